@@ -0,0 +1,261 @@
+import itertools
+import json
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Callable
+
+import click
+from loguru import logger
+
+from oobleck.engine.pipeline_instantiator import PipelineInstantiator
+from oobleck.planning.planner import create_pipeline_templates
+from oobleck.planning.profiler import LayerExecutionResult
+
+model_name: str = "benchmark.SyntheticModel"
+
+
+def make_profile_data(num_layers: int, seed: int) -> list[LayerExecutionResult]:
+    """Create synthetic profile data of a transformer-like model.
+
+    The first and the last layers (embedding and head) are heavier than
+    the others, and transformer layers have a small random variation.
+    """
+    rng = random.Random(seed)
+    profile_data = []
+    for index in range(num_layers):
+        scale = 3.0 if index in (0, num_layers - 1) else 1.0
+        forward = scale * rng.uniform(0.9, 1.1)
+        profile_data.append(
+            LayerExecutionResult(
+                layer_index=index,
+                layer_name=f"layers.{index}",
+                forward=forward,
+                backward=2 * forward,
+                mem_required=int(scale * rng.uniform(0.9, 1.1) * 2**30),
+                activation_bytes=16 * 2**20,
+            )
+        )
+    return profile_data
+
+
+def measure(func: Callable[[], Any], repeat: int) -> tuple[float, Any]:
+    """Run `func` `repeat` times and return the median elapsed time in seconds
+    and the result of the last run."""
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed.append(time.perf_counter() - start)
+    return statistics.median(elapsed), result
+
+
+def run_case(
+    num_layers: int,
+    num_nodes: int,
+    repeat: int,
+    max_enumeration_nodes: int,
+    num_distributed_options: int,
+    seed: int,
+) -> dict[str, Any]:
+    """Benchmark planning for one configuration.
+
+    Runs in a fresh process, so that peak RSS only accounts for this case.
+    """
+    profile_data = make_profile_data(num_layers, seed)
+    result: dict[str, Any] = {"num_layers": num_layers, "num_nodes": num_nodes}
+
+    template_num_nodes = list(range(1, min(num_layers, num_nodes) + 1))
+    result["create_pipeline_templates"], pipeline_templates = measure(
+        lambda: create_pipeline_templates(model_name, profile_data, template_num_nodes),
+        repeat,
+    )
+    result["num_templates"] = len(pipeline_templates)
+
+    instantiator = PipelineInstantiator(pipeline_templates, 4 * num_nodes, 1)
+
+    result["find_optimal_instantiation"], _ = measure(
+        lambda: instantiator.find_optimal_instantiation(num_nodes), repeat
+    )
+
+    if num_nodes <= max_enumeration_nodes:
+        result["enumerate_instantiation_options"], result["num_options"] = measure(
+            lambda: sum(
+                1 for _ in instantiator._enumerate_instantiation_options(num_nodes)
+            ),
+            repeat,
+        )
+
+        options = list(
+            itertools.islice(
+                instantiator._enumerate_instantiation_options(num_nodes),
+                num_distributed_options,
+            )
+        )
+        elapsed, _ = measure(
+            lambda: [instantiator.distribute_batch(option) for option in options],
+            repeat,
+        )
+        result["distribute_batch"] = elapsed / max(1, len(options))
+        result["num_distributed_options"] = len(options)
+    else:
+        result["enumerate_instantiation_options"] = None
+        result["num_options"] = None
+        result["distribute_batch"] = None
+        result["num_distributed_options"] = 0
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_bytes"] = peak_rss if sys.platform == "darwin" else peak_rss * 1024
+    return result
+
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_int_list(ctx, param, value: str) -> list[int]:
+    try:
+        return [int(v) for v in value.split(",")]
+    except ValueError:
+        raise click.BadParameter("must be a comma-separated list of integers.")
+
+
+@click.group(help="CPU-only benchmarks of Oobleck planning with synthetic profiles.")
+def main():
+    pass
+
+
+@main.command(help="Run benchmarks and write results to a JSON file.")
+@click.option(
+    "--num_layers",
+    type=str,
+    default="24,64,128,256",
+    callback=parse_int_list,
+    help="Comma-separated numbers of layers.",
+)
+@click.option(
+    "--num_nodes",
+    type=str,
+    default="1,4,16,64,256",
+    callback=parse_int_list,
+    help="Comma-separated numbers of nodes.",
+)
+@click.option("--repeat", type=int, default=3, help="Repetitions per measurement.")
+@click.option(
+    "--max_enumeration_nodes",
+    type=int,
+    default=32,
+    help="Skip enumerating instantiation options for more nodes than this.",
+)
+@click.option(
+    "--num_distributed_options",
+    type=int,
+    default=16,
+    help="Number of instantiation options to run distribute_batch for.",
+)
+@click.option("--seed", type=int, default=0, help="Seed of synthetic profiles.")
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default="planning_benchmark.json",
+    help="Path to the result JSON file.",
+)
+def run(
+    num_layers: list[int],
+    num_nodes: list[int],
+    repeat: int,
+    max_enumeration_nodes: int,
+    num_distributed_options: int,
+    seed: int,
+    output: Path,
+):
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    results = []
+    for layers in num_layers:
+        for nodes in num_nodes:
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=get_context("spawn")
+            ) as executor:
+                result = executor.submit(
+                    run_case,
+                    layers,
+                    nodes,
+                    repeat,
+                    max_enumeration_nodes,
+                    num_distributed_options,
+                    seed,
+                ).result()
+            print(json.dumps(result))
+            results.append(result)
+
+    output.write_text(
+        json.dumps(
+            {
+                "commit": get_commit(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "repeat": repeat,
+                "seed": seed,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+    print(f"Results are written to {output}")
+
+
+@main.command(help="Compare two result JSON files (new / base ratio).")
+@click.argument("base", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.argument("new", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+def compare(base: Path, new: Path):
+    metrics = [
+        "create_pipeline_templates",
+        "find_optimal_instantiation",
+        "enumerate_instantiation_options",
+        "distribute_batch",
+        "peak_rss_bytes",
+    ]
+
+    def load(path: Path) -> dict[tuple[int, int], dict[str, Any]]:
+        data = json.loads(path.read_text())
+        return {
+            (result["num_layers"], result["num_nodes"]): result
+            for result in data["results"]
+        }
+
+    base_results, new_results = load(base), load(new)
+    print("layers nodes " + " ".join(f"{metric:>32}" for metric in metrics))
+    for key in sorted(base_results.keys() & new_results.keys()):
+        ratios = []
+        for metric in metrics:
+            base_value = base_results[key].get(metric)
+            new_value = new_results[key].get(metric)
+            if not base_value or new_value is None:
+                ratios.append(f"{'-':>32}")
+            else:
+                ratios.append(f"{new_value / base_value:>31.2f}x")
+        print(f"{key[0]:>6} {key[1]:>5} " + " ".join(ratios))
+
+
+if __name__ == "__main__":
+    main()
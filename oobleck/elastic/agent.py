@@ -97,7 +97,9 @@ class Agent:
         # Get distributed information and code from the master
         dist_info: DistInfo = stub.GetDistInfo(Empty())
         self.dist_info = list(
-            HostInfo(host.ip, host.devices, host.port, HostStatus[host.status])
+            HostInfo(
+                host.ip, host.devices, host.port, HostStatus[host.status], host.speed
+            )
             for host in dist_info.hosts
         )
         training_args: CodeInfo = stub.GetCode(Empty())
@@ -127,7 +129,13 @@ class Agent:
         for dist_info in self.stub.WatchReconfigurationNotification(Empty()):
             dist_info = cast(DistInfo, dist_info)
             dist_info = [
-                HostInfo(host.ip, host.devices, host.port, HostStatus[host.status])
+                HostInfo(
+                    host.ip,
+                    host.devices,
+                    host.port,
+                    HostStatus[host.status],
+                    host.speed,
+                )
                 for host in dist_info.hosts
             ]
 
@@ -7,16 +7,18 @@ from typing import ClassVar as _ClassVar, Iterable as _Iterable, Mapping as _Map
 DESCRIPTOR: _descriptor.FileDescriptor
 
 class HostInfo(_message.Message):
-    __slots__ = ("ip", "devices", "port", "status")
+    __slots__ = ("ip", "devices", "port", "status", "speed")
     IP_FIELD_NUMBER: _ClassVar[int]
     DEVICES_FIELD_NUMBER: _ClassVar[int]
     PORT_FIELD_NUMBER: _ClassVar[int]
     STATUS_FIELD_NUMBER: _ClassVar[int]
+    SPEED_FIELD_NUMBER: _ClassVar[int]
     ip: str
     devices: str
     port: int
     status: str
-    def __init__(self, ip: _Optional[str] = ..., devices: _Optional[str] = ..., port: _Optional[int] = ..., status: _Optional[str] = ...) -> None: ...
+    speed: float
+    def __init__(self, ip: _Optional[str] = ..., devices: _Optional[str] = ..., port: _Optional[int] = ..., status: _Optional[str] = ..., speed: _Optional[float] = ...) -> None: ...
 
 class DistInfo(_message.Message):
     __slots__ = ("hosts",)
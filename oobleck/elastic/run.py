@@ -65,6 +65,8 @@ class HostInfo:
     devices: str
     port: int
     status: HostStatus = HostStatus.up
+    # Relative speed of the host to the host that the model is profiled on
+    speed: float = 1.0
 
     def __eq__(self, other: HostInfo) -> bool:
         return (
@@ -85,9 +87,9 @@ class HostInfo:
         worker-0 slots=2 devices=0,1 port=22
         worker-0 slots=2 devices=2,3 port=22
         worker-1 slots=2 port=1234
-        worker-1 slots=2 port=1235
+        worker-1 slots=2 port=1235 speed=0.5
 
-        The `devices` and `port` fields are optional.
+        The `devices`, `port`, and `speed` fields are optional.
 
         You must specify the same number of slots to all agents.
 
@@ -98,6 +100,11 @@ class HostInfo:
 
         If you use Docker containers to split GPUs on the same host,
         you can specify different port numbers for each container.
+
+        You can optionally specify the `speed` field if hosts have different GPUs.
+        It is the relative speed of the host to the others (default: 1.0),
+        e.g. 0.5 for a host that takes twice as long to compute.
+        Pipeline templates and batch distribution take speeds into account.
         """
         hosts: list[HostInfo] = []
         with hostfile_path.open("r") as f:
@@ -107,11 +114,12 @@ class HostInfo:
                 if not parts:
                     continue
 
-                ip, slots, devices, port = (
+                ip, slots, devices, port, speed = (
                     socket.gethostbyname(parts[0]),
                     None,
                     None,
                     None,
+                    1.0,
                 )
                 first_slots = None
                 for part in parts[1:]:
@@ -129,6 +137,10 @@ class HostInfo:
                         devices = part.split("=")[1]
                     elif part.startswith("port="):
                         port = int(part.split("=")[1])
+                    elif part.startswith("speed="):
+                        speed = float(part.split("=")[1])
+                        if speed <= 0:
+                            raise ValueError("The `speed` field must be positive.")
 
                 if slots is None:
                     raise ValueError(
@@ -140,7 +152,7 @@ class HostInfo:
                 if port is None:
                     port = 22
 
-                host_info = HostInfo(ip, devices, port)
+                host_info = HostInfo(ip, devices, port, speed=speed)
                 if any(host == host_info for host in hosts):
                     raise ValueError(f"Duplicated host: {host_info}")
 
@@ -300,6 +312,7 @@ class MasterService(master_service_pb2_grpc.OobleckMasterServicer):
                     devices=host.devices,
                     port=host.port,
                     status=host.status.name,
+                    speed=host.speed,
                 )
                 for host, _ in agent_list
             ]
@@ -360,6 +373,7 @@ class MasterService(master_service_pb2_grpc.OobleckMasterServicer):
                         devices=host.devices,
                         port=host.port,
                         status=host.status.name,
+                        speed=host.speed,
                     )
                     for host, _ in agent_list
                 ]
@@ -0,0 +1,159 @@
+import math
+
+# A pipeline template in a batch distribution problem:
+# (latency with zero microbatches, latency per microbatch, number of pipelines)
+# Latency of a pipeline with n microbatches is `zero_latency + kstar_latency * n`.
+PipelineLatency = tuple[float, float, int]
+
+
+def distribute_microbatches(
+    pipelines: tuple[PipelineLatency, ...],
+    global_num_microbatches: int,
+    need_all_pipelines_have_batch: bool = False,
+) -> tuple[float, tuple[int, ...]] | None:
+    """Find the distribution of microbatches that minimizes iteration time.
+
+    Minimize Z = max(latency of each pipeline), while pipelines process
+    `global_num_microbatches` microbatches in total. Pipelines from
+    the same template process the same number of microbatches.
+
+    The optimal Z is the latency of some template with some microbatches,
+    thus it is found by binary search over candidate latencies
+    with a bounded subset-sum feasibility check.
+
+    This module does not depend on pipeline templates, so that it can be
+    imported by worker processes cheaply.
+
+    Args:
+        pipelines (tuple[PipelineLatency, ...]): Latency model and the number
+            of pipelines of each template. `kstar_latency` must not be negative.
+        global_num_microbatches (int): The total number of microbatches.
+        need_all_pipelines_have_batch (bool): Whether every pipeline
+            must have at least one microbatch.
+
+    Returns:
+        A tuple of the optimal iteration time and the number of microbatches
+        of each template in the same order of `pipelines`,
+        or None if there is no feasible distribution.
+    """
+    min_num_microbatches = 1 if need_all_pipelines_have_batch else 0
+
+    def get_latency(index: int, num_microbatches: int) -> float:
+        zero_latency, kstar_latency, _ = pipelines[index]
+        return zero_latency + kstar_latency * num_microbatches
+
+    def get_max_num_microbatches(index: int, latency: float) -> int:
+        zero_latency, kstar_latency, num_pipelines = pipelines[index]
+        max_num_microbatches = global_num_microbatches // num_pipelines
+        if kstar_latency == 0:
+            return max_num_microbatches if latency >= zero_latency else -1
+        return min(
+            max_num_microbatches,
+            math.floor((latency - zero_latency) / kstar_latency + 1e-9),
+        )
+
+    def get_reachable(latency: float) -> list[int] | None:
+        # reachable[i] is a bitmask of total numbers of microbatches
+        # that pipelines of pipelines[:i] can process within the latency.
+        mask = (1 << (global_num_microbatches + 1)) - 1
+        reachable = [1]
+        for index, (_, _, num_pipelines) in enumerate(pipelines):
+            max_num_microbatches = get_max_num_microbatches(index, latency)
+            if max_num_microbatches < min_num_microbatches:
+                return None
+
+            reachable_t = (
+                reachable[-1] << (num_pipelines * min_num_microbatches)
+            ) & mask
+            # Bounded multiplicity with binary splitting: 1, 2, 4, ..., remainder
+            remaining = max_num_microbatches - min_num_microbatches
+            chunk = 1
+            while remaining > 0:
+                chunk = min(chunk, remaining)
+                reachable_t |= (reachable_t << (num_pipelines * chunk)) & mask
+                remaining -= chunk
+                chunk *= 2
+            reachable.append(reachable_t)
+
+        if not reachable[-1] >> global_num_microbatches & 1:
+            return None
+        return reachable
+
+    if not pipelines:
+        return None
+
+    max_latency = max(
+        0.0,
+        *(
+            get_latency(index, global_num_microbatches // num_pipelines)
+            for index, (_, _, num_pipelines) in enumerate(pipelines)
+        ),
+    )
+    if get_reachable(max_latency) is None:
+        return None
+
+    # Narrow down the range of Z from the lower bound where microbatches are real numbers.
+    lower = max(0.0, *(zero_latency for zero_latency, _, _ in pipelines))
+    if all(kstar_latency > 0 for _, kstar_latency, _ in pipelines):
+        slope = sum(
+            num_pipelines / kstar_latency
+            for _, kstar_latency, num_pipelines in pipelines
+        )
+        intercept = sum(
+            num_pipelines * zero_latency / kstar_latency
+            for zero_latency, kstar_latency, num_pipelines in pipelines
+        )
+        lower = max(lower, (global_num_microbatches + intercept) / slope)
+
+    step = max(kstar_latency for _, kstar_latency, _ in pipelines) or 1.0
+    upper = lower + step
+    while upper < max_latency and get_reachable(upper) is None:
+        step *= 2
+        upper = lower + step
+    upper = min(upper, max_latency)
+
+    candidates: set[float] = set()
+    for index, (_, kstar_latency, _) in enumerate(pipelines):
+        max_num_microbatches = get_max_num_microbatches(index, upper)
+        if kstar_latency == 0:
+            min_candidate = max_num_microbatches
+        else:
+            min_candidate = max(
+                min_num_microbatches, get_max_num_microbatches(index, lower)
+            )
+        candidates.update(
+            max(0.0, get_latency(index, num_microbatches))
+            for num_microbatches in range(min_candidate, max_num_microbatches + 1)
+            if num_microbatches >= min_num_microbatches
+        )
+    candidates = sorted(candidate for candidate in candidates if candidate <= upper)
+    candidates.append(upper)
+
+    low, high = 0, len(candidates) - 1
+    while low < high:
+        mid = (low + high) // 2
+        if get_reachable(candidates[mid]) is not None:
+            high = mid
+        else:
+            low = mid + 1
+    latency = candidates[low]
+    reachable = get_reachable(latency)
+
+    # Backtrack the number of microbatches of each template.
+    num_microbatches = [0] * len(pipelines)
+    remaining = global_num_microbatches
+    for index in reversed(range(len(pipelines))):
+        num_pipelines = pipelines[index][2]
+        num_microbatches[index] = next(
+            n
+            for n in range(
+                get_max_num_microbatches(index, latency),
+                min_num_microbatches - 1,
+                -1,
+            )
+            if remaining >= num_pipelines * n
+            and reachable[index] >> (remaining - num_pipelines * n) & 1
+        )
+        remaining -= num_pipelines * num_microbatches[index]
+
+    return latency, tuple(num_microbatches)
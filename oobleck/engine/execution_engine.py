@@ -2,6 +2,7 @@ import itertools
 import math
 import os
 import time
+from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 from typing import Any, Callable, Iterator
@@ -12,6 +13,7 @@ import torch.nn as nn
 from colossalai.accelerator import get_accelerator
 from colossalai.booster import Booster
 from colossalai.shardformer.policies.auto_policy import _fullname
+from cornstarch import HeterogeneousDataLoader
 from cornstarch.pipeline_template import PipelineTemplate
 from cornstarch.shardformer.policies.auto_policy import get_autopolicy
 from cornstarch.shardformer.policies.pipeline_template_policy import (
@@ -26,8 +28,12 @@ from torch.utils.data import DataLoader
 from oobleck.engine.configuration_engine import ConfigurationEngine
 from oobleck.engine.pipeline_instantiator import PipelineInstantiator
 from oobleck.engine.plugin import OobleckPlugin
-from oobleck.planning.planner import create_pipeline_templates
-from oobleck.planning.profiler import ModelProfiler
+from oobleck.planning.planner import (
+    create_pipeline_template_for_node_speeds,
+    create_pipeline_templates,
+)
+from oobleck.planning.profiler import LayerExecutionResult, ModelProfiler
+from oobleck.planning.template_cache import PipelineTemplateCache
 
 
 class ExecutionEngine:
@@ -76,11 +82,18 @@ class ExecutionEngine:
         criterion: Callable | None = None,
         dataloader: DataLoader | None = None,
         lr_scheduler: LRScheduler | None = None,
+        microbatch_size_candidates: list[int] | None = None,
     ) -> tuple[nn.Module, Optimizer, Callable, DataLoader, LRScheduler]:
         """Initialize pipeline templates and distributed configuration.
 
         This function automatically initializes torch.distributed,
         create pipeline templates, instantiate pipelines, and then boost the model.
+
+        If `microbatch_size_candidates` is given, the model is profiled with
+        each of the microbatch sizes that divide the global batch size,
+        and the one with the shortest estimated iteration time is used
+        instead of the plugin's microbatch size. Microbatch sizes for which
+        no pipeline template fits in device memory are skipped.
         """
 
         assert (
@@ -103,61 +116,109 @@ class ExecutionEngine:
             precision=self.plugin.precision,
             tp_size=self.plugin.tp_size,
             base_dir=configuration_engine.base_dir,
+            num_iterations=self.plugin.profile_num_iterations,
+            timing_statistic=self.plugin.timing_statistic,
+            deduplicate_layers=self.plugin.profile_deduplicate_layers,
         )
 
+        if microbatch_size_candidates is None:
+            microbatch_sizes = [self.plugin.microbatch_size]
+        else:
+            microbatch_sizes = sorted(
+                {
+                    microbatch_size
+                    for microbatch_size in microbatch_size_candidates
+                    if self.plugin.global_batch_size % microbatch_size == 0
+                }
+            )
+            if not microbatch_sizes:
+                raise ValueError(
+                    f"None of microbatch sizes {microbatch_size_candidates} divides "
+                    f"global batch size {self.plugin.global_batch_size}."
+                )
+
+        # All microbatch sizes are profiled in one process with slices of one batch.
         profile_dataloder = DataLoader(
             dataloader.dataset,
-            batch_size=self.plugin.microbatch_size,
+            batch_size=max(microbatch_sizes),
             collate_fn=dataloader.collate_fn,
         )
         inputs = next(iter(profile_dataloder))
-        profiler.init_profile(inputs)
+        profiler.init_profile(inputs, microbatch_sizes=microbatch_sizes)
 
         configuration_engine.init_distributed()
-        profile_data = profiler.load_profile(self.plugin.microbatch_size)
+        # load_profile() is a collective, thus all ranks load profiles in the same order.
+        profile_data = {
+            microbatch_size: profiler.load_profile(microbatch_size)
+            for microbatch_size in microbatch_sizes
+        }
 
-        # Calculate the minimum number of nodes required
-        memory = torch.cuda.get_device_properties(0).total_memory
-        min_num_nodes = max(
-            1,
-            math.ceil(sum(layer.mem_required for layer in profile_data) / memory),
-        )
-        max_num_nodes = configuration_engine.world_size // self.plugin.tp_size
-
-        logger.debug("Creating pipeline templates...")
         model_name = _fullname(model)
-        pipeline_templates = create_pipeline_templates(
-            model_name,
-            profile_data,
-            list(range(min_num_nodes, max_num_nodes + 1)),
-        )
-
         policy: PipelineTemplatePolicyBase = get_autopolicy(model_name)
         policy.set_model(model)
-        for key in list(pipeline_templates.keys()):
+
+        modules = dict(model.named_modules())
+        self.plugin.layer_num_parameters = [
+            sum(param.numel() for param in modules[layer.layer_name].parameters())
+            for layer in profile_data[microbatch_sizes[0]]
+        ]
+        # Optimizer step time does not depend on the microbatch size.
+        self.plugin.layer_optimizer_step_times = [
+            layer.optimizer_step for layer in profile_data[microbatch_sizes[0]]
+        ]
+
+        num_hosts = len(configuration_engine.dist_info)
+
+        def evaluate(microbatch_size: int):
             try:
-                template = pipeline_templates[key]
-                policy.pipeline_template_sanity_check(template)
-            except ValueError as e:
-                logger.debug(
-                    f"Pipeline template {template} failed to pass sanity check and removed: {e}"
+                pipeline_instantiator = self._create_pipeline_instantiator(
+                    model_name, policy, profile_data[microbatch_size], microbatch_size
+                )
+                return (
+                    pipeline_instantiator,
+                    pipeline_instantiator.find_optimal_instantiation(num_hosts),
                 )
-                del pipeline_templates[key]
+            except RuntimeError as e:
+                logger.warning(f"Microbatch size {microbatch_size} is infeasible: {e}")
+                return e
+
+        # Planning releases the GIL, thus candidates are planned in parallel.
+        with ThreadPoolExecutor(max_workers=len(microbatch_sizes)) as executor:
+            results = dict(
+                zip(microbatch_sizes, executor.map(evaluate, microbatch_sizes))
+            )
 
-        if not pipeline_templates:
-            raise RuntimeError("No pipeline templates created.")
+        feasible_results = {
+            microbatch_size: result
+            for microbatch_size, result in results.items()
+            if not isinstance(result, RuntimeError)
+        }
+        if not feasible_results:
+            raise next(iter(results.values()))
+
+        for microbatch_size, (_, (latency, _, _)) in feasible_results.items():
+            logger.debug(
+                f"Microbatch size {microbatch_size}: estimated iteration time {latency} ms"
+            )
+        microbatch_size = min(
+            feasible_results, key=lambda size: feasible_results[size][1][0]
+        )
+        pipeline_instantiator, (_, num_instances, num_microbatches) = feasible_results[
+            microbatch_size
+        ]
 
-        self.pipeline_templates = pipeline_templates
-        logger.debug(f"Pipeline templates: {self.pipeline_templates}")
+        if microbatch_size != self.plugin.microbatch_size:
+            logger.info(f"Microbatch size {microbatch_size} is selected.")
+            self.plugin.microbatch_size = microbatch_size
+            if isinstance(dataloader, HeterogeneousDataLoader):
+                dataloader.microbatch_size = microbatch_size
 
-        pipeline_instantiator = PipelineInstantiator(
-            self.pipeline_templates,
-            self.plugin.global_batch_size // self.plugin.microbatch_size,
-            self.plugin.fault_tolerance_threshold,
-        )
-        num_instances, num_microbatches = pipeline_instantiator.instantiate(
-            len(configuration_engine.dist_info)
+        self.pipeline_templates = pipeline_instantiator.pipeline_templates
+        logger.debug(f"Pipeline templates: {self.pipeline_templates}")
+        self.plugin.create_template_for_node_speeds = (
+            pipeline_instantiator.create_template_for_node_speeds
         )
+
         logger.debug(f"Pipeline instances: {num_instances}")
         logger.debug(f"Microbatches: {num_microbatches}")
         self.plugin.set_pipelines(
@@ -170,7 +231,143 @@ class ExecutionEngine:
             num_microbatches,
         )
         self.booster = Booster(plugin=self.plugin, **self.booster_kwargs)
-        return self.booster.boost(model, optimizer, criterion, dataloader, lr_scheduler)
+        result = self.booster.boost(
+            model, optimizer, criterion, dataloader, lr_scheduler
+        )
+        self.plugin.precompute_reconfiguration_plans(self.pipeline_templates)
+        return result
+
+    def _create_pipeline_instantiator(
+        self,
+        model_name: str,
+        policy: PipelineTemplatePolicyBase,
+        profile_data: list[LayerExecutionResult],
+        microbatch_size: int,
+    ) -> PipelineInstantiator:
+        """Create pipeline templates for the given microbatch size
+        and a pipeline instantiator that uses them.
+
+        Raises:
+            RuntimeError: If no pipeline template is feasible.
+        """
+        configuration_engine = ConfigurationEngine.get_instance()
+
+        # Calculate the minimum number of nodes required
+        memory = torch.cuda.get_device_properties(0).total_memory
+        min_num_nodes = max(
+            1,
+            math.ceil(sum(layer.mem_required for layer in profile_data) / memory),
+        )
+        max_num_nodes = configuration_engine.world_size // self.plugin.tp_size
+        num_nodes = list(range(min_num_nodes, max_num_nodes + 1))
+
+        # Optimize each template for the number of microbatches that a pipeline
+        # of the template is expected to get. Microbatches are distributed
+        # roughly in proportion to the number of nodes of pipelines,
+        # thus an n-stage pipeline gets about n / max_num_nodes of them.
+        global_num_microbatches = self.plugin.global_batch_size // microbatch_size
+
+        def get_num_microbatches(num_stages: int) -> int:
+            return max(1, global_num_microbatches * num_stages // max_num_nodes)
+
+        num_nodes_per_num_microbatches: dict[int, list[int]] = defaultdict(list)
+        for num_stages in num_nodes:
+            num_nodes_per_num_microbatches[get_num_microbatches(num_stages)].append(
+                num_stages
+            )
+
+        planner_options = dict(
+            device_memory=memory,
+            inter_node_bandwidth=self.plugin.inter_node_bandwidth,
+            inter_node_latency=self.plugin.inter_node_latency,
+        )
+
+        template_cache = PipelineTemplateCache(configuration_engine.base_dir)
+        cache_key = PipelineTemplateCache.get_cache_key(
+            model_name,
+            profile_data,
+            self.plugin.tp_size,
+            microbatch_size,
+            num_nodes,
+            num_microbatches={
+                num_stages: get_num_microbatches(num_stages) for num_stages in num_nodes
+            },
+            **planner_options,
+        )
+        pipeline_templates = template_cache.load(cache_key)
+
+        if pipeline_templates is None:
+            logger.debug(
+                f"Creating pipeline templates for microbatch size {microbatch_size}..."
+            )
+
+            def create_templates(
+                item: tuple[int, list[int]],
+            ) -> dict[int, PipelineTemplate]:
+                num_microbatches, template_num_nodes = item
+                return create_pipeline_templates(
+                    model_name,
+                    profile_data,
+                    template_num_nodes,
+                    num_microbatches=num_microbatches,
+                    **planner_options,
+                )
+
+            # Planning releases the GIL, thus templates optimized for
+            # different numbers of microbatches are planned in parallel.
+            with ThreadPoolExecutor() as executor:
+                pipeline_templates = dict(
+                    sorted(
+                        itertools.chain.from_iterable(
+                            templates.items()
+                            for templates in executor.map(
+                                create_templates, num_nodes_per_num_microbatches.items()
+                            )
+                        )
+                    )
+                )
+
+            rejected: dict[int, str] = {}
+            for key in list(pipeline_templates.keys()):
+                try:
+                    template = pipeline_templates[key]
+                    policy.pipeline_template_sanity_check(template)
+                except ValueError as e:
+                    logger.debug(
+                        f"Pipeline template {template} failed to pass sanity check and removed: {e}"
+                    )
+                    rejected[key] = str(e)
+                    del pipeline_templates[key]
+
+            template_cache.store(cache_key, pipeline_templates, rejected)
+
+        if not pipeline_templates:
+            raise RuntimeError("No pipeline templates created.")
+
+        def create_template_for_node_speeds(
+            node_speeds: list[float],
+        ) -> PipelineTemplate:
+            template = create_pipeline_template_for_node_speeds(
+                model_name,
+                profile_data,
+                node_speeds,
+                num_microbatches=get_num_microbatches(len(node_speeds)),
+                **planner_options,
+            )
+            policy.pipeline_template_sanity_check(template)
+            return template
+
+        return PipelineInstantiator(
+            pipeline_templates,
+            global_num_microbatches,
+            self.plugin.fault_tolerance_threshold,
+            host_speeds=[host.speed for host in configuration_engine.dist_info],
+            create_template_for_node_speeds=create_template_for_node_speeds,
+            num_workers=self.plugin.planning_num_workers,
+            layer_num_gradient_bytes=self.plugin.layer_num_gradient_bytes,
+            allreduce_bandwidth=self.plugin.inter_node_bandwidth,
+            layer_optimizer_step_times=self.plugin.layer_optimizer_step_times,
+        )
 
     def _estimate_max_num_nodes_required(self):
         # TODO: implement it
@@ -298,6 +495,7 @@ class ExecutionEngine:
         model, optimizer, dataloader, _ = self.plugin.reconfigure(
             self.pipeline_templates, model, optimizer, dataloader
         )
+        self.plugin.precompute_reconfiguration_plans(self.pipeline_templates)
 
         self.need_reconfiguration = False
         logger.info("Reconfiguration is done.")
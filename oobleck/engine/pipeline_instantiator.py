@@ -1,24 +1,100 @@
-from collections import defaultdict
+import copy
+import itertools
+import math
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Callable, Iterator
 
-import pulp
 from cornstarch.pipeline_template import PipelineTemplate
 from loguru import logger
 
+from oobleck.engine.batch_distribution import PipelineLatency, distribute_microbatches
+
+try:
+    import pulp
+except ImportError:
+    pulp = None
+
 
 class PipelineInstantiator:
     """A class that determines the number of pipelines to be instantiated
     from each pipeline template and the number of microbatches.
+
+    Hosts may have different speeds. Pipelines are placed on hosts in order,
+    each of which takes `num_stages` consecutive hosts, and the templates of
+    the pipelines are replaced with ones that reflect the host speeds.
+
+    Args:
+        pipeline_templates (dict[int, PipelineTemplate]): Pipeline templates
+            planned for hosts with the same speed (num_stages -> template).
+        global_num_microbatches (int): Number of microbatches in a global batch.
+        fault_tolerance_threshold (int): Minimum number of pipelines.
+        host_speeds (list[float], optional): Relative speed of each host in order.
+            None if all hosts have the same speed.
+        create_template_for_node_speeds (Callable, optional): A function that
+            creates a pipeline template for the given speeds of nodes in order,
+            raising RuntimeError or ValueError if it cannot.
+            If None, stages of templates are not changed and templates
+            are only slowed down by their slowest host.
+        use_pulp (bool): Distribute microbatches with PuLP
+            instead of the in-process solver. Requires `pulp`.
+        num_workers (int): The number of worker processes that distribute
+            microbatches for instantiation options in parallel.
+            If 0, options are evaluated in this process.
+        layer_num_gradient_bytes (list[int], optional): The number of bytes of
+            gradients of each layer held by a device, all-reduced across pipelines.
+        allreduce_bandwidth (float, optional): Bandwidth between hosts in Gbps
+            for gradient all-reduce. The iteration time includes all-reduce
+            time only if both this and `layer_num_gradient_bytes` are given.
+        layer_optimizer_step_times (list[float], optional): Time of an optimizer
+            step of each layer in ms. If given, the iteration time includes
+            the optimizer step time.
     """
 
+    # Results of batch distribution are memoized across instantiators,
+    # so that reconfiguration reuses results that are computed at startup.
+    _batch_distributions: dict[
+        tuple[tuple[PipelineLatency, ...], int, bool],
+        tuple[float, tuple[int, ...]] | None,
+    ] = {}
+    _max_batch_distributions: int = 1 << 16
+    _batch_distributions_lock = threading.Lock()
+    _executor: ProcessPoolExecutor | None = None
+    _executor_lock = threading.Lock()
+    # Relative difference of scores under which reconfiguration candidates
+    # are considered equal and compared by layer reuse.
+    reconfiguration_score_tolerance: float = 0.01
+
     def __init__(
         self,
         pipeline_templates: dict[int, PipelineTemplate],
         global_num_microbatches: int,
         fault_tolerance_threshold: int,
+        host_speeds: list[float] | None = None,
+        create_template_for_node_speeds: (
+            Callable[[list[float]], PipelineTemplate] | None
+        ) = None,
+        use_pulp: bool = False,
+        num_workers: int = 0,
+        layer_num_gradient_bytes: list[int] | None = None,
+        allreduce_bandwidth: float | None = None,
+        layer_optimizer_step_times: list[float] | None = None,
     ):
         self.pipeline_templates = pipeline_templates
         self.global_num_microbatches = global_num_microbatches
         self.fault_tolerance_threshold = fault_tolerance_threshold
+        self.host_speeds = host_speeds
+        self.create_template_for_node_speeds = create_template_for_node_speeds
+        self.use_pulp = use_pulp
+        self.num_workers = num_workers
+        self.layer_num_gradient_bytes = layer_num_gradient_bytes
+        self.allreduce_bandwidth = allreduce_bandwidth
+        self.layer_optimizer_step_times = layer_optimizer_step_times
+        self._templates_for_node_speeds: dict[
+            tuple[PipelineTemplate, tuple[float, ...]], PipelineTemplate
+        ] = {}
 
     def instantiate(
         self, num_nodes: int
@@ -41,93 +117,448 @@ class PipelineInstantiator:
                    and the global batch size.
                 2. If failed to find a set of pipeline templates for the given number of nodes.
         """
-        instantiations_options = self._enumerate_instantiation_options(num_nodes)
+        _, num_instances, num_microbatches = self.find_optimal_instantiation(num_nodes)
+        return num_instances, num_microbatches
 
-        # Call self._distribute_batch for each element in instantiations_options
-        # Should also include None to properly calculate "index" of optimal dist
-        batch_distributions = [
-            self.distribute_batch(option) for option in instantiations_options
-        ]
+    def find_optimal_instantiation(
+        self, num_nodes: int
+    ) -> tuple[float, dict[PipelineTemplate, int], dict[PipelineTemplate, int]]:
+        """Same as `instantiate()`, but also returns the estimated iteration time.
 
-        if all(dist is None for dist in batch_distributions):
-            raise RuntimeError(
-                f"Failed to find optimal batch distribution for {num_nodes} nodes."
+        Used to compare instantiations across different inputs,
+        e.g. pipeline templates planned for different microbatch sizes.
+
+        Returns:
+            A tuple of three objects:
+                1. float: The estimated iteration time in ms.
+                2. dict[PipelineTemplate, int]: the number of pipelines to be instantiated
+                3. dict[PipelineTemplate, int]: the number of microbatches per pipeline
+
+        Raises:
+            RuntimeError: Same as `instantiate()`.
+        """
+        if self.host_speeds is not None:
+            assert (
+                len(self.host_speeds) == num_nodes
+            ), "Host speeds must be given for all nodes."
+
+        # Latency of templates is replaced by host speeds, thus partial options
+        # can only be bounded with the original templates if all hosts are the same.
+        can_prune_partial_options = self.host_speeds is None or all(
+            speed == 1.0 for speed in self.host_speeds
+        )
+
+        optimal: (
+            tuple[float, dict[PipelineTemplate, int], dict[PipelineTemplate, int]]
+            | None
+        ) = None
+
+        def prune(
+            option: dict[PipelineTemplate, int],
+            num_remaining_nodes: int,
+            candidates: list[PipelineTemplate],
+        ) -> bool:
+            return (
+                can_prune_partial_options
+                and optimal is not None
+                and self._is_bounded_by(
+                    optimal[0],
+                    self._latency_lower_bound(option, num_remaining_nodes, candidates),
+                )
             )
 
+        def get_options() -> Iterator[dict[PipelineTemplate, int]]:
+            for option in self._enumerate_instantiation_options(num_nodes, prune):
+                if self.host_speeds is not None:
+                    pipelines = list(
+                        itertools.chain.from_iterable(
+                            itertools.repeat(template, num_templates)
+                            for template, num_templates in option.items()
+                        )
+                    )
+                    option = dict(Counter(self.apply_host_speeds(pipelines)))
+
+                if optimal is None or not self._is_bounded_by(
+                    optimal[0], self._latency_lower_bound(option, 0, [])
+                ):
+                    yield option
+
+        # Options are evaluated in batches in parallel,
+        # and the best result so far prunes options of the next batches.
+        options = get_options()
+        batch_size = max(1, 4 * self.num_workers)
         str = "Batch distributions===============\n"
-        for latency_dist in batch_distributions:
-            if latency_dist is None:
-                continue
-            latency, dist = latency_dist
-            str += f"  {dist} (latency {latency} ms)\n"
+        while batch := list(itertools.islice(options, batch_size)):
+            self.precompute_batch_distributions(batch)
+
+            for option in batch:
+                latency_dist = self.distribute_batch(option)
+                if latency_dist is None:
+                    continue
+                latency, dist = latency_dist
+                str += f"  {dist} (latency {latency} ms)\n"
+
+                if optimal is None or latency < optimal[0]:
+                    optimal = (latency, option, dist)
         str + "=================================="
         logger.debug(str)
 
-        # Find the second dictionary where its corresponding float is the minimum
-        optimal_distribution = min(
-            [dist for dist in batch_distributions if dist is not None],
-            key=lambda x: x[0],
-        )
-        index = batch_distributions.index(optimal_distribution)
-
-        logger.info(f"Optimal batch distribution: {optimal_distribution[1]}")
+        if optimal is None:
+            raise RuntimeError(
+                f"Failed to find optimal batch distribution for {num_nodes} nodes."
+            )
 
-        return (
-            instantiations_options[index],
-            optimal_distribution[1],
-        )
+        logger.info(f"Optimal batch distribution: {optimal[2]}")
+        return optimal
 
     def _enumerate_instantiation_options(
-        self, num_nodes: int
-    ) -> list[dict[PipelineTemplate, int]]:
-        """Use dynamic programming to get all feasible sets of pipeline templates
-        given number of nodes.
+        self,
+        num_nodes: int,
+        prune: (
+            Callable[[dict[PipelineTemplate, int], int, list[PipelineTemplate]], bool]
+            | None
+        ) = None,
+    ) -> Iterator[dict[PipelineTemplate, int]]:
+        """Lazily enumerate all feasible sets of pipeline templates
+        given number of nodes, with depth-first search.
         Implementation of Section 4.2.1.
 
+        Only one set is kept in memory at a time. Branches that cannot use
+        exactly `num_nodes` nodes or cannot have `fault_tolerance_threshold`
+        pipelines are never visited.
+
         Args:
             num_nodes (int): The number of nodes in the distributed environment.
+            prune (Callable, optional): Called with a partial set of pipeline
+                templates, the number of nodes that are not used yet, and
+                templates that can still be added. If it returns True,
+                no set that extends the partial set is enumerated.
 
-        Returns:
-            A list of dict[PipelineTemplate, int] objects, where each dict represents
-            a feasible set of pipeline templates.
+        Yields:
+            dict[PipelineTemplate, int]: a feasible set of pipeline templates,
+            where each value represents the number of pipelines.
+
+        Raises:
+            RuntimeError: If there is no feasible set of pipeline templates
+                for the given number of nodes.
         """
         logger.debug(
             f"Enumerating all feasible sets of pipeline templates for {num_nodes} nodes."
         )
 
-        pipeline_templates: list[PipelineTemplate] = list(
-            self.pipeline_templates.values()
+        # Visit templates that process more microbatches per node first,
+        # so that a good option is found early and bounds the rest.
+        pipeline_templates: list[PipelineTemplate] = sorted(
+            self.pipeline_templates.values(),
+            key=lambda template: (
+                template.kstar_latency * template.num_stages,
+                -template.num_stages,
+            ),
         )
 
-        dp: list[list[list[dict[PipelineTemplate, int]]]] = [
-            [[] for _ in range(num_nodes + 1)]
-            for _ in range(len(self.pipeline_templates) + 1)
-        ]
-
-        for i in range(1, len(pipeline_templates) + 1):
-            dp[i][0] = [defaultdict(int)]
-            for j in range(1, num_nodes + 1):
-                # (1) in Figure: copy all dicts
-                dp[i][j] = [combo.copy() for combo in dp[i - 1][j]]
-                if pipeline_templates[i - 1].num_stages <= j:
-                    # (2) in Figure: copy all dicts with one pipeline_templates[i - 1] added
-                    for combo in dp[i][j - pipeline_templates[i - 1].num_stages]:
-                        new_combo = combo.copy()
-                        new_combo[pipeline_templates[i - 1]] += 1
-
-                        # concatenate two lists
-                        dp[i][j].append(new_combo)
-
-        logger.debug(f"Dynamic programming result: {dp[-1][-1]}")
-        if not dp[-1][-1]:
+        # reachable[i] is a bitmask of numbers of nodes that pipelines
+        # of pipeline_templates[i:] can use exactly.
+        # min_num_stages[i] is the minimum number of stages of pipeline_templates[i:].
+        reachable: list[int] = [1] * (len(pipeline_templates) + 1)
+        min_num_stages: list[int] = [num_nodes + 1] * (len(pipeline_templates) + 1)
+        for i in reversed(range(len(pipeline_templates))):
+            num_stages = pipeline_templates[i].num_stages
+            mask = reachable[i + 1]
+            for n in range(num_stages, num_nodes + 1):
+                if mask >> (n - num_stages) & 1:
+                    mask |= 1 << n
+            reachable[i] = mask
+            min_num_stages[i] = min(min_num_stages[i + 1], num_stages)
+
+        if not reachable[0] >> num_nodes & 1:
             raise RuntimeError(
                 f"Failed to find feasible sets of pipeline templates for {num_nodes} nodes."
             )
-        return [
-            option
-            for option in dp[-1][-1]
-            if sum(option.values()) >= self.fault_tolerance_threshold
+
+        option: dict[PipelineTemplate, int] = {}
+
+        def search(
+            index: int, num_remaining_nodes: int, num_pipelines: int
+        ) -> Iterator[dict[PipelineTemplate, int]]:
+            if num_remaining_nodes == 0:
+                if num_pipelines >= self.fault_tolerance_threshold:
+                    # Pipelines are placed on hosts in the order of given templates.
+                    yield {
+                        template: option[template]
+                        for template in self.pipeline_templates.values()
+                        if template in option
+                    }
+                return
+
+            if (
+                not reachable[index] >> num_remaining_nodes & 1
+                or num_pipelines + num_remaining_nodes // min_num_stages[index]
+                < self.fault_tolerance_threshold
+            ):
+                return
+
+            if prune is not None and prune(
+                option, num_remaining_nodes, pipeline_templates[index:]
+            ):
+                return
+
+            template = pipeline_templates[index]
+            for count in range(num_remaining_nodes // template.num_stages, -1, -1):
+                if count > 0:
+                    option[template] = count
+                else:
+                    option.pop(template, None)
+                yield from search(
+                    index + 1,
+                    num_remaining_nodes - count * template.num_stages,
+                    num_pipelines + count,
+                )
+            option.pop(template, None)
+
+        yield from search(0, num_nodes, 0)
+
+    @staticmethod
+    def _is_bounded_by(latency: float, lower_bound: float) -> bool:
+        """Whether an option with the lower bound cannot be faster than `latency`.
+        Tolerates floating point errors of the lower bound."""
+        return lower_bound * (1 - 1e-9) >= latency
+
+    @staticmethod
+    def _zero_microbatch_latency(template: PipelineTemplate) -> float:
+        # Latency of the template extrapolated to zero microbatches,
+        # which every template in an option adds as a bound of iteration time.
+        return (
+            template.pseudo_latency - template.kstar_latency * 4 * template.num_stages
+        )
+
+    def _latency_lower_bound(
+        self,
+        option: dict[PipelineTemplate, int],
+        num_remaining_nodes: int,
+        candidates: list[PipelineTemplate],
+    ) -> float:
+        """Get a lower bound of the iteration time of any set of pipeline templates
+        that extends `option` with pipelines from `candidates`
+        using `num_remaining_nodes` more nodes.
+
+        Microbatch distribution is relaxed to real numbers: with iteration
+        time Z, a pipeline from template t processes at most
+        (Z - t.latency(0)) / t.kstar_latency microbatches. Remaining nodes
+        process at most as many microbatches per node as the best candidate.
+        """
+        bound = max(
+            (self._zero_microbatch_latency(template) for template in option),
+            default=0.0,
+        )
+        if num_remaining_nodes == 0:
+            candidates = []
+        if any(
+            template.kstar_latency <= 0
+            for template in itertools.chain(option, candidates)
+        ):
+            # Such templates process infinitely many microbatches.
+            return bound
+
+        # Microbatches processed by pipelines in option: slope * Z + intercept
+        slope = sum(
+            num_templates / template.kstar_latency
+            for template, num_templates in option.items()
+        )
+        intercept = -sum(
+            num_templates
+            * self._zero_microbatch_latency(template)
+            / template.kstar_latency
+            for template, num_templates in option.items()
+        )
+
+        def solve(slope: float, intercept: float) -> float:
+            if slope <= 0:
+                return math.inf
+            return (self.global_num_microbatches - intercept) / slope
+
+        if not candidates:
+            return max(bound, solve(slope, intercept))
+
+        latency = math.inf
+        for template in candidates:
+            zero_latency = self._zero_microbatch_latency(template)
+            z = solve(slope, intercept)
+            if z > zero_latency:
+                # Remaining nodes contribute only above the zero-microbatch latency.
+                rate = num_remaining_nodes / (
+                    template.kstar_latency * template.num_stages
+                )
+                z = solve(slope + rate, intercept - rate * zero_latency)
+            latency = min(latency, z)
+        return max(bound, latency)
+
+    def apply_host_speeds(
+        self, pipelines: list[PipelineTemplate]
+    ) -> list[PipelineTemplate]:
+        """Replace templates of pipelines with ones that reflect host speeds.
+
+        All pipelines from the same template share the number of microbatches,
+        thus a template is replaced for the slowest host of each stage
+        among the pipelines.
+
+        Args:
+            pipelines (list[PipelineTemplate]): Pipelines in the order of hosts.
+
+        Returns:
+            list[PipelineTemplate]: Pipelines with replaced templates, in the same order.
+        """
+        if self.host_speeds is None:
+            return pipelines
+
+        assert sum(pipeline.num_stages for pipeline in pipelines) == len(
+            self.host_speeds
+        ), "Pipelines must use all hosts."
+
+        node_speeds: dict[PipelineTemplate, list[float]] = {}
+        host_index = 0
+        for pipeline in pipelines:
+            speeds = self.host_speeds[host_index : host_index + pipeline.num_stages]
+            if pipeline in node_speeds:
+                speeds = [min(a, b) for a, b in zip(node_speeds[pipeline], speeds)]
+            node_speeds[pipeline] = speeds
+            host_index += pipeline.num_stages
+
+        templates = {
+            template: self._get_template_for_node_speeds(template, speeds)
+            for template, speeds in node_speeds.items()
+        }
+        return [templates[pipeline] for pipeline in pipelines]
+
+    def _get_template_for_node_speeds(
+        self, template: PipelineTemplate, node_speeds: list[float]
+    ) -> PipelineTemplate:
+        if all(speed == 1.0 for speed in node_speeds):
+            return template
+
+        key = (template, tuple(node_speeds))
+        if key in self._templates_for_node_speeds:
+            return self._templates_for_node_speeds[key]
+
+        new_template = None
+        if self.create_template_for_node_speeds is not None:
+            try:
+                new_template = self.create_template_for_node_speeds(node_speeds)
+            except (RuntimeError, ValueError) as e:
+                logger.warning(
+                    f"Failed to create a pipeline template for node speeds "
+                    f"{node_speeds}: {e}. Using {template} instead."
+                )
+
+        if new_template is None:
+            # Keep the stages, but the slowest node bounds the pipeline.
+            speed = min(node_speeds)
+            new_template = copy.copy(template)
+            new_template.pseudo_latency = template.pseudo_latency / speed
+            new_template.kstar_latency = template.kstar_latency / speed
+
+        self._templates_for_node_speeds[key] = new_template
+        return new_template
+
+    @staticmethod
+    def get_layers_per_host(pipelines: list[PipelineTemplate]) -> list[set[int]]:
+        """Get indices of layers held by each host when the given pipelines
+        are instantiated in the order of hosts."""
+        layers_per_host: list[set[int]] = []
+        for pipeline in pipelines:
+            layer_index = 0
+            for modules in pipeline.modules_per_stage:
+                layers_per_host.append(
+                    set(range(layer_index, layer_index + len(modules)))
+                )
+                layer_index += len(modules)
+        return layers_per_host
+
+    def select_reconfiguration(
+        self,
+        candidates: list[list[PipelineTemplate]],
+        old_layers_per_host: list[set[int]],
+        layer_num_bytes: list[int] | None = None,
+        bandwidth: float | None = None,
+    ) -> tuple[list[PipelineTemplate], dict[PipelineTemplate, int]] | None:
+        """Select pipelines to be instantiated after losing hosts among candidates.
+
+        A candidate is scored by its estimated iteration time plus
+        the time of transferring layers that hosts newly need,
+        which is bounded by the host that receives the most bytes.
+        Among candidates with nearly the same score, the one that reuses
+        the most layers that hosts already hold, i.e. that transfers
+        the fewest bytes in total, is selected.
+        Candidates with fewer pipelines than `fault_tolerance_threshold`
+        are not considered.
+
+        Args:
+            candidates (list[list[PipelineTemplate]]): Candidate pipelines,
+                each of which is in the order of hosts.
+            old_layers_per_host (list[set[int]]): Indices of layers
+                that each remaining host holds now, in the order of hosts.
+            layer_num_bytes (list[int], optional): The number of bytes to be
+                transferred for each layer, including optimizer states.
+                If not given, every layer is considered to have the same size.
+            bandwidth (float, optional): Bandwidth between hosts in Gbps.
+                If not given, transfer time is not added to the score.
+
+        Returns:
+            A tuple of the selected pipelines with host speeds applied,
+            in the order of hosts, and the number of microbatches per pipeline.
+            None if no candidate has a feasible batch distribution.
+        """
+        candidates = [
+            self.apply_host_speeds(candidate)
+            for candidate in candidates
+            if len(candidate) >= self.fault_tolerance_threshold
         ]
+        self.precompute_batch_distributions(
+            [dict(Counter(pipelines)) for pipelines in candidates],
+            need_all_pipelines_have_batch=True,
+        )
+
+        selected: tuple[float, int, list[PipelineTemplate], dict] | None = None
+        for pipelines in candidates:
+            result = self.distribute_batch(
+                dict(Counter(pipelines)), need_all_pipelines_have_batch=True
+            )
+            if result is None:
+                continue
+            latency, num_microbatches = result
+
+            num_bytes_received = [
+                sum(
+                    layer_num_bytes[layer_index] if layer_num_bytes else 1
+                    for layer_index in new_layers - old_layers
+                )
+                for old_layers, new_layers in zip(
+                    old_layers_per_host, self.get_layers_per_host(pipelines)
+                )
+            ]
+
+            score = latency
+            if bandwidth and layer_num_bytes:
+                # bytes -> ms with Gbps
+                score += max(num_bytes_received, default=0) * 8 / (bandwidth * 1e6)
+
+            is_close = selected is not None and math.isclose(
+                score, selected[0], rel_tol=self.reconfiguration_score_tolerance
+            )
+            if (
+                selected is None
+                or (is_close and sum(num_bytes_received) < selected[1])
+                or (not is_close and score < selected[0])
+            ):
+                selected = (score, sum(num_bytes_received), pipelines, num_microbatches)
+
+        if selected is None:
+            return None
+
+        logger.debug(
+            f"Selected pipelines for reconfiguration: {selected[2]} "
+            f"(score {selected[0]} ms, {selected[1]} bytes to be transferred)"
+        )
+        return selected[2], selected[3]
 
     def distribute_batch(
         self,
@@ -137,14 +568,27 @@ class PipelineInstantiator:
         """Find the optimal distribution of microbatches that minimizes iteration time.
         Implementation of Section 4.2.2.
 
-        Use integer linear programming library (PuLP) that finds the optimal solution:
         - Let Z the slowest iteration time (max(Bi * Ti))
         - Minimize Z, while keeping sum(Bi) remain constant to global_num_microbatch
+        - Gradient all-reduce time across pipelines and optimizer step time
+          are added to Z, which do not depend on Bi
+          (see `_allreduce_latency()` and `_optimizer_step_latency()`).
+
+        Latency of a template is monotone in the number of microbatches,
+        thus the optimal Z is found exactly in-process by binary search
+        over candidate latencies (see `distribute_microbatches()`).
+        Results are memoized across instantiators by the latency model of
+        templates, the number of pipelines, the global number of microbatches
+        and `need_all_pipelines_have_batch`.
+
+        If a template has decreasing latency or `use_pulp` is set,
+        integer linear programming library (PuLP) is used instead.
 
         Args:
-            global_num_microbatch (int): The total number of microbatches.
             num_pipelines (dict[PipelineTemplate, int]): A set of pipeline templates,
                 where each value represents the number of pipelines to be instantiated.
+            need_all_pipelines_have_batch (bool): Whether every pipeline
+                must have at least one microbatch.
 
         Returns:
             A tuple of two objects:
@@ -162,6 +606,218 @@ class PipelineInstantiator:
             f"{self.fault_tolerance_threshold}."
         )
 
+        if self.use_pulp or any(
+            template.kstar_latency < 0 for template in num_pipelines
+        ):
+            result = self._distribute_batch_pulp(
+                num_pipelines, need_all_pipelines_have_batch
+            )
+            if result is None:
+                return None
+            latency, num_microbatches = result
+            return (
+                latency
+                + self._allreduce_latency(num_pipelines)
+                + self._optimizer_step_latency(num_pipelines),
+                num_microbatches,
+            )
+
+        key = self._get_batch_distribution_key(
+            num_pipelines, need_all_pipelines_have_batch
+        )
+        try:
+            result = PipelineInstantiator._batch_distributions[key]
+        except KeyError:
+            result = distribute_microbatches(*key)
+            self._store_batch_distribution(key, result)
+
+        if result is None:
+            logger.warning(f"Failed to find optimal solution for {num_pipelines}.")
+            return None
+
+        latency, num_microbatches_in_key = result
+        num_microbatches = dict(
+            zip(
+                self._sort_for_batch_distribution_key(num_pipelines),
+                num_microbatches_in_key,
+            )
+        )
+        num_microbatches = {
+            template: num_microbatches[template] for template in num_pipelines
+        }
+        logger.debug(
+            f"Optiomal batch distribution for {num_pipelines}: {num_microbatches}"
+        )
+        return (
+            latency
+            + self._allreduce_latency(num_pipelines)
+            + self._optimizer_step_latency(num_pipelines),
+            num_microbatches,
+        )
+
+    def _allreduce_latency(self, num_pipelines: dict[PipelineTemplate, int]) -> float:
+        """Estimate the time of all-reducing gradients across pipelines in ms.
+
+        Gradients of each layer are all-reduced with ring all-reduce
+        among devices that hold the layer, one from each pipeline,
+        which sends 2 * (N - 1) / N of the gradients for N pipelines.
+        Devices all-reduce their layers one by one, thus the device
+        that holds the most gradient bytes bounds the time.
+        """
+        if not self.layer_num_gradient_bytes or not self.allreduce_bandwidth:
+            return 0.0
+
+        num_replicas = sum(num_pipelines.values())
+        if num_replicas <= 1:
+            return 0.0
+
+        max_num_bytes = max(
+            sum(self.layer_num_gradient_bytes[layer_index] for layer_index in layers)
+            for layers in self.get_layers_per_host(
+                [template for template, num in num_pipelines.items() if num > 0]
+            )
+        )
+        # bytes -> ms with Gbps
+        return (
+            2
+            * (num_replicas - 1)
+            / num_replicas
+            * max_num_bytes
+            * 8
+            / (self.allreduce_bandwidth * 1e6)
+        )
+
+    def _optimizer_step_latency(
+        self, num_pipelines: dict[PipelineTemplate, int]
+    ) -> float:
+        """Estimate the time of optimizer step in ms.
+
+        Every device steps the optimizer for its layers after all-reduce,
+        thus the device whose layers take the longest bounds the time.
+        """
+        if not self.layer_optimizer_step_times:
+            return 0.0
+
+        return max(
+            sum(self.layer_optimizer_step_times[layer_index] for layer_index in layers)
+            for layers in self.get_layers_per_host(
+                [template for template, num in num_pipelines.items() if num > 0]
+            )
+        )
+
+    def _sort_for_batch_distribution_key(
+        self, num_pipelines: dict[PipelineTemplate, int]
+    ) -> list[PipelineTemplate]:
+        return sorted(
+            num_pipelines,
+            key=lambda template: (
+                self._zero_microbatch_latency(template),
+                template.kstar_latency,
+                num_pipelines[template],
+            ),
+        )
+
+    def _get_batch_distribution_key(
+        self,
+        num_pipelines: dict[PipelineTemplate, int],
+        need_all_pipelines_have_batch: bool,
+    ) -> tuple[tuple[PipelineLatency, ...], int, bool]:
+        """Get a canonical key of a batch distribution problem.
+
+        The solution only depends on the latency model and the number of
+        pipelines of each template, thus templates are identified by them,
+        in a canonical order. It is also the arguments of
+        `distribute_microbatches()`.
+        """
+        return (
+            tuple(
+                (
+                    self._zero_microbatch_latency(template),
+                    template.kstar_latency,
+                    num_pipelines[template],
+                )
+                for template in self._sort_for_batch_distribution_key(num_pipelines)
+            ),
+            self.global_num_microbatches,
+            need_all_pipelines_have_batch,
+        )
+
+    @staticmethod
+    def _store_batch_distribution(
+        key: tuple[tuple[PipelineLatency, ...], int, bool],
+        result: tuple[float, tuple[int, ...]] | None,
+    ):
+        # Reconfiguration plans are precomputed in another thread.
+        with PipelineInstantiator._batch_distributions_lock:
+            batch_distributions = PipelineInstantiator._batch_distributions
+            if (
+                len(batch_distributions)
+                >= PipelineInstantiator._max_batch_distributions
+            ):
+                # Evict the oldest result
+                del batch_distributions[next(iter(batch_distributions))]
+            batch_distributions[key] = result
+
+    def precompute_batch_distributions(
+        self,
+        options: list[dict[PipelineTemplate, int]],
+        need_all_pipelines_have_batch: bool = False,
+    ):
+        """Solve batch distribution problems of options in parallel
+        on the worker process pool, unless results are already memoized.
+        Options that share a problem are solved once. Does nothing
+        without worker processes."""
+        if self.num_workers <= 0 or self.use_pulp:
+            return
+
+        keys = list(
+            dict.fromkeys(
+                self._get_batch_distribution_key(option, need_all_pipelines_have_batch)
+                for option in options
+                if all(template.kstar_latency >= 0 for template in option)
+            )
+        )
+        keys = [
+            key for key in keys if key not in PipelineInstantiator._batch_distributions
+        ]
+        if len(keys) <= 1:
+            return
+
+        executor = PipelineInstantiator._get_executor(self.num_workers)
+        for key, result in zip(
+            keys, executor.map(distribute_microbatches, *zip(*keys))
+        ):
+            self._store_batch_distribution(key, result)
+
+    @staticmethod
+    def _get_executor(num_workers: int) -> ProcessPoolExecutor:
+        # The pool is shared by all instantiators and kept alive
+        # to avoid starting processes again for reconfiguration.
+        # It is used both by the reconfiguration planner thread and
+        # the training thread, which must not create a pool each.
+        with PipelineInstantiator._executor_lock:
+            executor = PipelineInstantiator._executor
+            if executor is None or executor._max_workers != num_workers:
+                if executor is not None:
+                    executor.shutdown()
+                executor = ProcessPoolExecutor(
+                    max_workers=num_workers, mp_context=get_context("spawn")
+                )
+                PipelineInstantiator._executor = executor
+            return executor
+
+    def _distribute_batch_pulp(
+        self,
+        num_pipelines: dict[PipelineTemplate, int],
+        need_all_pipelines_have_batch: bool = False,
+    ) -> tuple[float, dict[PipelineTemplate, int]] | None:
+        """`distribute_batch()` with integer linear programming (PuLP) that
+        finds the optimal solution."""
+        if pulp is None:
+            raise RuntimeError(
+                "PuLP is not installed. Install it with `pip install pulp`."
+            )
+
         model = pulp.LpProblem("Microbatch Distribution", pulp.LpMinimize)
 
         # define variables
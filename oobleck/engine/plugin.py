@@ -1,8 +1,10 @@
 import copy
 import io
 import itertools
+import threading
 from collections import Counter, defaultdict
-from typing import Optional
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
 
 import numpy as np
 import torch
@@ -34,9 +36,43 @@ from oobleck.engine.configuration_engine import ConfigurationEngine, HostInfo
 from oobleck.engine.pipeline_instantiator import PipelineInstantiator
 
 
+@dataclass
+class ReconfigurationPlan:
+    """Pipelines and microbatch distribution to be used
+    after losing some hosts of the current configuration."""
+
+    global_num_microbatches: int
+    host_speeds: list[float]
+    pipelines: list[PipelineTemplate]
+    num_microbatches: dict[PipelineTemplate, int]
+
+
 class OobleckPlugin(HeterogeneousParallelPlugin):
     """Plugin for Oobleck, an extension of heterogeneous parallel plugin
     to support fault tolerance and reconfiguration.
+
+    Args:
+        inter_node_bandwidth (float, optional): Bandwidth between nodes in Gbps.
+            If given, pipeline templates are planned considering activation
+            transfer between stages, and instantiation considers gradient
+            all-reduce across pipelines and layer transfer in reconfiguration.
+            Defaults to None.
+        inter_node_latency (float): Latency between nodes in ms.
+            Only used with `inter_node_bandwidth`. Defaults to 0.0.
+        planning_num_workers (int): The number of worker processes that
+            evaluate instantiation options in parallel. Defaults to 0,
+            which evaluates them in the worker itself.
+        precompute_double_failures (bool): Whether to precompute reconfiguration
+            plans for losing two hosts at once, in addition to losing a single host.
+            Defaults to False.
+        profile_num_iterations (int): The number of iterations whose layer
+            latency is measured in profiling. Defaults to 1.
+        timing_statistic (str): Statistic of measured layer latency that
+            pipeline templates are optimized for; one of "mean", "median",
+            and "p95". Defaults to "mean".
+        profile_deduplicate_layers (bool): Whether to measure only one of
+            structurally identical layers in profiling and copy its results
+            to the others. Defaults to True.
     """
 
     def __init__(
@@ -49,6 +85,13 @@ class OobleckPlugin(HeterogeneousParallelPlugin):
         enable_fused_normalization: bool = False,
         enable_flash_attention: bool = False,
         enable_jit_used: bool = False,
+        inter_node_bandwidth: Optional[float] = None,
+        inter_node_latency: float = 0.0,
+        planning_num_workers: int = 0,
+        precompute_double_failures: bool = False,
+        profile_num_iterations: int = 1,
+        timing_statistic: str = "mean",
+        profile_deduplicate_layers: bool = True,
     ):
         assert (
             global_batch_size % microbatch_size == 0
@@ -71,6 +114,63 @@ class OobleckPlugin(HeterogeneousParallelPlugin):
 
         self.global_batch_size = global_batch_size
         self.fault_tolerance_threshold = fault_tolerance_threshold
+        self.inter_node_bandwidth = inter_node_bandwidth
+        self.inter_node_latency = inter_node_latency
+        self.planning_num_workers = planning_num_workers
+        self.precompute_double_failures = precompute_double_failures
+        self.profile_num_iterations = profile_num_iterations
+        self.timing_statistic = timing_statistic
+        self.profile_deduplicate_layers = profile_deduplicate_layers
+
+        # Reconfiguration plans precomputed in background (removed hosts -> plan).
+        # Plans are discarded whenever a new precomputation starts.
+        self._reconfiguration_plans: dict[frozenset[HostInfo], ReconfigurationPlan] = {}
+        self._reconfiguration_plans_lock = threading.Lock()
+        self._reconfiguration_plans_generation = 0
+        self._reconfiguration_planner: Optional[threading.Thread] = None
+
+        # The number of parameters of each layer.
+        # Set by ExecutionEngine once the model is given.
+        self.layer_num_parameters: Optional[list[int]] = None
+        # Time of an optimizer step of each layer in ms.
+        # Set by ExecutionEngine once the model is profiled.
+        self.layer_optimizer_step_times: Optional[list[float]] = None
+
+        # A function that creates a pipeline template for nodes with the given speeds.
+        # Set by ExecutionEngine once the model is profiled.
+        self.create_template_for_node_speeds: Optional[
+            Callable[[list[float]], PipelineTemplate]
+        ] = None
+
+    @property
+    def layer_num_gradient_bytes(self) -> Optional[list[int]]:
+        """The number of bytes of gradients of each layer held by a device,
+        which are all-reduced across pipelines."""
+        if self.layer_num_parameters is None:
+            return None
+
+        num_bytes = 2 if self.precision in ["fp16", "bf16"] else 4
+        return [
+            num_parameters * num_bytes // self.tp_size
+            for num_parameters in self.layer_num_parameters
+        ]
+
+    @property
+    def layer_num_transfer_bytes(self) -> Optional[list[int]]:
+        """The number of bytes of each layer held by a device to be transferred
+        in reconfiguration. A layer is transferred with fp32 master parameters,
+        two fp32 optimizer states per parameter (e.g. Adam), and
+        half precision working parameters with mixed precision."""
+        if self.layer_num_parameters is None:
+            return None
+
+        num_bytes = 4 * 3
+        if self.precision in ["fp16", "bf16"]:
+            num_bytes += 2
+        return [
+            num_parameters * num_bytes // self.tp_size
+            for num_parameters in self.layer_num_parameters
+        ]
 
     def _instantiate_pipelines(
         self,
@@ -95,10 +195,8 @@ class OobleckPlugin(HeterogeneousParallelPlugin):
             list[PipelineTemplate]: List of pipelines to be instantiated
             dict[PipelineTemplate, int]: Number of microbatches for each pipeline
         """
-        pipeline_instantiator = PipelineInstantiator(
-            pipeline_templates, global_num_microbatches, self.fault_tolerance_threshold
-        )
         configuration_engine = ConfigurationEngine.get_instance()
+        host_speeds = [host.speed for host in configuration_engine.dist_info]
 
         # Is this for reconfiguration?
         if old_pg_mesh is not None and old_rank_map is not None:
@@ -107,44 +205,461 @@ class OobleckPlugin(HeterogeneousParallelPlugin):
                     "Existing pipelines are necessary for reconfiguration"
                 )
 
-            num_hosts_per_pipeline = [
-                pipeline.num_stages for pipeline in self.pipelines
-            ]
-            removed_ranks_list = [
-                old_rank_map[host]
+            removed_hosts = frozenset(
+                host
                 for host in old_rank_map
                 if host not in configuration_engine.rank_map
-            ]
-
-            for removed_ranks in removed_ranks_list:
-                for pipeline_index, ranks_in_mesh in enumerate(old_pg_mesh):
-                    if removed_ranks in ranks_in_mesh:
-                        num_hosts_per_pipeline[pipeline_index] -= 1
-
-            # TODO (insujang): If there is no feasible pipeline, merge pipelines
-            pipelines = [
-                pipeline_templates[num_stages]
-                for num_stages in num_hosts_per_pipeline
-                if num_stages > 0
-            ]
-
-            _, num_microbatches = pipeline_instantiator.distribute_batch(
-                dict(Counter(pipelines)), need_all_pipelines_have_batch=True
             )
-        else:
-            num_instances, num_microbatches = pipeline_instantiator.instantiate(
-                len(configuration_engine.dist_info)
+            with self._reconfiguration_plans_lock:
+                plan = self._reconfiguration_plans.get(removed_hosts)
+            if (
+                plan is not None
+                and plan.global_num_microbatches == global_num_microbatches
+                and plan.host_speeds == host_speeds
+            ):
+                logger.info("Using a precomputed reconfiguration plan.")
+                return plan.pipelines, plan.num_microbatches
+
+            return self._plan_reconfiguration(
+                pipeline_templates,
+                global_num_microbatches,
+                [pipeline.num_stages for pipeline in self.pipelines],
+                self._get_num_hosts_per_pipeline(
+                    self.pipelines,
+                    old_pg_mesh,
+                    [old_rank_map[host] for host in removed_hosts],
+                ),
+                self._get_layers_per_host(old_pg_mesh, old_rank_map, removed_hosts),
+                host_speeds,
             )
 
-            pipelines = list(
-                itertools.chain.from_iterable(
-                    itertools.repeat(template, num_templates)
-                    for template, num_templates in num_instances.items()
-                )
+        pipeline_instantiator = PipelineInstantiator(
+            pipeline_templates,
+            global_num_microbatches,
+            self.fault_tolerance_threshold,
+            host_speeds=host_speeds,
+            create_template_for_node_speeds=self.create_template_for_node_speeds,
+            num_workers=self.planning_num_workers,
+            layer_num_gradient_bytes=self.layer_num_gradient_bytes,
+            allreduce_bandwidth=self.inter_node_bandwidth,
+            layer_optimizer_step_times=self.layer_optimizer_step_times,
+        )
+        num_instances, num_microbatches = pipeline_instantiator.instantiate(
+            len(configuration_engine.dist_info)
+        )
+
+        pipelines = list(
+            itertools.chain.from_iterable(
+                itertools.repeat(template, num_templates)
+                for template, num_templates in num_instances.items()
             )
+        )
 
         return pipelines, num_microbatches
 
+    @staticmethod
+    def _get_num_hosts_per_pipeline(
+        pipelines: list[PipelineTemplate],
+        pg_mesh: np.ndarray,
+        removed_ranks_list: list[list[int]],
+    ) -> list[int]:
+        """Get the number of hosts remaining in each pipeline after removing ranks."""
+        num_hosts_per_pipeline = [pipeline.num_stages for pipeline in pipelines]
+        for removed_ranks in removed_ranks_list:
+            for pipeline_index, ranks_in_mesh in enumerate(pg_mesh):
+                if removed_ranks in ranks_in_mesh:
+                    num_hosts_per_pipeline[pipeline_index] -= 1
+        return num_hosts_per_pipeline
+
+    @staticmethod
+    def _get_layers_per_host(
+        pg_mesh: np.ndarray,
+        rank_map: dict[HostInfo, list[int]],
+        removed_hosts: frozenset[HostInfo],
+    ) -> list[set[int]]:
+        """Get indices of layers held by each remaining host in the rank order."""
+        layers_per_rank: dict[int, set[int]] = defaultdict(set)
+        for ranks_in_mesh in pg_mesh:
+            for layer_index, ranks in enumerate(ranks_in_mesh):
+                for rank in ranks:
+                    layers_per_rank[rank].add(layer_index)
+
+        return [
+            layers_per_rank[ranks[0]]
+            for host, ranks in rank_map.items()
+            if host not in removed_hosts
+        ]
+
+    @staticmethod
+    def _merge_pipelines(
+        pipeline_templates: dict[int, PipelineTemplate],
+        num_hosts_per_pipeline: list[int],
+        fault_tolerance_threshold: int = 1,
+    ) -> list[int]:
+        """Regroup hosts remaining in existing pipelines into new pipelines
+        so that every remaining host belongs to a pipeline with a template.
+
+        Hosts of a pipeline are contiguous in the rank order, and a new pipeline
+        also takes contiguous hosts. Pipelines that still have a template are
+        kept as they are, and hosts of pipelines that have no template
+        (too few hosts remained) are merged with neighboring hosts.
+        Among possible groupings that have at least `fault_tolerance_threshold`
+        pipelines, the one that moves the fewest hosts to a different pipeline
+        is chosen, and then the one with fewer pipelines.
+
+        Args:
+            pipeline_templates: Dict of pipeline templates (num_hosts -> pipeline template)
+            num_hosts_per_pipeline: Number of hosts remaining in each existing pipeline
+            fault_tolerance_threshold: Minimum number of new pipelines
+
+        Returns:
+            list[int]: Number of hosts of each new pipeline in the rank order
+
+        Raises:
+            RuntimeError: If no grouping has enough pipelines.
+        """
+        num_hosts = sum(num_hosts_per_pipeline)
+        existing_pipelines: set[tuple[int, int]] = set()
+        start = 0
+        for num_stages in num_hosts_per_pipeline:
+            if num_stages > 0:
+                existing_pipelines.add((start, start + num_stages))
+            start += num_stages
+
+        # best[end][count]: (number of moved hosts, number of pipelines, start,
+        # count before the last pipeline) of the best grouping of the first `end`
+        # hosts into `count` pipelines, where `count` is capped at the threshold.
+        min_num_pipelines = max(1, fault_tolerance_threshold)
+        best: list[list[tuple[int, int, int, int] | None]] = [
+            [None] * (min_num_pipelines + 1) for _ in range(num_hosts + 1)
+        ]
+        best[0][0] = (0, 0, 0, 0)
+        for end in range(1, num_hosts + 1):
+            for num_stages in pipeline_templates:
+                start = end - num_stages
+                if start < 0:
+                    continue
+
+                for count, previous in enumerate(best[start]):
+                    if previous is None:
+                        continue
+                    num_moved_hosts, num_pipelines, _, _ = previous
+                    if (start, end) not in existing_pipelines:
+                        num_moved_hosts += num_stages
+                    new_count = min(count + 1, min_num_pipelines)
+                    candidate = (num_moved_hosts, num_pipelines + 1, start, count)
+                    if best[end][new_count] is None or candidate < best[end][new_count]:
+                        best[end][new_count] = candidate
+
+        if best[num_hosts][min_num_pipelines] is None:
+            raise RuntimeError(
+                f"Cannot create {min_num_pipelines} or more pipelines "
+                f"with {num_hosts} hosts "
+                f"from templates for {sorted(pipeline_templates)} hosts."
+            )
+
+        new_num_hosts_per_pipeline = []
+        end, count = num_hosts, min_num_pipelines
+        while end > 0:
+            _, _, start, count = best[end][count]
+            new_num_hosts_per_pipeline.append(end - start)
+            end = start
+        new_num_hosts_per_pipeline.reverse()
+
+        if best[num_hosts][min_num_pipelines][0] > 0:
+            logger.debug(
+                f"Pipelines with {num_hosts_per_pipeline} hosts can be merged "
+                f"into pipelines with {new_num_hosts_per_pipeline} hosts."
+            )
+        return new_num_hosts_per_pipeline
+
+    @staticmethod
+    def _get_pipeline_groupings(
+        pipeline_templates: dict[int, PipelineTemplate],
+        old_num_hosts_per_pipeline: list[int],
+        num_hosts_per_pipeline: list[int],
+        fault_tolerance_threshold: int = 1,
+        max_num_groupings: int = 64,
+    ) -> list[list[int]]:
+        """Get candidate groupings of remaining hosts into new pipelines.
+
+        The first candidate is the one from `_merge_pipelines()`.
+        The others keep pipelines that lost no host as they are,
+        and regroup hosts of each contiguous run of pipelines that lost hosts
+        into pipelines of any template.
+        Groupings with fewer pipelines than `fault_tolerance_threshold`
+        are dropped.
+
+        Returns:
+            list[list[int]]: Number of hosts of each new pipeline in the rank order,
+                for each candidate.
+        """
+
+        def get_compositions(num_hosts: int) -> Iterator[list[int]]:
+            if num_hosts == 0:
+                yield []
+                return
+            for num_stages in sorted(pipeline_templates, reverse=True):
+                if num_stages <= num_hosts:
+                    for rest in get_compositions(num_hosts - num_stages):
+                        yield [num_stages] + rest
+
+        # (number of hosts, whether to keep) of pipelines that lost no host
+        # and of runs of pipelines that lost hosts, in the rank order.
+        segments: list[tuple[int, bool]] = []
+        for old_num_stages, num_stages in zip(
+            old_num_hosts_per_pipeline, num_hosts_per_pipeline
+        ):
+            if num_stages == old_num_stages and num_stages in pipeline_templates:
+                segments.append((num_stages, True))
+            elif segments and not segments[-1][1]:
+                segments[-1] = (segments[-1][0] + num_stages, False)
+            else:
+                segments.append((num_stages, False))
+
+        groupings = [
+            tuple(
+                OobleckPlugin._merge_pipelines(
+                    pipeline_templates,
+                    num_hosts_per_pipeline,
+                    fault_tolerance_threshold,
+                )
+            )
+        ]
+        choices = [
+            (
+                [[num_hosts]]
+                if kept
+                else list(
+                    itertools.islice(get_compositions(num_hosts), max_num_groupings)
+                )
+            )
+            for num_hosts, kept in segments
+        ]
+        for choice in itertools.islice(itertools.product(*choices), max_num_groupings):
+            groupings.append(tuple(itertools.chain.from_iterable(choice)))
+
+        return [
+            list(grouping)
+            for grouping in dict.fromkeys(groupings)
+            if len(grouping) >= fault_tolerance_threshold
+        ]
+
+    def _get_reconfiguration_candidates(
+        self,
+        pipeline_templates: dict[int, PipelineTemplate],
+        global_num_microbatches: int,
+        old_num_hosts_per_pipeline: list[int],
+        num_hosts_per_pipeline: list[int],
+        host_speeds: list[float],
+    ) -> tuple[PipelineInstantiator, list[list[PipelineTemplate]]]:
+        """Get an instantiator for remaining hosts and candidate pipelines
+        in the order of hosts to be selected among in reconfiguration."""
+        pipeline_instantiator = PipelineInstantiator(
+            pipeline_templates,
+            global_num_microbatches,
+            self.fault_tolerance_threshold,
+            host_speeds=host_speeds,
+            create_template_for_node_speeds=self.create_template_for_node_speeds,
+            num_workers=self.planning_num_workers,
+            layer_num_gradient_bytes=self.layer_num_gradient_bytes,
+            allreduce_bandwidth=self.inter_node_bandwidth,
+            layer_optimizer_step_times=self.layer_optimizer_step_times,
+        )
+
+        candidates = [
+            [pipeline_templates[num_stages] for num_stages in grouping]
+            for grouping in self._get_pipeline_groupings(
+                pipeline_templates,
+                old_num_hosts_per_pipeline,
+                num_hosts_per_pipeline,
+                self.fault_tolerance_threshold,
+            )
+        ]
+        return pipeline_instantiator, candidates
+
+    def _plan_reconfiguration(
+        self,
+        pipeline_templates: dict[int, PipelineTemplate],
+        global_num_microbatches: int,
+        old_num_hosts_per_pipeline: list[int],
+        num_hosts_per_pipeline: list[int],
+        old_layers_per_host: list[set[int]],
+        host_speeds: list[float],
+    ) -> tuple[list[PipelineTemplate], dict[PipelineTemplate, int]]:
+        """Regroup remaining hosts into pipelines and redistribute microbatches
+        to them, considering both iteration time and layers to be transferred."""
+        pipeline_instantiator, candidates = self._get_reconfiguration_candidates(
+            pipeline_templates,
+            global_num_microbatches,
+            old_num_hosts_per_pipeline,
+            num_hosts_per_pipeline,
+            host_speeds,
+        )
+        result = pipeline_instantiator.select_reconfiguration(
+            candidates,
+            old_layers_per_host,
+            self.layer_num_transfer_bytes,
+            self.inter_node_bandwidth,
+        )
+        if result is None:
+            raise RuntimeError(
+                f"No feasible batch distribution for pipelines "
+                f"with {num_hosts_per_pipeline} hosts."
+            )
+        return result
+
+    def precompute_reconfiguration_plans(
+        self, pipeline_templates: dict[int, PipelineTemplate]
+    ):
+        """Start precomputing reconfiguration plans for the current configuration
+        in a background thread.
+
+        A plan is computed for every loss of a single host
+        (and of two hosts if `precompute_double_failures` is set),
+        so that `reconfigure()` does not have to solve instantiation
+        and batch distribution after a failure.
+        Batch distribution problems of candidate pipelines are solved
+        on the worker process pool if `planning_num_workers` is set.
+        Plans of the previous configuration are discarded.
+        Must be called after the pipelines are configured.
+        """
+        configuration_engine = ConfigurationEngine.get_instance()
+        dist_info = list(configuration_engine.dist_info)
+        rank_map = dict(configuration_engine.rank_map)
+        pipelines = list(self.pipelines)
+        pg_mesh = copy.deepcopy(self.pg_mesh.mesh)
+        global_num_microbatches = self.global_batch_size // self.microbatch_size
+
+        max_num_removed_hosts = 2 if self.precompute_double_failures else 1
+        scenarios: list[
+            tuple[frozenset[HostInfo], list[int], list[set[int]], list[float]]
+        ] = []
+        for num_removed_hosts in range(1, max_num_removed_hosts + 1):
+            for removed_hosts in itertools.combinations(dist_info, num_removed_hosts):
+                removed_hosts = frozenset(removed_hosts)
+                scenarios.append(
+                    (
+                        removed_hosts,
+                        self._get_num_hosts_per_pipeline(
+                            pipelines,
+                            pg_mesh,
+                            [rank_map[host] for host in removed_hosts],
+                        ),
+                        self._get_layers_per_host(pg_mesh, rank_map, removed_hosts),
+                        [host.speed for host in dist_info if host not in removed_hosts],
+                    )
+                )
+
+        with self._reconfiguration_plans_lock:
+            self._reconfiguration_plans_generation += 1
+            generation = self._reconfiguration_plans_generation
+            self._reconfiguration_plans = {}
+
+        def precompute():
+            old_num_hosts_per_pipeline = [pipeline.num_stages for pipeline in pipelines]
+            # Scenarios are planned in chunks. Batch distribution problems of
+            # all candidates in a chunk are solved at once on the worker process
+            # pool, and selection in this thread only looks up memoized results.
+            # Candidates of different scenarios often have the same problem
+            # (e.g. losing a host of any of identical pipelines leaves the same
+            # numbers of pipelines of each template), which is solved once.
+            chunk_size = max(1, 4 * self.planning_num_workers)
+            for chunk_start in range(0, len(scenarios), chunk_size):
+                if self._reconfiguration_plans_generation != generation:
+                    # A newer configuration has started its own precomputation.
+                    return
+
+                chunk = []
+                options: list[dict[PipelineTemplate, int]] = []
+                for scenario in scenarios[chunk_start : chunk_start + chunk_size]:
+                    _, num_hosts_per_pipeline, _, host_speeds = scenario
+                    try:
+                        pipeline_instantiator, candidates = (
+                            self._get_reconfiguration_candidates(
+                                pipeline_templates,
+                                global_num_microbatches,
+                                old_num_hosts_per_pipeline,
+                                num_hosts_per_pipeline,
+                                host_speeds,
+                            )
+                        )
+                    except RuntimeError as e:
+                        # No grouping of the remaining hosts into pipelines.
+                        logger.debug(
+                            f"No reconfiguration plan "
+                            f"for {num_hosts_per_pipeline}: {e}"
+                        )
+                        continue
+                    except Exception as e:
+                        logger.opt(exception=e).warning(
+                            f"Failed to precompute reconfiguration plan "
+                            f"for {num_hosts_per_pipeline}: {e}"
+                        )
+                        continue
+                    chunk.append((scenario, pipeline_instantiator, candidates))
+                    options.extend(
+                        dict(
+                            Counter(pipeline_instantiator.apply_host_speeds(candidate))
+                        )
+                        for candidate in candidates
+                    )
+
+                if not chunk:
+                    continue
+                chunk[0][1].precompute_batch_distributions(
+                    options, need_all_pipelines_have_batch=True
+                )
+
+                for scenario, pipeline_instantiator, candidates in chunk:
+                    (
+                        removed_hosts,
+                        num_hosts_per_pipeline,
+                        old_layers_per_host,
+                        host_speeds,
+                    ) = scenario
+                    try:
+                        result = pipeline_instantiator.select_reconfiguration(
+                            candidates,
+                            old_layers_per_host,
+                            self.layer_num_transfer_bytes,
+                            self.inter_node_bandwidth,
+                        )
+                    except Exception as e:
+                        logger.opt(exception=e).warning(
+                            f"Failed to precompute reconfiguration plan "
+                            f"for {num_hosts_per_pipeline}: {e}"
+                        )
+                        continue
+                    if result is None:
+                        logger.debug(
+                            f"No feasible batch distribution "
+                            f"for {num_hosts_per_pipeline}."
+                        )
+                        continue
+
+                    new_pipelines, new_num_microbatches = result
+                    with self._reconfiguration_plans_lock:
+                        if self._reconfiguration_plans_generation != generation:
+                            return
+                        self._reconfiguration_plans[removed_hosts] = (
+                            ReconfigurationPlan(
+                                global_num_microbatches,
+                                host_speeds,
+                                new_pipelines,
+                                new_num_microbatches,
+                            )
+                        )
+
+            logger.debug(
+                f"Precomputed {len(self._reconfiguration_plans)} reconfiguration plans."
+            )
+
+        self._reconfiguration_planner = threading.Thread(
+            target=precompute, name="reconfiguration_planner", daemon=True
+        )
+        self._reconfiguration_planner.start()
+
     @torch.no_grad()
     def reconfigure(
         self,
@@ -224,7 +739,8 @@ class OobleckPlugin(HeterogeneousParallelPlugin):
         # Setting new pipelines will free unused layers, which some other may need.
 
         # Create new pipelines.
-        # TODO: If there is no feasible pipeline, merge pipelines
+        # Hosts of pipelines that have no template after failures are merged
+        # into new pipelines, which receive missing layers below.
         new_pipelines, new_num_microbatches = self._instantiate_pipelines(
             pipeline_templates,
             self.global_batch_size // self.microbatch_size,
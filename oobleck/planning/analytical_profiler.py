@@ -0,0 +1,419 @@
+import functools
+import importlib
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import click
+import torch
+import torch.nn as nn
+from cornstarch.pipeline_template import PipelineTemplate
+from loguru import logger
+from torch.utils.flop_counter import FlopCounterMode
+from transformers import AutoConfig, PretrainedConfig, PreTrainedModel
+
+from oobleck.engine.configuration_engine import ConfigurationEngine
+from oobleck.planning.profiler import JsonEncoder, LayerExecutionResult, ModelProfiler
+
+
+class AnalyticalProfiler(ModelProfiler):
+    """A profiler that estimates profile data without GPUs.
+
+    The model is instantiated on the meta device and a forward pass is
+    traced to count FLOPs, output activation bytes, and bytes of tensors
+    saved for backward of each layer.
+    Latency is estimated from device throughput:
+    - Forward latency is FLOPs divided by `device_tflops`, or bytes of
+      weights and output activations divided by `memory_bandwidth`
+      if that takes longer
+    - Backward latency is `backward_ratio` times forward latency. As in
+      `ModelProfiler`, it is backward with activation checkpointing, which
+      includes recomputation of forward. Without activation checkpointing,
+      it is one forward latency less
+    - Optimizer step latency is bytes of fp32 parameters, gradients,
+      and optimizer states, read and written once, divided by
+      `memory_bandwidth`, or zero if it is not given
+    - Required memory is output activations, gradients, and optimizer states,
+      which is what `ModelProfiler` measures. Without activation checkpointing,
+      tensors saved for backward are kept as well
+
+    Profiles are written in the same format as `ModelProfiler`, under
+    `base_dir / tag / "profile_analytical"` so that they are never mixed
+    with measured profiles, and `load_profile()` works the same way.
+    With tensor parallelism, FLOPs and parameters of each layer are assumed
+    to be split evenly across `tp_size` devices.
+
+    Args:
+        device_tflops (float): Achievable throughput of a device in TFLOPS
+            with the given precision.
+        memory_bandwidth (float, optional): Memory bandwidth of a device in GB/s.
+            If None, layers are assumed to be compute bound.
+        backward_ratio (float): Backward latency with activation checkpointing
+            relative to forward latency.
+        num_optimizer_states (int): The number of fp32 optimizer states
+            per parameter, e.g. 2 for Adam.
+    """
+
+    def __init__(
+        self,
+        tag: str,
+        model_name_or_path: str,
+        optimizer_class: str,
+        config: PretrainedConfig,
+        precision: str,
+        tp_size: int,
+        base_dir: Path,
+        device_tflops: float,
+        memory_bandwidth: float | None = None,
+        backward_ratio: float = 3.0,
+        num_optimizer_states: int = 2,
+    ):
+        assert device_tflops > 0, "Device throughput must be positive."
+        assert (
+            backward_ratio >= 1
+        ), "Backward must take at least as long as recomputing forward."
+
+        super().__init__(
+            tag,
+            model_name_or_path=model_name_or_path,
+            optimizer_class=optimizer_class,
+            config=config,
+            precision=precision,
+            tp_size=tp_size,
+            base_dir=base_dir,
+        )
+        self.profile_dir = base_dir / tag / "profile_analytical"
+        self.device_tflops = device_tflops
+        self.memory_bandwidth = memory_bandwidth
+        self.backward_ratio = backward_ratio
+        self.num_optimizer_states = num_optimizer_states
+
+    def init_profile(
+        self,
+        inputs: dict[str, torch.Tensor],
+        microbatch_sizes: list[int] | None = None,
+    ):
+        """Estimate profile data and store it.
+
+        Only the first worker of each agent writes profiles; others do nothing.
+
+        Args:
+            inputs (dict[str, torch.Tensor]): Inputs of the model. Only their
+                shapes and dtypes are used.
+            microbatch_sizes (list[int], optional): Microbatch sizes to estimate.
+                If None, only the batch size of `inputs` is estimated.
+        """
+        if ConfigurationEngine.get_instance().local_rank != 0:
+            return
+
+        if microbatch_sizes is None:
+            microbatch_sizes = [inputs["input_ids"].shape[0]]
+
+        for microbatch_size in microbatch_sizes:
+            profile_path = ModelProfiler.get_profile_path(
+                self.profile_dir, self.tp_size, microbatch_size, self.precision
+            )
+            if profile_path.exists():
+                logger.debug(f"Profile exists: {profile_path}")
+                continue
+
+            self.write_profile(
+                {
+                    name: ModelProfiler.resize_batch(value, microbatch_size)
+                    for name, value in inputs.items()
+                },
+                profile_path,
+            )
+
+    def write_profile(self, inputs: dict[str, torch.Tensor], profile_path: Path):
+        """Estimate profile data with `inputs` and write it to `profile_path`."""
+        microbatch_size = inputs["input_ids"].shape[0]
+        data = {
+            "model_name": self.model_name_or_path,
+            "microbatch_size": microbatch_size,
+            "tp_size": self.tp_size,
+            "precision": self.precision,
+            "backend": "analytical",
+            "layers": self.estimate(inputs),
+        }
+
+        logger.debug(f"Writing estimated profile to {profile_path}")
+        profile_path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=profile_path.parent, prefix=f".{profile_path.name}.", delete=False
+        ) as f:
+            json.dump(data, f, cls=JsonEncoder)
+        os.replace(f.name, profile_path)
+
+    def estimate(self, inputs: dict[str, torch.Tensor]) -> list[LayerExecutionResult]:
+        """Estimate profile data of each layer with `inputs`."""
+        dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(
+            self.precision, torch.float32
+        )
+
+        module_name, cls = self.model_name_or_path.rsplit(".", 1)
+        module = importlib.import_module(module_name)
+        with torch.device("meta"):
+            model: PreTrainedModel = getattr(module, cls)(self.model_config)
+        model = model.to(dtype=dtype)
+        layers = PipelineTemplate.get_modules(model)
+
+        flop_counter = FlopCounterMode(display=False)
+        # Layer name -> (FLOPs, output activation bytes, activation bytes
+        # without activation checkpointing) of forward pass
+        forward_results: dict[str, tuple[int, int, int]] = {}
+        start_flops: dict[str, int] = {}
+        # Tensors kept for backward by the layer being traced, by id.
+        # Inputs and parameters of the layer are not its activations.
+        kept_tensors: dict[int, torch.Tensor] = {}
+        excluded_ids: set[int] = set()
+        current_layer: str | None = None
+
+        def get_tensors(values) -> list[torch.Tensor]:
+            if isinstance(values, torch.Tensor):
+                return [values]
+            if isinstance(values, dict):
+                values = list(values.values())
+            if isinstance(values, (list, tuple)):
+                return [tensor for value in values for tensor in get_tensors(value)]
+            return []
+
+        def pack_hook(tensor: torch.Tensor) -> torch.Tensor:
+            if (
+                current_layer is not None
+                and not isinstance(tensor, nn.Parameter)
+                and id(tensor) not in excluded_ids
+            ):
+                kept_tensors[id(tensor)] = tensor
+            return tensor
+
+        def forward_pre_hook(layer_name: str, module: nn.Module, inputs):
+            nonlocal current_layer
+            current_layer = layer_name
+            kept_tensors.clear()
+            excluded_ids.clear()
+            excluded_ids.update(id(tensor) for tensor in get_tensors(inputs))
+            start_flops[layer_name] = flop_counter.get_total_flops()
+
+        def forward_hook(layer_name: str, module: nn.Module, inputs, outputs):
+            nonlocal current_layer
+            current_layer = None
+            for tensor in get_tensors(outputs):
+                if id(tensor) not in excluded_ids:
+                    kept_tensors[id(tensor)] = tensor
+            forward_results[layer_name] = (
+                flop_counter.get_total_flops() - start_flops[layer_name],
+                ModelProfiler.get_tensor_bytes(outputs),
+                sum(
+                    tensor.numel() * tensor.element_size()
+                    for tensor in kept_tensors.values()
+                ),
+            )
+            kept_tensors.clear()
+
+        handles = []
+        for layer_name in layers:
+            module = ModelProfiler.get_module_by_name(model, layer_name)
+            handles.append(
+                module.register_forward_pre_hook(
+                    functools.partial(forward_pre_hook, layer_name)
+                )
+            )
+            handles.append(
+                module.register_forward_hook(
+                    functools.partial(forward_hook, layer_name)
+                )
+            )
+
+        saved_tensors_hooks = torch.autograd.graph.saved_tensors_hooks(
+            pack_hook, lambda tensor: tensor
+        )
+        with saved_tensors_hooks, flop_counter:
+            model(**{name: value.to("meta") for name, value in inputs.items()})
+
+        for handle in handles:
+            handle.remove()
+
+        tied_weights_keys = model._tied_weights_keys or []
+        results = []
+        for index, layer_name in enumerate(layers):
+            flops, activation_bytes, no_checkpointing_activation_bytes = (
+                forward_results.get(layer_name, (0, 0, 0))
+            )
+            module = ModelProfiler.get_module_by_name(model, layer_name)
+
+            param_bytes = (
+                sum(p.numel() * p.element_size() for p in module.parameters())
+                // self.tp_size
+            )
+            num_optimizer_params = (
+                sum(
+                    p.numel()
+                    for param_name, p in module.named_parameters()
+                    if f"{layer_name}.{param_name}" not in tied_weights_keys
+                )
+                // self.tp_size
+            )
+
+            forward = flops / self.tp_size / (self.device_tflops * 1e12) * 1e3
+            if self.memory_bandwidth is not None:
+                forward = max(
+                    forward,
+                    (param_bytes + activation_bytes)
+                    / (self.memory_bandwidth * 1e9)
+                    * 1e3,
+                )
+
+            optimizer_step = 0.0
+            if self.memory_bandwidth is not None:
+                optimizer_step = (
+                    2
+                    * num_optimizer_params
+                    * (2 + self.num_optimizer_states)
+                    * 4
+                    / (self.memory_bandwidth * 1e9)
+                    * 1e3
+                )
+
+            optimizer_state_bytes = num_optimizer_params * self.num_optimizer_states * 4
+            results.append(
+                LayerExecutionResult(
+                    layer_index=index,
+                    layer_name=layer_name,
+                    forward=forward,
+                    backward=forward * self.backward_ratio,
+                    mem_required=activation_bytes + param_bytes + optimizer_state_bytes,
+                    activation_bytes=activation_bytes,
+                    optimizer_step=optimizer_step,
+                    backward_no_checkpointing=forward * (self.backward_ratio - 1),
+                    mem_required_no_checkpointing=no_checkpointing_activation_bytes
+                    + param_bytes
+                    + optimizer_state_bytes,
+                    num_parameters=sum(p.numel() for p in module.parameters()),
+                )
+            )
+        return results
+
+
+@click.command(
+    help="Estimate a profile of a HuggingFace model without GPUs. "
+    "The profile can be used by the what-if capacity planner."
+)
+@click.option(
+    "--model",
+    "model_name_or_path",
+    type=str,
+    required=True,
+    help="Full name of the model class, e.g. "
+    "transformers.models.gpt2.modeling_gpt2.GPT2LMHeadModel.",
+)
+@click.option(
+    "--config",
+    "config_name_or_path",
+    type=str,
+    required=True,
+    help="Name or path of the pretrained model configuration.",
+)
+@click.option(
+    "--microbatch_size",
+    "microbatch_sizes",
+    type=int,
+    multiple=True,
+    required=True,
+    help="Microbatch size. Can be given multiple times.",
+)
+@click.option("--sequence_length", type=int, required=True, help="Sequence length.")
+@click.option(
+    "--precision",
+    type=click.Choice(["fp32", "fp16", "bf16"]),
+    default="fp16",
+    help="Precision of the model.",
+)
+@click.option("--tp_size", type=int, default=1, help="Tensor parallel size.")
+@click.option(
+    "--optimizer_class",
+    type=str,
+    default="torch.optim.AdamW",
+    help="Full name of the optimizer class.",
+)
+@click.option(
+    "--num_optimizer_states",
+    type=int,
+    default=2,
+    help="The number of fp32 optimizer states per parameter.",
+)
+@click.option(
+    "--device_tflops",
+    type=float,
+    required=True,
+    help="Achievable throughput of a device in TFLOPS.",
+)
+@click.option(
+    "--memory_bandwidth",
+    type=float,
+    default=None,
+    help="Memory bandwidth of a device in GB/s. Not considered if not given.",
+)
+@click.option(
+    "--backward_ratio",
+    type=float,
+    default=3.0,
+    help="Backward latency with activation checkpointing relative to "
+    "forward latency.",
+)
+@click.option(
+    "--output_dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=Path("."),
+    help="Directory to write profiles to.",
+)
+def main(
+    model_name_or_path: str,
+    config_name_or_path: str,
+    microbatch_sizes: tuple[int, ...],
+    sequence_length: int,
+    precision: str,
+    tp_size: int,
+    optimizer_class: str,
+    num_optimizer_states: int,
+    device_tflops: float,
+    memory_bandwidth: float | None,
+    backward_ratio: float,
+    output_dir: Path,
+):
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    profiler = AnalyticalProfiler(
+        "analytical",
+        model_name_or_path=model_name_or_path,
+        optimizer_class=optimizer_class,
+        config=AutoConfig.from_pretrained(config_name_or_path),
+        precision=precision,
+        tp_size=tp_size,
+        base_dir=output_dir,
+        device_tflops=device_tflops,
+        memory_bandwidth=memory_bandwidth,
+        backward_ratio=backward_ratio,
+        num_optimizer_states=num_optimizer_states,
+    )
+
+    for microbatch_size in microbatch_sizes:
+        profile_path = ModelProfiler.get_profile_path(
+            output_dir, tp_size, microbatch_size, precision
+        )
+        profiler.write_profile(
+            {
+                "input_ids": torch.zeros(
+                    microbatch_size, sequence_length, dtype=torch.long
+                )
+            },
+            profile_path,
+        )
+        print(profile_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,4 +6,66 @@ def create_pipeline_templates(
     model_name: str,
     profile_data: list[LayerExecutionResult],
     num_nodes: list[int],
-) -> dict[int, PipelineTemplate]: ...
+    device_memory: int | None = None,
+    num_microbatches: int | None = None,
+    inter_node_bandwidth: float | None = None,
+    inter_node_latency: float = 0.0,
+) -> dict[int, PipelineTemplate]:
+    """Create pipeline templates for the given numbers of nodes.
+
+    If `device_memory` is given, stages that require more memory than
+    `device_memory` are never created, and numbers of nodes for which no
+    feasible template exists are omitted from the result.
+    Each template has `mem_required_per_stage` attribute.
+
+    Templates are optimized for `num_microbatches` microbatches per pipeline
+    (128 if not given).
+
+    If `inter_node_bandwidth` (Gbps) is given, each stage also pays for
+    sending its output activations to the next stage and gradients to
+    the previous stage, with `inter_node_latency` (ms) per transfer.
+
+    The GIL is released while planning, so that templates for different
+    inputs can be created in parallel from multiple threads.
+    """
+
+def create_pipeline_template_for_node_speeds(
+    model_name: str,
+    profile_data: list[LayerExecutionResult],
+    node_speeds: list[float],
+    device_memory: int | None = None,
+    num_microbatches: int | None = None,
+    inter_node_bandwidth: float | None = None,
+    inter_node_latency: float = 0.0,
+) -> PipelineTemplate:
+    """Create a pipeline template whose stages are placed on nodes
+    with the given speeds in order.
+
+    `node_speeds[k]` is the speed of the node that runs the `k`-th stage,
+    relative to the node that the model is profiled on.
+    Slower nodes get fewer layers, and latency of the template
+    reflects the node speeds. The template has `node_speeds` and
+    `mem_required_per_stage` attributes.
+    """
+
+class PipelineTemplateGenerator:
+    """A pipeline template generator that keeps its planning results.
+
+    Creating templates for more nodes than previously requested
+    only computes the results that are missing.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        profile_data: list[LayerExecutionResult],
+        device_memory: int | None = None,
+        num_microbatches: int | None = None,
+        inter_node_bandwidth: float | None = None,
+        inter_node_latency: float = 0.0,
+    ) -> None: ...
+    @property
+    def max_num_nodes(self) -> int: ...
+    def create_pipeline_templates(
+        self, num_nodes: list[int]
+    ) -> dict[int, PipelineTemplate]: ...
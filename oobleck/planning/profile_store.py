@@ -0,0 +1,139 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator
+
+from loguru import logger
+
+
+class ProfileStore:
+    """A persistent profile store shared by jobs.
+
+    `ModelProfiler` stores profiles under `base_dir / tag / "profile"`,
+    thus every job with a new tag would profile the same model again.
+    Profiles are also stored under `base_dir / "profile_store"` with a
+    file name that is a hash of everything that affects profiling results,
+    including the device model and library versions, so that any job
+    on the same hardware can reuse them.
+
+    Entries are written atomically, and writers and readers of an entry
+    are serialized with a file lock, so that concurrent jobs never read
+    or leave a partially written entry.
+
+    Args:
+        store_dir (Path): Directory of the profile store.
+    """
+
+    def __init__(self, store_dir: Path):
+        self.store_dir = store_dir
+
+    @staticmethod
+    def get_fingerprint(
+        model_name_or_path: str,
+        model_config: dict[str, Any],
+        optimizer_class: str,
+        precision: str,
+        tp_size: int,
+        microbatch_size: int,
+        device_name: str,
+        versions: dict[str, str],
+        num_iterations: int = 1,
+        input_shapes: dict[str, list[int]] | None = None,
+        profiler_options: dict[str, Any] | None = None,
+    ) -> str:
+        """Get a hash of all inputs that determine profiling results.
+
+        Args:
+            model_name_or_path (str): The name of the model.
+            model_config (dict[str, Any]): Model configuration.
+            optimizer_class (str): The name of the optimizer class.
+            precision (str): Precision of the model.
+            tp_size (int): Tensor parallel size.
+            microbatch_size (int): Microbatch size.
+            device_name (str): The device model, e.g. "NVIDIA A100-SXM4-80GB".
+            versions (dict[str, str]): Versions of libraries, e.g. torch.
+            num_iterations (int): The number of measured iterations.
+            input_shapes (dict[str, list[int]], optional): Shape of each input
+                of the model except the batch dimension, e.g. sequence length.
+            profiler_options (dict[str, Any], optional): Options of the profiler
+                that change what is measured or stored, e.g. layer deduplication.
+
+        Returns:
+            str: A hex digest that identifies the store entry.
+        """
+        key = {
+            "model_name": model_name_or_path,
+            "model_config": model_config,
+            "optimizer_class": optimizer_class,
+            "precision": precision,
+            "tp_size": tp_size,
+            "microbatch_size": microbatch_size,
+            "device_name": device_name,
+            "versions": versions,
+            "num_iterations": num_iterations,
+            "input_shapes": input_shapes,
+            "profiler_options": profiler_options,
+        }
+        data = json.dumps(key, sort_keys=True, default=str).encode()
+        return hashlib.sha256(data).hexdigest()
+
+    def get_profile_path(self, key: str) -> Path:
+        return self.store_dir / f"profile_{key}.json"
+
+    @contextmanager
+    def lock(self, key: str) -> Iterator[None]:
+        """Exclusively lock a store entry across processes."""
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        with (self.store_dir / f"profile_{key}.lock").open("a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def contains(self, key: str) -> bool:
+        return self.get_profile_path(key).exists()
+
+    def load(self, key: str, profile_path: Path) -> bool:
+        """Copy a stored profile to `profile_path` atomically.
+
+        Must be called with `lock(key)` held.
+
+        Returns:
+            bool: Whether the profile is found in the store.
+        """
+        stored_path = self.get_profile_path(key)
+        if not stored_path.exists():
+            return False
+
+        ProfileStore._atomic_copy(stored_path, profile_path)
+        logger.debug(f"Profile loaded from store: {stored_path}")
+        return True
+
+    def store(self, key: str, profile_path: Path):
+        """Store a profile atomically.
+
+        Must be called with `lock(key)` held.
+
+        Args:
+            key (str): Store key from `get_fingerprint()`.
+            profile_path (Path): Path to the profile to be stored.
+        """
+        stored_path = self.get_profile_path(key)
+        ProfileStore._atomic_copy(profile_path, stored_path)
+        logger.debug(f"Profile stored: {stored_path}")
+
+    @staticmethod
+    def _atomic_copy(src: Path, dst: Path):
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=dst.parent, prefix=f".{dst.name}.", delete=False
+        ) as f:
+            with src.open("rb") as src_file:
+                shutil.copyfileobj(src_file, f)
+        os.replace(f.name, dst)
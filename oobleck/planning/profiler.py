@@ -1,10 +1,15 @@
 import functools
 import importlib
+import importlib.metadata
+import itertools
 import json
+import os
+import tempfile
 from dataclasses import asdict, dataclass, field
 from enum import Enum
 from functools import reduce
 from pathlib import Path
+from typing import Callable
 
 import torch
 import torch.distributed as dist
@@ -20,6 +25,10 @@ from torch.distributed import FileStore
 from transformers import PretrainedConfig, PreTrainedModel
 
 from oobleck.engine.configuration_engine import ConfigurationEngine
+from oobleck.planning.profile_store import ProfileStore
+
+# Statistics of repeated latency measurements that the planner can optimize
+TIMING_STATISTICS = ["mean", "median", "p95"]
 
 
 @dataclass
@@ -29,6 +38,65 @@ class LayerExecutionResult:
     forward: float
     backward: float
     mem_required: int
+    activation_bytes: int = 0
+    # Time of an optimizer step of the layer in ms
+    optimizer_step: float = 0.0
+    # Backward latency and memory without activation checkpointing,
+    # None if not profiled
+    backward_no_checkpointing: float | None = None
+    mem_required_no_checkpointing: int | None = None
+    # The number of parameters of the layer without tensor parallelism,
+    # None if not profiled
+    num_parameters: int | None = None
+
+    @classmethod
+    def from_dict(
+        cls, layer: dict, timing_statistic: str = "mean"
+    ) -> "LayerExecutionResult":
+        """Create a result from a layer in a profile JSON file.
+
+        Args:
+            layer (dict): A layer in a profile JSON file.
+            timing_statistic (str): Statistic of repeated measurements used as
+                latency of forward, backward, and optimizer step;
+                one of `TIMING_STATISTICS`.
+                Profiles without statistics have only one latency that is used
+                for all statistics.
+        """
+        if timing_statistic not in TIMING_STATISTICS:
+            raise ValueError(
+                f"Unknown timing statistic {timing_statistic}. "
+                f"Must be one of {TIMING_STATISTICS}."
+            )
+
+        return cls(
+            layer_index=layer["layer_index"],
+            layer_name=layer["layer_name"],
+            forward=layer.get("forward_stats", {}).get(
+                timing_statistic, layer["forward"]
+            ),
+            backward=layer.get("backward_stats", {}).get(
+                timing_statistic, layer["backward"]
+            ),
+            mem_required=layer["mem_required"],
+            activation_bytes=layer.get("activation_bytes", 0),
+            optimizer_step=layer.get("optimizer_step_stats", {}).get(
+                timing_statistic, layer.get("optimizer_step", 0.0)
+            ),
+            backward_no_checkpointing=layer.get(
+                "backward_no_checkpointing_stats", {}
+            ).get(timing_statistic, layer.get("backward_no_checkpointing")),
+            mem_required_no_checkpointing=layer.get("mem_required_no_checkpointing"),
+            num_parameters=layer.get("num_parameters"),
+        )
+
+
+class _ForwardStopped(Exception):
+    """Raised to stop forward pass after the last layer to be profiled."""
+
+    def __init__(self, outputs):
+        super().__init__()
+        self.outputs = outputs
 
 
 class JsonEncoder(json.JSONEncoder):
@@ -43,7 +111,26 @@ class ModelProfiler:
 
     Profiling includes:
     - Forward and backward latency (in ms) for each layer
+    - Optimizer step latency (in ms) for each layer
+    - Backward latency and memory consumption for each layer
+      without activation checkpointing, unless it runs out of GPU memory
     - Maximum memory consumption (in bytes) for each layer
+    - Output activation size (in bytes) for each layer
+    - The number of parameters for each layer
+
+    Latency is the mean, median, p95, and standard deviation over
+    `num_iterations` measured iterations.
+
+    Profiling is split across agents by layer range. Each agent profiles
+    a contiguous range of layers, and partial profiles are merged into one
+    in `load_profile()`.
+
+    If `deduplicate_layers` is True, only one of structurally identical layers,
+    e.g. transformer blocks, is measured and its results are copied to the others.
+    The others are not executed nor moved to GPU; they pass their inputs through.
+
+    Profiles are also kept in a `ProfileStore` under `base_dir / "profile_store"`,
+    which is shared by jobs with different tags.
 
     Args:
         model (nn.Module): The model to be profiled.
@@ -51,6 +138,18 @@ class ModelProfiler:
         model must have modules with the given names.
     """
 
+    # Metrics of `LayerExecutionResult` fitted against microbatch size.
+    # Metrics that are None in any profile are not fitted.
+    FITTED_METRICS = [
+        "forward",
+        "backward",
+        "mem_required",
+        "activation_bytes",
+        "optimizer_step",
+        "backward_no_checkpointing",
+        "mem_required_no_checkpointing",
+    ]
+
     def __init__(
         self,
         tag: str,
@@ -60,13 +159,27 @@ class ModelProfiler:
         precision: str,
         tp_size: int,
         base_dir: Path,
+        num_iterations: int = 1,
+        timing_statistic: str = "mean",
+        deduplicate_layers: bool = True,
     ):
+        assert num_iterations >= 1, "At least one iteration must be measured."
+        assert (
+            timing_statistic in TIMING_STATISTICS
+        ), f"Timing statistic must be one of {TIMING_STATISTICS}."
+
         self.model_name_or_path = model_name_or_path
         self.optimizer_class = optimizer_class
         self.precision = precision
         self.model_config = config
         self.tp_size = tp_size
+        self.num_iterations = num_iterations
+        self.timing_statistic = timing_statistic
+        self.deduplicate_layers = deduplicate_layers
+        # Shape of each input except the batch dimension, set in `init_profile()`.
+        self.input_shapes: dict[str, list[int]] | None = None
         self.profile_dir = base_dir / tag / "profile"
+        self.profile_store = ProfileStore(base_dir / "profile_store")
 
     @staticmethod
     def get_profile_path(
@@ -75,24 +188,129 @@ class ModelProfiler:
         profile_dir.mkdir(parents=True, exist_ok=True)
         return profile_dir / f"profile_tp{tp_size}_mb{microbatch_size}_{precision}.json"
 
-    def init_profile(self, inputs: dict[str, torch.Tensor]):
+    @staticmethod
+    def get_fit_profile_path(profile_dir: Path, tp_size: int, precision: str) -> Path:
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        return profile_dir / f"profile_tp{tp_size}_fit_{precision}.json"
+
+    @staticmethod
+    def get_partial_profile_path(
+        profile_dir: Path,
+        tp_size: int,
+        microbatch_size: int,
+        precision: str,
+        agent_index: int,
+        num_agents: int,
+    ) -> Path:
+        profile_path = ModelProfiler.get_profile_path(
+            profile_dir, tp_size, microbatch_size, precision
+        )
+        return profile_path.with_suffix(f".part{agent_index}of{num_agents}.json")
+
+    @staticmethod
+    def get_layer_range(num_layers: int, agent_index: int, num_agents: int) -> range:
+        """Get the range of layers that an agent profiles.
+        Layers are split into `num_agents` contiguous ranges of similar sizes."""
+        return range(
+            agent_index * num_layers // num_agents,
+            (agent_index + 1) * num_layers // num_agents,
+        )
+
+    def get_store_key(self, microbatch_size: int) -> str:
+        """Get the key of the profile in the profile store.
+        Must be called after `init_profile()`, which sets input shapes."""
+        assert (
+            self.input_shapes is not None
+        ), "init_profile() must be called before using the profile store."
+        return ProfileStore.get_fingerprint(
+            model_name_or_path=self.model_name_or_path,
+            model_config=self.model_config.to_dict(),
+            optimizer_class=self.optimizer_class,
+            precision=self.precision,
+            tp_size=self.tp_size,
+            microbatch_size=microbatch_size,
+            num_iterations=self.num_iterations,
+            input_shapes=self.input_shapes,
+            # Measured metrics are included, so that profiles
+            # without newly measured metrics are not reused.
+            profiler_options={
+                "deduplicate_layers": self.deduplicate_layers,
+                "metrics": ModelProfiler.FITTED_METRICS,
+            },
+            device_name=torch.cuda.get_device_name(),
+            versions={
+                name: importlib.metadata.version(name)
+                for name in ["torch", "colossalai"]
+            },
+        )
+
+    def init_profile(
+        self,
+        inputs: dict[str, torch.Tensor],
+        microbatch_sizes: list[int] | None = None,
+    ):
         """Profile the model with a new child process.
 
-        All processes calls this function, and all workers in the first agent
-        actually profile the model.
+        All processes calls this function, and workers in each agent profile
+        their range of layers, unless the profile is in the profile store.
+
+        Args:
+            inputs (dict[str, torch.Tensor]): Inputs of the model.
+            microbatch_sizes (list[int], optional): Microbatch sizes to profile
+                in one child process. Inputs are repeated or truncated along
+                the batch dimension for each size. If None, only the batch size
+                of `inputs` is profiled.
         """
         assert not dist.is_initialized(), "torch.distributed should not be initialized."
         configuration_engine = ConfigurationEngine.get_instance()
+        agent_index = configuration_engine.agent_index
+        num_agents = len(configuration_engine.dist_info)
 
-        if configuration_engine.agent_index != 0:
-            return
+        if microbatch_sizes is None:
+            microbatch_sizes = [inputs["input_ids"].shape[0]]
+        self.input_shapes = {
+            name: list(value.shape[1:]) for name, value in inputs.items()
+        }
 
-        microbatch_size = inputs["input_ids"].shape[0]
-        profile_path = ModelProfiler.get_profile_path(
-            self.profile_dir, self.tp_size, microbatch_size, self.precision
-        )
-        if profile_path.exists():
-            logger.debug(f"Profile exists: {profile_path}")
+        # Microbatch size -> (store key, claim path) of sizes to be profiled
+        claims: dict[int, tuple[str, Path]] = {}
+        for microbatch_size in microbatch_sizes:
+            profile_path = ModelProfiler.get_profile_path(
+                self.profile_dir, self.tp_size, microbatch_size, self.precision
+            )
+            if profile_path.exists():
+                logger.debug(f"Profile exists: {profile_path}")
+                continue
+
+            partial_profile_path = ModelProfiler.get_partial_profile_path(
+                self.profile_dir,
+                self.tp_size,
+                microbatch_size,
+                self.precision,
+                agent_index,
+                num_agents,
+            )
+            if partial_profile_path.exists():
+                logger.debug(f"Partial profile exists: {partial_profile_path}")
+                continue
+
+            # All workers of the agent must agree on whether to profile, even if
+            # another job stores the profile meanwhile. The first worker claims
+            # profiling unless the profile is in the store, and the others follow
+            # the claim.
+            store_key = self.get_store_key(microbatch_size)
+            claim_path = partial_profile_path.with_name(
+                f".{partial_profile_path.name}.profiling"
+            )
+            with self.profile_store.lock(store_key):
+                if not claim_path.exists() and self.profile_store.load(
+                    store_key, profile_path
+                ):
+                    continue
+                claim_path.touch()
+            claims[microbatch_size] = (store_key, claim_path)
+
+        if not claims:
             return
 
         context = torch.multiprocessing.get_context("spawn")
@@ -107,58 +325,430 @@ class ModelProfiler:
                 "tp_size": self.tp_size,
                 "precision": self.precision,
                 "inputs": inputs,
+                "agent_index": agent_index,
+                "num_agents": num_agents,
+                "microbatch_sizes": list(claims.keys()),
+                "num_iterations": self.num_iterations,
+                "deduplicate_layers": self.deduplicate_layers,
             },
             daemon=True,
         )
         process.start()
         process.join()
 
+        if configuration_engine.local_rank == 0:
+            for microbatch_size, (store_key, claim_path) in claims.items():
+                profile_path = ModelProfiler.get_profile_path(
+                    self.profile_dir, self.tp_size, microbatch_size, self.precision
+                )
+                if profile_path.exists():
+                    with self.profile_store.lock(store_key):
+                        self.profile_store.store(store_key, profile_path)
+                claim_path.unlink(missing_ok=True)
+
     def load_profile(self, microbatch_size: int) -> list[LayerExecutionResult]:
         """Load profile data from storage.
 
         Only rank 0 loads profile data, which is broadcasted to all others.
+        If rank 0 does not have the whole profile, the first worker of each agent
+        broadcasts its partial profile, and rank 0 stores the merged profile.
+        If the microbatch size has never been profiled, profile data is
+        synthesized from the model fitted to profiled microbatch sizes.
         """
         assert dist.is_initialized(), "torch.distributed is not initialized."
 
         configuration_engine = ConfigurationEngine.get_instance()
+        profile_path = ModelProfiler.get_profile_path(
+            self.profile_dir, self.tp_size, microbatch_size, self.precision
+        )
+
+        data = None
+        if configuration_engine.rank == 0:
+            data = self._read_profile(microbatch_size)
+        data = ModelProfiler._broadcast_bytes(data, src=0)
+
+        if not data:
+            data = self._merge_partial_profiles(microbatch_size)
+            if configuration_engine.rank == 0:
+                with tempfile.NamedTemporaryFile(
+                    dir=self.profile_dir, prefix=f".{profile_path.name}.", delete=False
+                ) as f:
+                    f.write(data)
+                os.replace(f.name, profile_path)
+
+                store_key = self.get_store_key(microbatch_size)
+                with self.profile_store.lock(store_key):
+                    self.profile_store.store(store_key, profile_path)
+
+        if configuration_engine.rank == 0 and profile_path.exists():
+            self._update_fit_profile()
+
+        data = json.loads(data)
+        return [
+            LayerExecutionResult.from_dict(layer, self.timing_statistic)
+            for layer in data["layers"]
+        ]
+
+    def _read_profile(self, microbatch_size: int) -> bytes | None:
+        """Read the profile, or synthesize it from the fitted model
+        if the microbatch size has not been profiled.
+
+        Returns:
+            Profile data, or None if partial profiles should be merged.
+        """
+        profile_path = ModelProfiler.get_profile_path(
+            self.profile_dir, self.tp_size, microbatch_size, self.precision
+        )
+        if profile_path.exists():
+            return profile_path.read_bytes()
+
+        num_agents = len(ConfigurationEngine.get_instance().dist_info)
+        partial_profile_path = ModelProfiler.get_partial_profile_path(
+            self.profile_dir,
+            self.tp_size,
+            microbatch_size,
+            self.precision,
+            0,
+            num_agents,
+        )
+        fit_profile_path = ModelProfiler.get_fit_profile_path(
+            self.profile_dir, self.tp_size, self.precision
+        )
+        if partial_profile_path.exists() or not fit_profile_path.exists():
+            return None
+
+        fit = json.loads(fit_profile_path.read_text())
+        logger.debug(
+            f"Synthesizing profile for microbatch size {microbatch_size} "
+            f"from profiled microbatch sizes {fit['microbatch_sizes']}"
+        )
+        data = {
+            "model_name": fit["model_name"],
+            "microbatch_size": microbatch_size,
+            "tp_size": self.tp_size,
+            "precision": self.precision,
+            "layers": ModelProfiler.synthesize_profile(fit["layers"], microbatch_size),
+        }
+        return json.dumps(data, cls=JsonEncoder).encode()
+
+    def _update_fit_profile(self):
+        """Fit the model of profile data to all profiled microbatch sizes
+        and store it."""
+        profiles: dict[int, list[LayerExecutionResult]] = {}
+        model_name = None
+        for profile_path in self.profile_dir.glob(
+            f"profile_tp{self.tp_size}_mb*_{self.precision}.json"
+        ):
+            data = json.loads(profile_path.read_text())
+            model_name = data["model_name"]
+            profiles[data["microbatch_size"]] = [
+                LayerExecutionResult.from_dict(layer, self.timing_statistic)
+                for layer in data["layers"]
+            ]
+
+        fit_profile_path = ModelProfiler.get_fit_profile_path(
+            self.profile_dir, self.tp_size, self.precision
+        )
+        data = {
+            "model_name": model_name,
+            "tp_size": self.tp_size,
+            "precision": self.precision,
+            "microbatch_sizes": sorted(profiles.keys()),
+            "layers": ModelProfiler.fit_profiles(profiles),
+        }
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.profile_dir, prefix=f".{fit_profile_path.name}.", delete=False
+        ) as f:
+            json.dump(data, f)
+        os.replace(f.name, fit_profile_path)
+
+    @staticmethod
+    def fit_profiles(profiles: dict[int, list[LayerExecutionResult]]) -> list[dict]:
+        """Fit `value = intercept + slope * microbatch_size` of each metric
+        of each layer to profile data of different microbatch sizes
+        with least squares.
+
+        Args:
+            profiles (dict[int, list[LayerExecutionResult]]): Profile data
+                of each microbatch size.
+
+        Returns:
+            list[dict]: For each layer, `layer_index`, `layer_name`, and
+            `num_parameters`, and `[intercept, slope]` of each metric in
+            `FITTED_METRICS` that is profiled in all microbatch sizes.
+            With only one microbatch size, metrics are assumed to be
+            proportional to the microbatch size.
+        """
+        microbatch_sizes = sorted(profiles.keys())
+        mean_size = sum(microbatch_sizes) / len(microbatch_sizes)
+        variance = sum((size - mean_size) ** 2 for size in microbatch_sizes)
+
+        fits = []
+        for layers in zip(*(profiles[size] for size in microbatch_sizes)):
+            assert (
+                len({layer.layer_name for layer in layers}) == 1
+            ), "Profiles of different microbatch sizes have different layers."
+
+            fit = {
+                "layer_index": layers[0].layer_index,
+                "layer_name": layers[0].layer_name,
+                "num_parameters": layers[0].num_parameters,
+            }
+            for metric in ModelProfiler.FITTED_METRICS:
+                values = [getattr(layer, metric) for layer in layers]
+                if None in values:
+                    continue
+                if variance == 0:
+                    fit[metric] = [0.0, values[0] / microbatch_sizes[0]]
+                    continue
+
+                mean_value = sum(values) / len(values)
+                slope = (
+                    sum(
+                        (size - mean_size) * (value - mean_value)
+                        for size, value in zip(microbatch_sizes, values)
+                    )
+                    / variance
+                )
+                fit[metric] = [mean_value - slope * mean_size, slope]
+            fits.append(fit)
+        return fits
+
+    @staticmethod
+    def synthesize_profile(
+        fits: list[dict], microbatch_size: int
+    ) -> list[LayerExecutionResult]:
+        """Synthesize profile data of a microbatch size from `fit_profiles()`.
+        Metrics that are not fitted are left as defaults of `LayerExecutionResult`,
+        e.g. None for metrics without activation checkpointing."""
+
+        def estimate(fit: dict, metric: str) -> float:
+            intercept, slope = fit[metric]
+            return max(0.0, intercept + slope * microbatch_size)
+
+        results = []
+        for fit in fits:
+            result = LayerExecutionResult(
+                layer_index=fit["layer_index"],
+                layer_name=fit["layer_name"],
+                forward=estimate(fit, "forward"),
+                backward=estimate(fit, "backward"),
+                mem_required=round(estimate(fit, "mem_required")),
+                activation_bytes=round(estimate(fit, "activation_bytes")),
+                num_parameters=fit.get("num_parameters"),
+            )
+            if "optimizer_step" in fit:
+                result.optimizer_step = estimate(fit, "optimizer_step")
+            if "backward_no_checkpointing" in fit:
+                result.backward_no_checkpointing = estimate(
+                    fit, "backward_no_checkpointing"
+                )
+            if "mem_required_no_checkpointing" in fit:
+                result.mem_required_no_checkpointing = round(
+                    estimate(fit, "mem_required_no_checkpointing")
+                )
+            results.append(result)
+        return results
+
+    def _merge_partial_profiles(self, microbatch_size: int) -> bytes:
+        """Gather partial profiles of all agents and merge them into one."""
+        configuration_engine = ConfigurationEngine.get_instance()
+        num_agents = len(configuration_engine.dist_info)
+
+        merged: dict | None = None
+        for agent_index, host in enumerate(configuration_engine.dist_info):
+            src = configuration_engine.rank_map[host][0]
+            data = None
+            if configuration_engine.rank == src:
+                data = json.dumps(
+                    self._load_partial_profile(microbatch_size, agent_index, num_agents)
+                ).encode()
+            partial = json.loads(ModelProfiler._broadcast_bytes(data, src=src))
+
+            if merged is None:
+                merged = dict(partial, layers=[])
+            merged["layers"].extend(partial["layers"])
+
+        num_layers = merged.pop("num_layers")
+        layers = sorted(merged["layers"], key=lambda layer: layer["layer_index"])
+        assert [layer["layer_index"] for layer in layers] == list(
+            range(num_layers)
+        ), "Partial profiles do not cover all layers."
+
+        # Copy results of identical layers measured by other agents.
+        for index, layer in enumerate(layers):
+            if "representative" in layer:
+                layers[index] = dict(
+                    layers[layer["representative"]],
+                    layer_index=index,
+                    layer_name=layer["layer_name"],
+                )
+        merged["layers"] = layers
+
+        return json.dumps(merged).encode()
+
+    def _load_partial_profile(
+        self, microbatch_size: int, agent_index: int, num_agents: int
+    ) -> dict:
+        """Load the partial profile of an agent. If the agent has the whole
+        profile instead, e.g. from the profile store, its range is taken from it."""
+        partial_profile_path = ModelProfiler.get_partial_profile_path(
+            self.profile_dir,
+            self.tp_size,
+            microbatch_size,
+            self.precision,
+            agent_index,
+            num_agents,
+        )
+        if partial_profile_path.exists():
+            return json.loads(partial_profile_path.read_text())
+
+        profile_path = ModelProfiler.get_profile_path(
+            self.profile_dir, self.tp_size, microbatch_size, self.precision
+        )
+        data = json.loads(profile_path.read_text())
+        layer_range = ModelProfiler.get_layer_range(
+            len(data["layers"]), agent_index, num_agents
+        )
+        data["num_layers"] = len(data["layers"])
+        data["layers"] = data["layers"][layer_range.start : layer_range.stop]
+        return data
+
+    @staticmethod
+    def _broadcast_bytes(data: bytes | None, src: int) -> bytes:
+        """Broadcast bytes from the rank `src` to all ranks."""
         device = get_accelerator().get_current_device()
         size_tensor = torch.empty(1, dtype=torch.int64, device=device)
-        if configuration_engine.rank == 0:
-            profile_path = ModelProfiler.get_profile_path(
-                self.profile_dir, self.tp_size, microbatch_size, self.precision
+        if dist.get_rank() == src:
+            data_tensor = torch.tensor(
+                list(data or b""), dtype=torch.uint8, device=device
             )
-            data = profile_path.read_bytes()
-            data_tensor = torch.tensor(list(data), dtype=torch.uint8, device=device)
             size_tensor[0] = data_tensor.numel()
 
-        dist.broadcast(size_tensor, src=0)
+        dist.broadcast(size_tensor, src=src)
 
-        if configuration_engine.rank != 0:
+        if dist.get_rank() != src:
             data_tensor = torch.empty(
                 size_tensor.item(), dtype=torch.uint8, device=device
             )
 
-        dist.broadcast(data_tensor, src=0)
+        if size_tensor.item() > 0:
+            dist.broadcast(data_tensor, src=src)
         torch.cuda.synchronize()
 
-        data = json.loads(data_tensor.cpu().numpy().tobytes())
+        return data_tensor.cpu().numpy().tobytes()
+
+    @staticmethod
+    def get_layer_signature(module: nn.Module) -> str:
+        """Get a signature of a layer that is the same for structurally identical
+        layers: the class, configuration of all submodules, and names, shapes,
+        and dtypes of parameters and buffers."""
+        tensors = itertools.chain(module.named_parameters(), module.named_buffers())
+        return json.dumps(
+            [
+                f"{type(module).__module__}.{type(module).__qualname__}",
+                repr(module),
+                [
+                    (name, list(tensor.shape), str(tensor.dtype))
+                    for name, tensor in tensors
+                ],
+            ]
+        )
+
+    @staticmethod
+    def get_representatives(model: nn.Module, layers: list[str]) -> list[int]:
+        """Get the index of the representative of each layer, which is the first
+        layer that is structurally identical to it."""
+        first_indices: dict[str, int] = {}
         return [
-            LayerExecutionResult(
-                layer_index=layer["layer_index"],
-                layer_name=layer["layer_name"],
-                forward=layer["forward"],
-                backward=layer["backward"],
-                mem_required=layer["mem_required"],
+            first_indices.setdefault(
+                ModelProfiler.get_layer_signature(
+                    ModelProfiler.get_module_by_name(model, layer_name)
+                ),
+                index,
             )
-            for layer in data["layers"]
+            for index, layer_name in enumerate(layers)
         ]
 
+    @staticmethod
+    def get_timing_statistics(samples: list[float]) -> dict[str, float]:
+        """Get mean, median, p95, and standard deviation of latency samples.
+        Percentiles are linearly interpolated between samples."""
+
+        def percentile(q: float) -> float:
+            position = (len(ordered) - 1) * q
+            lower = int(position)
+            upper = min(lower + 1, len(ordered) - 1)
+            return ordered[lower] + (ordered[upper] - ordered[lower]) * (
+                position - lower
+            )
+
+        ordered = sorted(samples)
+        mean = sum(ordered) / len(ordered)
+        return {
+            "mean": mean,
+            "median": percentile(0.5),
+            "p95": percentile(0.95),
+            "std": (sum((x - mean) ** 2 for x in ordered) / len(ordered)) ** 0.5,
+        }
+
+    @staticmethod
+    def resize_batch(tensor: torch.Tensor, batch_size: int) -> torch.Tensor:
+        """Repeat or truncate a tensor along the batch dimension."""
+        num_repeats = -(-batch_size // tensor.shape[0])
+        return tensor.repeat(num_repeats, *([1] * (tensor.dim() - 1)))[:batch_size]
+
     @staticmethod
     def get_module_by_name(model: nn.Module, name: str) -> nn.Module:
         """Get a module by its name."""
         names = name.split(".")
         return reduce(getattr, names, model)
 
+    @staticmethod
+    def get_passthrough_outputs(inputs, outputs) -> Callable | None:
+        """Get a function that creates outputs of a layer identical to one
+        with the given inputs and outputs by passing its own inputs through,
+        or None if the layer does not keep the shape of its first input
+        in its first output, e.g. transformer blocks."""
+        first_output = outputs
+        if isinstance(outputs, tuple) and outputs:
+            first_output = outputs[0]
+        if (
+            not inputs
+            or not isinstance(inputs[0], torch.Tensor)
+            or not isinstance(first_output, torch.Tensor)
+            or inputs[0].shape != first_output.shape
+        ):
+            return None
+
+        shape = first_output.shape
+        # Other outputs, e.g. attention weights, are reused as they are.
+        other_outputs = outputs[1:] if isinstance(outputs, tuple) else None
+
+        def passthrough(layer_inputs: tuple):
+            if (
+                not layer_inputs
+                or not isinstance(layer_inputs[0], torch.Tensor)
+                or layer_inputs[0].shape != shape
+            ):
+                return None
+            if other_outputs is None:
+                return layer_inputs[0]
+            return (layer_inputs[0],) + other_outputs
+
+        return passthrough
+
+    @staticmethod
+    def get_tensor_bytes(outputs) -> int:
+        """Get the total size of tensors in the (nested) outputs of a module."""
+        if isinstance(outputs, torch.Tensor):
+            return outputs.numel() * outputs.element_size()
+        if isinstance(outputs, dict):
+            outputs = list(outputs.values())
+        if isinstance(outputs, (list, tuple)):
+            return sum(ModelProfiler.get_tensor_bytes(output) for output in outputs)
+        return 0
+
     @staticmethod
     def _profile_model(
         model_name_or_path: str,
@@ -170,6 +760,11 @@ class ModelProfiler:
         precision: str,
         inputs: dict[str, torch.Tensor],
         warmup: int = 3,
+        agent_index: int = 0,
+        num_agents: int = 1,
+        microbatch_sizes: list[int] | None = None,
+        num_iterations: int = 1,
+        deduplicate_layers: bool = True,
     ):
         class EventTiming(Enum):
             FORWARD_START = 0
@@ -184,8 +779,23 @@ class ModelProfiler:
             module_name: str
             events: dict[EventTiming, torch.cuda.Event] = field(default_factory=dict)
             memory: dict[EventTiming, int] = field(default_factory=dict)
+            activation_bytes: int = 0
+            forward_samples: list[float] = field(default_factory=list)
+            backward_samples: list[float] = field(default_factory=list)
+
+            def record_latency(self):
+                self.forward_samples.append(
+                    self.events[EventTiming.FORWARD_START].elapsed_time(
+                        self.events[EventTiming.FORWARD_END]
+                    )
+                )
+                self.backward_samples.append(
+                    self.events[EventTiming.BACKWARD_START].elapsed_time(
+                        self.events[EventTiming.BACKWARD_END]
+                    )
+                )
 
-        store_path = profile_dir / "store"
+        store_path = profile_dir / f"store{agent_index}"
         logger.debug(
             f"Profiler initiating torch.distributed: {store_path} with {tp_size} workers"
         )
@@ -207,16 +817,59 @@ class ModelProfiler:
         model.gradient_checkpointing_enable()
 
         layers = PipelineTemplate.get_modules(model)
-        profile_data: dict[str, ProfileData] = {
-            layer_name: ProfileData(
-                module_name=layer_name,
-                events={
-                    timing: torch.cuda.Event(enable_timing=True)
-                    for timing in EventTiming
-                },
+        # Parameters are counted before the model is sharded.
+        layer_num_parameters = [
+            sum(
+                p.numel()
+                for p in ModelProfiler.get_module_by_name(
+                    model, layer_name
+                ).parameters()
             )
             for layer_name in layers
-        }
+        ]
+        layer_range = ModelProfiler.get_layer_range(
+            len(layers), agent_index, num_agents
+        )
+        representatives = (
+            ModelProfiler.get_representatives(model, layers)
+            if deduplicate_layers
+            else list(range(len(layers)))
+        )
+        # Only representatives in the range are measured.
+        profiled_indices = [
+            index for index in layer_range if representatives[index] == index
+        ]
+        # Forward pass stops after the last layer to be measured, and gradients
+        # do not flow to layers before the first one.
+        first_layer = layers[profiled_indices[0]] if profiled_indices else None
+        last_layer = (
+            layers[profiled_indices[-1]]
+            if profiled_indices and profiled_indices[-1] < len(layers) - 1
+            else None
+        )
+        if not profiled_indices:
+            # Nothing to profile; stop forward pass as early as possible.
+            last_layer = layers[0]
+        stop_forward = True
+        logger.debug(
+            f"Profiling layers {profiled_indices} in {layer_range} "
+            f"out of {len(layers)} layers"
+        )
+
+        def create_profile_data() -> dict[str, ProfileData]:
+            return {
+                layer_name: ProfileData(
+                    module_name=layer_name,
+                    events={
+                        timing: torch.cuda.Event(enable_timing=True)
+                        for timing in EventTiming
+                    },
+                )
+                for layer_name in (layers[index] for index in profiled_indices)
+            }
+
+        # Hooks record into profile data of the microbatch size being profiled.
+        profile_data = create_profile_data()
 
         optim_name, cls = optimizer_class.rsplit(".", 1)
         module = importlib.import_module(optim_name)
@@ -252,24 +905,51 @@ class ModelProfiler:
         # Configure hooks for each layer
         def forward_pre_hook(module_name: str, module: nn.Module, inputs):
             module.to("cuda")
+            if module_name not in profile_data:
+                return
+
+            if module_name == first_layer and layers.index(first_layer) > 0:
+                inputs = tuple(
+                    (
+                        input.detach().requires_grad_(input.is_floating_point())
+                        if isinstance(input, torch.Tensor)
+                        else input
+                    )
+                    for input in inputs
+                )
             profile_data[module_name].memory[EventTiming.FORWARD_START] = (
                 torch.cuda.memory_allocated()
             )
             event = profile_data[module_name].events[EventTiming.FORWARD_START]
             event.record()
+            return inputs
 
         def forward_hook(module_name: str, module: nn.Module, inputs, outputs):
-            profile_data[module_name].memory[EventTiming.FORWARD_END] = (
-                torch.cuda.memory_allocated()
-            )
-            event = profile_data[module_name].events[EventTiming.FORWARD_END]
-            event.record()
+            if module_name in duplicated_layers:
+                representative_outputs[module_name] = (
+                    ModelProfiler.get_passthrough_outputs(inputs, outputs)
+                )
+            if module_name in profile_data:
+                profile_data[module_name].memory[EventTiming.FORWARD_END] = (
+                    torch.cuda.memory_allocated()
+                )
+                event = profile_data[module_name].events[EventTiming.FORWARD_END]
+                event.record()
+                profile_data[module_name].activation_bytes = (
+                    ModelProfiler.get_tensor_bytes(outputs)
+                )
             module.to("cpu")
 
+            if module_name == last_layer and stop_forward:
+                raise _ForwardStopped(outputs)
+
         modules_to_offload: list[tuple[str, torch.nn.Module]] = []
 
         def backward_pre_hook(module_name: str, module: nn.Module, grad_output):
             module.to("cuda")
+            if module_name not in profile_data:
+                return
+
             profile_data[module_name].memory[EventTiming.BACKWARD_START] = (
                 torch.cuda.memory_allocated()
             )
@@ -277,28 +957,58 @@ class ModelProfiler:
             event.record()
 
         def backward_hook(module_name, module: nn.Module, grad_input, grad_output):
-            event = profile_data[module_name].events[EventTiming.BACKWARD_END]
-            event.record()
+            if module_name in profile_data:
+                event = profile_data[module_name].events[EventTiming.BACKWARD_END]
+                event.record()
 
-            profile_data[module_name].memory[EventTiming.BACKWARD_END] = profile_data[
-                module_name
-            ].memory[EventTiming.BACKWARD_START] + sum(
-                p.numel() * p.element_size() for p in module.parameters()
-            )
+                profile_data[module_name].memory[EventTiming.BACKWARD_END] = (
+                    profile_data[module_name].memory[EventTiming.BACKWARD_START]
+                    + sum(p.numel() * p.element_size() for p in module.parameters())
+                )
 
             for _, m in modules_to_offload:
                 m.to("cpu")
             modules_to_offload.clear()
             modules_to_offload.append((module_name, module))
 
-        # Move inputs to cuda
-        for name in inputs.keys():
-            inputs[name] = inputs[name].to("cuda")
+        # Layers identical to a representative are not executed. They pass
+        # their inputs through in the structure of outputs of the representative,
+        # which runs earlier in the same forward pass.
+        duplicated_layers = {
+            layers[representative]
+            for index, representative in enumerate(representatives)
+            if representative != index
+        }
+        representative_outputs: dict[str, Callable | None] = {}
+
+        def skip_forward(
+            representative_name: str,
+            module: nn.Module,
+            forward: Callable,
+            *args,
+            **kwargs,
+        ):
+            passthrough = representative_outputs.get(representative_name)
+            outputs = passthrough(args) if passthrough is not None else None
+            if outputs is None:
+                # Inputs cannot be passed through; execute the layer.
+                # It is offloaded with all the others after the iteration.
+                module.to("cuda")
+                return forward(*args, **kwargs)
+            return outputs
 
         logger.info("Profiler started...")
 
-        for layer_name in layers:
+        for index, layer_name in enumerate(layers):
             module = ModelProfiler.get_module_by_name(model, layer_name)
+            if representatives[index] != index:
+                module.forward = functools.partial(
+                    skip_forward,
+                    layers[representatives[index]],
+                    module,
+                    module.forward,
+                )
+                continue
 
             module.register_forward_pre_hook(
                 functools.partial(forward_pre_hook, layer_name)
@@ -311,126 +1021,341 @@ class ModelProfiler:
                 functools.partial(backward_hook, layer_name)
             )
 
-        with torch.no_grad():
-            for _ in range(warmup):
-                model(**inputs)
-
-        should_continue: bool = True
-
-        while should_continue:
-            for param in model.parameters():
-                param.grad = None
-
-            logger.debug("Iterating until overflow solved...")
-            outputs = model(**inputs)
-            optimizer.backward(outputs.loss)
-            torch.cuda.synchronize()
+        def get_loss() -> torch.Tensor:
+            """Run forward pass and get the loss, or a surrogate loss
+            from outputs of the last layer in the range if it is stopped."""
+            nonlocal stop_forward
+            stop_forward = True
+            try:
+                return model(**inputs).loss
+            except _ForwardStopped as e:
+                outputs = e.outputs
+                if isinstance(outputs, dict):
+                    outputs = list(outputs.values())
+                if not isinstance(outputs, (list, tuple)):
+                    outputs = [outputs]
+                return sum(
+                    output.float().mean()
+                    for output in outputs
+                    if isinstance(output, torch.Tensor) and output.requires_grad
+                )
+            finally:
+                # Layers may be recomputed during backward with gradient checkpointing.
+                stop_forward = False
 
+        def offload_parameters():
             modules_to_offload.clear()
             for param in model.parameters():
                 param.data = param.data.to("cpu")
-                param.grad.data = param.grad.data.to("cpu")
-
-            if (
-                mixed_precision is None
-                or not optimizer.mixed_precision.should_skip_step()
-            ):
-                should_continue = False
-
-                for layer_name in layers:
-                    profile_data[layer_name].memory[
-                        EventTiming.OPTIMIZER_STEP_START
-                    ] = 0
-                    profile_data[layer_name].memory[EventTiming.OPTIMIZER_STEP_END] = 0
-                optimizer.step()
-
-                num_parameters = 0
-                working_to_master_map = (
-                    optimizer.get_working_to_master_map()
-                    if (precision in ["fp16", "bf16"])
-                    else None
+                if param.grad is not None:
+                    param.grad.data = param.grad.data.to("cpu")
+
+        def get_mem_required(layer_memory: dict[EventTiming, int]) -> int:
+            return (
+                (
+                    layer_memory[EventTiming.FORWARD_END]
+                    - layer_memory[EventTiming.FORWARD_START]
                 )
-                for layer_name in layers:
-                    module = ModelProfiler.get_module_by_name(model, layer_name)
-                    for param_name, p in module.named_parameters():
-                        if f"{layer_name}.{param_name}" in model._tied_weights_keys:
-                            continue
-
-                        if precision in ["fp16", "bf16"]:
-                            optim_param_index_id = optim_param_info["id2param"][
-                                num_parameters
-                            ]
-                            master_tensor = working_to_master_map[optim_param_index_id]
-                            states: dict[torch.Tensor, dict] = (
-                                optimizer.optim.state.get(master_tensor)
-                            )
-                        else:
-                            states: dict[torch.Tensor, dict] = (
-                                optimizer.optim.state.get(p)
-                            )
-
-                        if states:
-                            for name, state in states.items():
-                                if isinstance(state, torch.Tensor):
-                                    profile_data[layer_name].memory[
-                                        EventTiming.OPTIMIZER_STEP_END
-                                    ] += state.numel() * state.element_size()
-
-                        num_parameters += 1
-
-            optimizer.zero_grad()
+                + (
+                    layer_memory[EventTiming.BACKWARD_END]
+                    - layer_memory[EventTiming.BACKWARD_START]
+                )
+                + (
+                    layer_memory[EventTiming.OPTIMIZER_STEP_END]
+                    - layer_memory[EventTiming.OPTIMIZER_STEP_START]
+                )
+            )
 
-        logger.debug("Profiler finished.")
+        def get_optimizer_step_samples(layer_name: str) -> list[float]:
+            """Time `num_iterations` optimizer steps of a layer with its own
+            optimizer. Optimizer states are kept in fp32 even with mixed precision,
+            thus steps are taken on fp32 copies of parameters."""
+            module = ModelProfiler.get_module_by_name(model, layer_name)
+            params = []
+            for param_name, p in module.named_parameters():
+                if f"{layer_name}.{param_name}" in model._tied_weights_keys:
+                    continue
+                param = p.detach().to("cuda", torch.float32).requires_grad_()
+                param.grad = torch.zeros_like(param)
+                params.append(param)
+            if not params:
+                return [0.0]
+
+            layer_optimizer = optim_cls(params)
+            # The first step allocates optimizer states.
+            layer_optimizer.step()
+            events = []
+            for _ in range(num_iterations):
+                start = torch.cuda.Event(enable_timing=True)
+                end = torch.cuda.Event(enable_timing=True)
+                start.record()
+                layer_optimizer.step()
+                end.record()
+                events.append((start, end))
+            torch.cuda.synchronize()
+            return [start.elapsed_time(end) for start, end in events]
 
         rank = dist.get_rank()
-        if rank == 0:
-            microbatch_size = inputs["input_ids"].shape[0]
-            profile_path = ModelProfiler.get_profile_path(
-                profile_dir, tp_size, microbatch_size, precision
-            )
-            logger.debug(f"Writing results to {profile_path}")
-
-            data = {
-                "model_name": model_name_or_path,
-                "microbatch_size": microbatch_size,
-                "tp_size": tp_size,
-                "precision": precision,
-                "layers": [],
+        base_inputs = inputs
+        if microbatch_sizes is None:
+            microbatch_sizes = [inputs["input_ids"].shape[0]]
+
+        for microbatch_size in microbatch_sizes:
+            logger.debug(f"Profiling with microbatch size {microbatch_size}...")
+            inputs = {
+                name: ModelProfiler.resize_batch(value, microbatch_size).to("cuda")
+                for name, value in base_inputs.items()
             }
-            for index, (layer_name, layer_profile) in enumerate(profile_data.items()):
-                data["layers"].append(
-                    asdict(
+            profile_data = create_profile_data()
+
+            with torch.no_grad():
+                for _ in range(warmup):
+                    get_loss()
+
+            should_continue: bool = True
+
+            while should_continue:
+                for param in model.parameters():
+                    param.grad = None
+
+                logger.debug("Iterating until overflow solved...")
+                optimizer.backward(get_loss())
+                torch.cuda.synchronize()
+                for layer_profile in profile_data.values():
+                    layer_profile.record_latency()
+
+                offload_parameters()
+
+                if (
+                    mixed_precision is None
+                    or not optimizer.mixed_precision.should_skip_step()
+                ):
+                    should_continue = False
+
+                    for layer_name in profile_data:
+                        profile_data[layer_name].memory[
+                            EventTiming.OPTIMIZER_STEP_START
+                        ] = 0
+                        profile_data[layer_name].memory[
+                            EventTiming.OPTIMIZER_STEP_END
+                        ] = 0
+                    optimizer.step()
+
+                    num_parameters = 0
+                    working_to_master_map = (
+                        optimizer.get_working_to_master_map()
+                        if (precision in ["fp16", "bf16"])
+                        else None
+                    )
+                    for layer_name in layers:
+                        module = ModelProfiler.get_module_by_name(model, layer_name)
+                        for param_name, p in module.named_parameters():
+                            if f"{layer_name}.{param_name}" in model._tied_weights_keys:
+                                continue
+
+                            if precision in ["fp16", "bf16"]:
+                                optim_param_index_id = optim_param_info["id2param"][
+                                    num_parameters
+                                ]
+                                master_tensor = working_to_master_map[
+                                    optim_param_index_id
+                                ]
+                                states: dict[torch.Tensor, dict] = (
+                                    optimizer.optim.state.get(master_tensor)
+                                )
+                            else:
+                                states: dict[torch.Tensor, dict] = (
+                                    optimizer.optim.state.get(p)
+                                )
+
+                            if states and layer_name in profile_data:
+                                for name, state in states.items():
+                                    if isinstance(state, torch.Tensor):
+                                        profile_data[layer_name].memory[
+                                            EventTiming.OPTIMIZER_STEP_END
+                                        ] += state.numel() * state.element_size()
+
+                            num_parameters += 1
+
+                optimizer.zero_grad()
+
+            # Memory is measured in the first iteration that is not skipped,
+            # and only latency is measured in the remaining iterations.
+            # Latency of skipped iterations is dropped.
+            memory = {
+                layer_name: dict(layer_profile.memory)
+                for layer_name, layer_profile in profile_data.items()
+            }
+            for layer_profile in profile_data.values():
+                layer_profile.forward_samples = layer_profile.forward_samples[-1:]
+                layer_profile.backward_samples = layer_profile.backward_samples[-1:]
+
+            for iteration in range(1, num_iterations):
+                logger.debug(f"Measuring iteration {iteration + 1}/{num_iterations}")
+                for param in model.parameters():
+                    param.grad = None
+
+                optimizer.backward(get_loss())
+                torch.cuda.synchronize()
+                for layer_profile in profile_data.values():
+                    layer_profile.record_latency()
+
+                offload_parameters()
+                optimizer.zero_grad()
+
+            optimizer_step_samples = {
+                layer_name: get_optimizer_step_samples(layer_name)
+                for layer_name in profile_data
+            }
+
+            # Backward without activation checkpointing does not recompute
+            # forward, but keeps intermediate activations of all layers in
+            # the range on the GPU at once, which may not fit for large models.
+            # If it does not, the layers are recorded as not profiled
+            # without activation checkpointing.
+            logger.debug("Measuring iterations without activation checkpointing")
+            checkpointing_profile_data = profile_data
+            profile_data = create_profile_data()
+            model.gradient_checkpointing_disable()
+            try:
+                for _ in range(num_iterations):
+                    for param in model.parameters():
+                        param.grad = None
+
+                    optimizer.backward(get_loss())
+                    torch.cuda.synchronize()
+                    for layer_profile in profile_data.values():
+                        layer_profile.record_latency()
+
+                    offload_parameters()
+                    optimizer.zero_grad()
+                no_checkpointing_profile_data = profile_data
+            except torch.cuda.OutOfMemoryError:
+                logger.warning(
+                    "Out of memory without activation checkpointing; "
+                    "it is not profiled."
+                )
+                no_checkpointing_profile_data = None
+                for param in model.parameters():
+                    param.grad = None
+                offload_parameters()
+                optimizer.zero_grad()
+                torch.cuda.empty_cache()
+            model.gradient_checkpointing_enable()
+            profile_data = checkpointing_profile_data
+
+            if rank == 0:
+                if num_agents == 1:
+                    profile_path = ModelProfiler.get_profile_path(
+                        profile_dir, tp_size, microbatch_size, precision
+                    )
+                else:
+                    profile_path = ModelProfiler.get_partial_profile_path(
+                        profile_dir,
+                        tp_size,
+                        microbatch_size,
+                        precision,
+                        agent_index,
+                        num_agents,
+                    )
+                logger.debug(f"Writing results to {profile_path}")
+
+                data = {
+                    "model_name": model_name_or_path,
+                    "microbatch_size": microbatch_size,
+                    "tp_size": tp_size,
+                    "precision": precision,
+                    "layers": [],
+                }
+                if num_agents > 1:
+                    data["num_layers"] = len(layers)
+                measured: dict[int, dict] = {}
+                for index, (layer_name, layer_profile) in zip(
+                    profiled_indices, profile_data.items()
+                ):
+                    forward_stats = ModelProfiler.get_timing_statistics(
+                        layer_profile.forward_samples
+                    )
+                    backward_stats = ModelProfiler.get_timing_statistics(
+                        layer_profile.backward_samples
+                    )
+                    optimizer_step_stats = ModelProfiler.get_timing_statistics(
+                        optimizer_step_samples[layer_name]
+                    )
+                    backward_no_checkpointing_stats = None
+                    mem_required_no_checkpointing = None
+                    if no_checkpointing_profile_data is not None:
+                        no_checkpointing_profile = no_checkpointing_profile_data[
+                            layer_name
+                        ]
+                        backward_no_checkpointing_stats = (
+                            ModelProfiler.get_timing_statistics(
+                                no_checkpointing_profile.backward_samples
+                            )
+                        )
+                        # Optimizer states are the same with and without
+                        # activation checkpointing.
+                        mem_required_no_checkpointing = get_mem_required(
+                            {
+                                **memory[layer_name],
+                                **no_checkpointing_profile.memory,
+                            }
+                        )
+                    layer = asdict(
                         LayerExecutionResult(
                             layer_index=index,
                             layer_name=layer_name,
-                            forward=layer_profile.events[
-                                EventTiming.FORWARD_START
-                            ].elapsed_time(
-                                layer_profile.events[EventTiming.FORWARD_END]
-                            ),
-                            backward=layer_profile.events[
-                                EventTiming.BACKWARD_START
-                            ].elapsed_time(
-                                layer_profile.events[EventTiming.BACKWARD_END]
-                            ),
-                            mem_required=(
-                                layer_profile.memory[EventTiming.FORWARD_END]
-                                - layer_profile.memory[EventTiming.FORWARD_START]
-                            )
-                            + (
-                                layer_profile.memory[EventTiming.BACKWARD_END]
-                                - layer_profile.memory[EventTiming.BACKWARD_START]
-                            )
-                            + (
-                                layer_profile.memory[EventTiming.OPTIMIZER_STEP_END]
-                                - layer_profile.memory[EventTiming.OPTIMIZER_STEP_START]
+                            forward=forward_stats["mean"],
+                            backward=backward_stats["mean"],
+                            mem_required=get_mem_required(memory[layer_name]),
+                            activation_bytes=layer_profile.activation_bytes,
+                            optimizer_step=optimizer_step_stats["mean"],
+                            backward_no_checkpointing=(
+                                backward_no_checkpointing_stats["mean"]
+                                if backward_no_checkpointing_stats is not None
+                                else None
                             ),
+                            mem_required_no_checkpointing=mem_required_no_checkpointing,
+                            num_parameters=layer_num_parameters[index],
                         )
                     )
-                )
+                    layer["forward_stats"] = forward_stats
+                    layer["backward_stats"] = backward_stats
+                    layer["optimizer_step_stats"] = optimizer_step_stats
+                    if backward_no_checkpointing_stats is not None:
+                        layer["backward_no_checkpointing_stats"] = (
+                            backward_no_checkpointing_stats
+                        )
+                    layer["num_iterations"] = len(layer_profile.forward_samples)
+                    measured[index] = layer
+
+                for index in layer_range:
+                    representative = representatives[index]
+                    if representative in measured:
+                        data["layers"].append(
+                            dict(
+                                measured[representative],
+                                layer_index=index,
+                                layer_name=layers[index],
+                            )
+                        )
+                    else:
+                        # Measured by another agent; copied in load_profile().
+                        data["layers"].append(
+                            {
+                                "layer_index": index,
+                                "layer_name": layers[index],
+                                "representative": representative,
+                            }
+                        )
+
+                with tempfile.NamedTemporaryFile(
+                    "w", dir=profile_dir, prefix=f".{profile_path.name}.", delete=False
+                ) as f:
+                    json.dump(data, f, cls=JsonEncoder)
+                os.replace(f.name, profile_path)
 
-            with profile_path.open("w") as f:
-                json.dump(data, f, cls=JsonEncoder)
+        logger.debug("Profiler finished.")
 
         dist.barrier()
         torch.cuda.synchronize()
@@ -0,0 +1,392 @@
+import heapq
+from collections import Counter
+from dataclasses import dataclass
+
+from cornstarch.pipeline_template import PipelineTemplate
+
+from oobleck.planning.profiler import LayerExecutionResult
+
+
+@dataclass
+class SimulationResult:
+    """Result of simulating an iteration of instantiated pipelines.
+    All times are in ms.
+
+    Attributes:
+        iteration_time (float): Time until all pipelines finish their
+            microbatches, gradients are all-reduced, and optimizer steps finish.
+        pipeline_time (float): Time until all pipelines finish their microbatches.
+        allreduce_time (float): Time from `pipeline_time` until gradients
+            of all layers are all-reduced.
+        optimizer_step_time (float): The longest time that a device
+            spends on optimizer step.
+        bubble_fraction (float): Fraction of time that devices are idle
+            until all pipelines finish their microbatches.
+        stage_utilization (list[list[float]]): Fraction of `iteration_time`
+            that each stage of each pipeline spends on computation,
+            in the order of pipelines.
+    """
+
+    iteration_time: float
+    pipeline_time: float
+    allreduce_time: float
+    optimizer_step_time: float
+    bubble_fraction: float
+    stage_utilization: list[list[float]]
+
+
+class PipelineSimulator:
+    """A CPU-only discrete-event simulator of an iteration of
+    heterogeneous pipelines with 1F1B schedule.
+
+    Each stage runs forward and backward passes of microbatches in 1F1B order,
+    and activations and their gradients are sent to the next and previous
+    stages through links that transfer one tensor at a time.
+    After all pipelines finish, gradients of each layer are all-reduced
+    with ring all-reduce among devices that hold the layer, one from each
+    pipeline. A device all-reduces its layers one by one,
+    from the last layer to the first one, and then steps the optimizer
+    for its layers.
+
+    If `device_memory` is given and layers are profiled without activation
+    checkpointing, stages that fit in device memory without checkpointing
+    run backward without recomputation (see `get_stage_checkpointing()`).
+
+    Args:
+        profile_data (list[LayerExecutionResult]): Profile data of the model.
+        inter_node_bandwidth (float, optional): Bandwidth between nodes in Gbps.
+            If None, communication takes no time.
+        inter_node_latency (float): Latency between nodes in ms.
+            Only used with `inter_node_bandwidth`.
+        layer_num_gradient_bytes (list[int], optional): The number of bytes of
+            gradients of each layer held by a device. If None, all-reduce
+            takes no time.
+        device_memory (int, optional): Memory of a device in bytes.
+            If None, all stages use activation checkpointing.
+    """
+
+    def __init__(
+        self,
+        profile_data: list[LayerExecutionResult],
+        inter_node_bandwidth: float | None = None,
+        inter_node_latency: float = 0.0,
+        layer_num_gradient_bytes: list[int] | None = None,
+        device_memory: int | None = None,
+    ):
+        self.profile_data = profile_data
+        self.inter_node_bandwidth = inter_node_bandwidth
+        self.inter_node_latency = inter_node_latency
+        self.layer_num_gradient_bytes = layer_num_gradient_bytes
+        self.device_memory = device_memory
+        self._layers = {layer.layer_name: layer for layer in profile_data}
+
+    def transfer_time(self, num_bytes: int) -> float:
+        if self.inter_node_bandwidth is None:
+            return 0.0
+        return self.inter_node_latency + num_bytes * 8 / (
+            self.inter_node_bandwidth * 1e6
+        )
+
+    def allreduce_time(self, num_bytes: int, num_replicas: int) -> float:
+        if (
+            self.inter_node_bandwidth is None
+            or self.layer_num_gradient_bytes is None
+            or num_replicas <= 1
+        ):
+            return 0.0
+        # Ring all-reduce: 2 * (N - 1) steps, each sending 1 / N of the gradients
+        return 2 * (num_replicas - 1) * self.transfer_time(num_bytes / num_replicas)
+
+    def get_stage_checkpointing(self, template: PipelineTemplate) -> list[bool]:
+        """Decide whether each stage of a template uses activation checkpointing.
+
+        Checkpointing trades recomputation for memory, thus a stage does not
+        use it if its layers fit in device memory without it.
+        """
+        checkpointing = []
+        for modules in template.modules_per_stage:
+            layers = [self._layers[name] for name in modules]
+            checkpointing.append(
+                self.device_memory is None
+                or any(
+                    layer.backward_no_checkpointing is None
+                    or layer.mem_required_no_checkpointing is None
+                    for layer in layers
+                )
+                or sum(layer.mem_required_no_checkpointing for layer in layers)
+                > self.device_memory
+            )
+        return checkpointing
+
+    @staticmethod
+    def get_schedule(num_stages: int, num_microbatches: int) -> list[list[tuple]]:
+        """Get the order of passes ("forward" or "backward", microbatch index)
+        of each stage in 1F1B schedule."""
+        schedule = []
+        for stage_index in range(num_stages):
+            num_warmup = min(num_stages - stage_index - 1, num_microbatches)
+            passes = [("forward", index) for index in range(num_warmup)]
+            for index in range(num_microbatches - num_warmup):
+                passes.append(("forward", num_warmup + index))
+                passes.append(("backward", index))
+            passes.extend(
+                ("backward", index)
+                for index in range(num_microbatches - num_warmup, num_microbatches)
+            )
+            schedule.append(passes)
+        return schedule
+
+    def simulate_pipeline(
+        self,
+        template: PipelineTemplate,
+        num_microbatches: int,
+        host_speeds: list[float] | None = None,
+    ) -> tuple[list[float], list[float]]:
+        """Simulate 1F1B execution of a pipeline.
+
+        Args:
+            template (PipelineTemplate): The template of the pipeline.
+            num_microbatches (int): The number of microbatches of the pipeline.
+            host_speeds (list[float], optional): Relative speed of the host
+                of each stage. None if all hosts have the same speed.
+
+        Returns:
+            A tuple of two lists, which are the time that each stage
+            finishes its last pass and the time that each stage spends
+            on computation.
+        """
+        num_stages = template.num_stages
+        speeds = host_speeds or [1.0] * num_stages
+        layers = [
+            [self._layers[name] for name in modules]
+            for modules in template.modules_per_stage
+        ]
+        durations = {
+            "forward": [
+                sum(layer.forward for layer in stage_layers) / speed
+                for stage_layers, speed in zip(layers, speeds)
+            ],
+            "backward": [
+                sum(
+                    (
+                        layer.backward
+                        if checkpointing
+                        else layer.backward_no_checkpointing
+                    )
+                    for layer in stage_layers
+                )
+                / speed
+                for stage_layers, speed, checkpointing in zip(
+                    layers, speeds, self.get_stage_checkpointing(template)
+                )
+            ],
+        }
+        # Activations of the last layer of a stage and their gradients
+        # are sent between the stage and the next stage.
+        transfer_times = [
+            self.transfer_time(stage_layers[-1].activation_bytes)
+            for stage_layers in layers[:-1]
+        ]
+
+        schedule = self.get_schedule(num_stages, num_microbatches)
+        next_pass = [0] * num_stages
+        busy = [False] * num_stages
+        end_times = [0.0] * num_stages
+        busy_times = [0.0] * num_stages
+        # Passes whose inputs have arrived at each stage
+        ready: list[set[tuple[str, int]]] = [set() for _ in range(num_stages)]
+        ready[0].update(("forward", index) for index in range(num_microbatches))
+        # Time that each link becomes free (forward and backward directions)
+        link_free_times = {
+            "forward": [0.0] * num_stages,
+            "backward": [0.0] * num_stages,
+        }
+
+        events: list[tuple[float, int, str, int, tuple[str, int]]] = []
+        sequence = 0
+
+        def push(time: float, kind: str, stage_index: int, pass_: tuple[str, int]):
+            nonlocal sequence
+            heapq.heappush(events, (time, sequence, kind, stage_index, pass_))
+            sequence += 1
+
+        def try_start(time: float, stage_index: int):
+            if busy[stage_index] or next_pass[stage_index] >= len(
+                schedule[stage_index]
+            ):
+                return
+            pass_ = schedule[stage_index][next_pass[stage_index]]
+            if pass_ not in ready[stage_index]:
+                return
+
+            duration = durations[pass_[0]][stage_index]
+            busy[stage_index] = True
+            busy_times[stage_index] += duration
+            next_pass[stage_index] += 1
+            push(time + duration, "done", stage_index, pass_)
+
+        def send(time: float, direction: str, link_index: int, pass_: tuple[str, int]):
+            destination = link_index + 1 if direction == "forward" else link_index
+            start = max(time, link_free_times[direction][link_index])
+            arrival = start + transfer_times[link_index]
+            link_free_times[direction][link_index] = arrival
+            push(arrival, "arrive", destination, pass_)
+
+        try_start(0.0, 0)
+        while events:
+            time, _, kind, stage_index, pass_ = heapq.heappop(events)
+            if kind == "arrive":
+                ready[stage_index].add(pass_)
+                try_start(time, stage_index)
+                continue
+
+            busy[stage_index] = False
+            end_times[stage_index] = time
+            name, index = pass_
+            if name == "forward":
+                if stage_index < num_stages - 1:
+                    send(time, "forward", stage_index, pass_)
+                else:
+                    ready[stage_index].add(("backward", index))
+            elif stage_index > 0:
+                send(time, "backward", stage_index - 1, ("backward", index))
+            try_start(time, stage_index)
+
+        assert all(
+            next_pass[stage_index] == len(schedule[stage_index])
+            for stage_index in range(num_stages)
+        ), "Pipeline simulation deadlocked."
+
+        return end_times, busy_times
+
+    def simulate(
+        self,
+        pipelines: list[PipelineTemplate],
+        num_microbatches: dict[PipelineTemplate, int],
+        host_speeds: list[float] | None = None,
+    ) -> SimulationResult:
+        """Simulate an iteration of instantiated pipelines.
+
+        Args:
+            pipelines (list[PipelineTemplate]): Instantiated pipelines
+                in the order of hosts.
+            num_microbatches (dict[PipelineTemplate, int]): The number of
+                microbatches of each pipeline of each template.
+            host_speeds (list[float], optional): Relative speed of each host
+                in order. None if all hosts have the same speed.
+
+        Returns:
+            SimulationResult: The result of the simulation.
+        """
+        end_times: list[list[float]] = []
+        busy_times: list[list[float]] = []
+        optimizer_step_times: list[list[float]] = []
+        host_index = 0
+        for pipeline in pipelines:
+            speeds = (
+                host_speeds[host_index : host_index + pipeline.num_stages]
+                if host_speeds is not None
+                else [1.0] * pipeline.num_stages
+            )
+            pipeline_end_times, pipeline_busy_times = self.simulate_pipeline(
+                pipeline, num_microbatches[pipeline], speeds
+            )
+            end_times.append(pipeline_end_times)
+            busy_times.append(pipeline_busy_times)
+            optimizer_step_times.append(
+                [
+                    sum(self._layers[name].optimizer_step for name in modules) / speed
+                    for modules, speed in zip(pipeline.modules_per_stage, speeds)
+                ]
+            )
+            host_index += pipeline.num_stages
+
+        pipeline_time = max(
+            (max(stage_end_times) for stage_end_times in end_times), default=0.0
+        )
+
+        # Gradients of a layer are all-reduced after every stage holding it finishes.
+        device_free_times = [list(stage_end_times) for stage_end_times in end_times]
+        stage_of_layer: list[dict[str, int]] = [
+            {
+                name: stage_index
+                for stage_index, modules in enumerate(pipeline.modules_per_stage)
+                for name in modules
+            }
+            for pipeline in pipelines
+        ]
+        allreduce_end_time = pipeline_time
+        for layer in reversed(self.profile_data):
+            stages = [
+                (pipeline_index, layer_stages[layer.layer_name])
+                for pipeline_index, layer_stages in enumerate(stage_of_layer)
+            ]
+            start = max(
+                device_free_times[pipeline_index][stage_index]
+                for pipeline_index, stage_index in stages
+            )
+            end = start + self.allreduce_time(
+                (
+                    self.layer_num_gradient_bytes[layer.layer_index]
+                    if self.layer_num_gradient_bytes is not None
+                    else 0
+                ),
+                len(pipelines),
+            )
+            for pipeline_index, stage_index in stages:
+                device_free_times[pipeline_index][stage_index] = end
+            allreduce_end_time = max(allreduce_end_time, end)
+
+        iteration_time = max(
+            (
+                free_time + step_time
+                for stage_free_times, stage_step_times in zip(
+                    device_free_times, optimizer_step_times
+                )
+                for free_time, step_time in zip(stage_free_times, stage_step_times)
+            ),
+            default=0.0,
+        )
+
+        num_devices = sum(pipeline.num_stages for pipeline in pipelines)
+        total_busy_time = sum(sum(stage_busy_times) for stage_busy_times in busy_times)
+        return SimulationResult(
+            iteration_time=iteration_time,
+            pipeline_time=pipeline_time,
+            allreduce_time=allreduce_end_time - pipeline_time,
+            optimizer_step_time=max(
+                (
+                    step_time
+                    for stage_step_times in optimizer_step_times
+                    for step_time in stage_step_times
+                ),
+                default=0.0,
+            ),
+            bubble_fraction=(
+                1 - total_busy_time / (num_devices * pipeline_time)
+                if pipeline_time > 0
+                else 0.0
+            ),
+            stage_utilization=[
+                [
+                    busy_time / iteration_time if iteration_time > 0 else 0.0
+                    for busy_time in stage_busy_times
+                ]
+                for stage_busy_times in busy_times
+            ],
+        )
+
+    def simulate_instantiation(
+        self,
+        num_instances: dict[PipelineTemplate, int],
+        num_microbatches: dict[PipelineTemplate, int],
+    ) -> SimulationResult:
+        """Simulate an iteration of pipelines instantiated from templates,
+        e.g. the result of `PipelineInstantiator.instantiate()`,
+        on hosts with the same speed."""
+        pipelines = [
+            template
+            for template, count in Counter(num_instances).items()
+            for _ in range(count)
+        ]
+        return self.simulate(pipelines, num_microbatches)
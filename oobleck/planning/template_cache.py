@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from dataclasses import asdict
+from pathlib import Path
+
+from cornstarch.pipeline_template import PipelineTemplate
+from loguru import logger
+
+from oobleck.planning.profiler import LayerExecutionResult
+
+
+class PipelineTemplateCache:
+    """A persistent, content-addressed cache of pipeline templates.
+
+    Pipeline template generation and their sanity check are deterministic
+    given the profile data and planner inputs. Cached templates are stored
+    under `base_dir / "template_cache"` with a file name that is a hash of
+    all those inputs, so that a restarted job can reuse templates
+    instead of planning again.
+
+    Each cache entry includes templates that passed the sanity check
+    and the reasons of templates that failed it.
+
+    Args:
+        base_dir (Path): Oobleck root directory.
+    """
+
+    def __init__(self, base_dir: Path):
+        self.cache_dir = base_dir / "template_cache"
+
+    @staticmethod
+    def get_cache_key(
+        model_name: str,
+        profile_data: list[LayerExecutionResult],
+        tp_size: int,
+        microbatch_size: int,
+        num_nodes: list[int],
+        **planner_options,
+    ) -> str:
+        """Get a hash of all inputs that determine pipeline templates.
+
+        Args:
+            model_name (str): The name of the model.
+            profile_data (list[LayerExecutionResult]): Profile data of the model.
+            tp_size (int): Tensor parallel size.
+            microbatch_size (int): Microbatch size.
+            num_nodes (list[int]): A list of number of nodes to create templates for.
+            planner_options: Additional planner inputs that affect templates.
+
+        Returns:
+            str: A hex digest that identifies the cache entry.
+        """
+        key = {
+            "model_name": model_name,
+            "profile_data": [asdict(layer) for layer in profile_data],
+            "tp_size": tp_size,
+            "microbatch_size": microbatch_size,
+            "num_nodes": sorted(num_nodes),
+            "planner_options": planner_options,
+        }
+        data = json.dumps(key, sort_keys=True).encode()
+        return hashlib.sha256(data).hexdigest()
+
+    def get_cache_path(self, key: str) -> Path:
+        return self.cache_dir / f"templates_{key}.pkl"
+
+    def load(self, key: str) -> dict[int, PipelineTemplate] | None:
+        """Load cached pipeline templates.
+
+        Returns:
+            Pipeline templates that passed the sanity check,
+            or None if there is no valid cache entry.
+        """
+        cache_path = self.get_cache_path(key)
+        if not cache_path.exists():
+            return None
+
+        try:
+            with cache_path.open("rb") as f:
+                entry = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Ignoring broken pipeline template cache {cache_path}: {e}")
+            return None
+
+        for num_stages, reason in entry["rejected"].items():
+            logger.debug(
+                f"Cached pipeline template with {num_stages} stages "
+                f"failed to pass sanity check: {reason}"
+            )
+
+        logger.debug(f"Pipeline templates loaded from cache: {cache_path}")
+        return entry["pipeline_templates"]
+
+    def store(
+        self,
+        key: str,
+        pipeline_templates: dict[int, PipelineTemplate],
+        rejected: dict[int, str],
+    ):
+        """Store pipeline templates and sanity check results.
+
+        The cache file is written atomically, so that concurrent processes
+        never read a partially written entry.
+
+        Args:
+            key (str): Cache key from `get_cache_key()`.
+            pipeline_templates (dict[int, PipelineTemplate]):
+                Pipeline templates that passed the sanity check.
+            rejected (dict[int, str]): The number of stages of templates
+                that failed the sanity check, and the reasons.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_path = self.get_cache_path(key)
+
+        with tempfile.NamedTemporaryFile(
+            dir=self.cache_dir, prefix=f".{cache_path.name}.", delete=False
+        ) as f:
+            pickle.dump(
+                {"pipeline_templates": pipeline_templates, "rejected": rejected}, f
+            )
+        os.replace(f.name, cache_path)
+
+        logger.debug(f"Pipeline templates stored to cache: {cache_path}")
@@ -0,0 +1,400 @@
+import json
+import math
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import click
+from cornstarch.pipeline_template import PipelineTemplate
+from loguru import logger
+
+from oobleck.engine.pipeline_instantiator import PipelineInstantiator
+from oobleck.planning.planner import PipelineTemplateGenerator
+from oobleck.planning.profiler import TIMING_STATISTICS, LayerExecutionResult
+from oobleck.planning.simulator import PipelineSimulator
+
+
+@dataclass
+class WhatIfResult:
+    """Predicted training performance with a number of nodes.
+
+    Attributes:
+        num_nodes (int): The number of nodes.
+        iteration_time (float, optional): Estimated iteration time in ms.
+        samples_per_second (float, optional): Estimated training throughput.
+        num_instances (dict[int, int]): The number of pipelines of each template
+            (num_stages -> number of pipelines).
+        num_microbatches (dict[int, int]): The number of microbatches of
+            a pipeline of each template (num_stages -> number of microbatches).
+        simulated_iteration_time (float, optional): Iteration time in ms
+            simulated by `PipelineSimulator`, if requested.
+        error (str, optional): Why no instantiation is feasible, if any.
+    """
+
+    num_nodes: int
+    iteration_time: float | None = None
+    samples_per_second: float | None = None
+    num_instances: dict[int, int] = field(default_factory=dict)
+    num_microbatches: dict[int, int] = field(default_factory=dict)
+    simulated_iteration_time: float | None = None
+    error: str | None = None
+
+    @property
+    def template_mix(self) -> str:
+        return " + ".join(
+            f"{count}x{num_stages}-stage ({self.num_microbatches[num_stages]} mb)"
+            for num_stages, count in sorted(self.num_instances.items())
+        )
+
+
+class CapacityPlanner:
+    """Predicts iteration time and throughput of training with different
+    numbers of nodes only from profile data, without launching a job.
+
+    Pipeline templates and instantiations are planned the same way as
+    `ExecutionEngine` does for nodes with the same speed, except that
+    templates are not checked by the model policy.
+    All-reduce of gradients across pipelines is only modeled if the number of
+    parameters of each layer is profiled and `inter_node_bandwidth` is given.
+
+    Args:
+        model_name (str): Name of the model.
+        profile_data (list[LayerExecutionResult]): Profile data of the model.
+        microbatch_size (int): Microbatch size that the model is profiled with.
+        global_batch_size (int): Global batch size.
+        fault_tolerance_threshold (int): Minimum number of pipelines.
+        device_memory (int, optional): Memory of a device in bytes.
+            If None, memory is not considered.
+        inter_node_bandwidth (float, optional): Bandwidth between nodes in Gbps
+            for stage-to-stage transfers and gradient all-reduce.
+            If None, communication is ignored.
+        inter_node_latency (float): Latency between nodes in ms.
+        precision (str): Precision that the model is profiled with.
+        tp_size (int): Tensor parallel size that the model is profiled with.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        profile_data: list[LayerExecutionResult],
+        microbatch_size: int,
+        global_batch_size: int,
+        fault_tolerance_threshold: int = 1,
+        device_memory: int | None = None,
+        inter_node_bandwidth: float | None = None,
+        inter_node_latency: float = 0.0,
+        precision: str = "fp32",
+        tp_size: int = 1,
+    ):
+        assert (
+            global_batch_size % microbatch_size == 0
+        ), "Global batch size must be divisible by microbatch size."
+
+        self.model_name = model_name
+        self.profile_data = profile_data
+        self.microbatch_size = microbatch_size
+        self.global_batch_size = global_batch_size
+        self.fault_tolerance_threshold = fault_tolerance_threshold
+        self.device_memory = device_memory
+        self.inter_node_bandwidth = inter_node_bandwidth
+        self.inter_node_latency = inter_node_latency
+        self.precision = precision
+        self.tp_size = tp_size
+
+        self.min_num_nodes = (
+            max(
+                1,
+                math.ceil(
+                    sum(layer.mem_required for layer in profile_data) / device_memory
+                ),
+            )
+            if device_memory is not None
+            else 1
+        )
+        # Templates depend on the number of microbatches they are optimized for.
+        self._generators: dict[int, PipelineTemplateGenerator] = {}
+
+    @classmethod
+    def from_profile(
+        cls, profile_path: Path, timing_statistic: str = "mean", **kwargs
+    ) -> "CapacityPlanner":
+        """Create a planner from a profile JSON file written by `ModelProfiler`.
+
+        Args:
+            profile_path (Path): Path to the profile JSON file.
+            timing_statistic (str): Statistic of measured layer latency to plan
+                with; one of `TIMING_STATISTICS`.
+            **kwargs: Other arguments of `CapacityPlanner`.
+        """
+        data = json.loads(Path(profile_path).read_text())
+        profile_data = [
+            LayerExecutionResult.from_dict(layer, timing_statistic)
+            for layer in data["layers"]
+        ]
+        return cls(
+            data["model_name"],
+            profile_data,
+            data["microbatch_size"],
+            precision=data["precision"],
+            tp_size=data["tp_size"],
+            **kwargs,
+        )
+
+    @property
+    def global_num_microbatches(self) -> int:
+        return self.global_batch_size // self.microbatch_size
+
+    @property
+    def layer_num_gradient_bytes(self) -> list[int] | None:
+        """The number of bytes of gradients of each layer held by a device,
+        or None if the number of parameters of any layer is not profiled."""
+        if any(layer.num_parameters is None for layer in self.profile_data):
+            return None
+
+        num_bytes = 2 if self.precision in ["fp16", "bf16"] else 4
+        return [
+            layer.num_parameters * num_bytes // self.tp_size
+            for layer in self.profile_data
+        ]
+
+    def create_pipeline_templates(self, num_nodes: int) -> dict[int, PipelineTemplate]:
+        """Create pipeline templates that `ExecutionEngine` would use
+        with `num_nodes` nodes.
+
+        Raises:
+            RuntimeError: If no pipeline template is feasible.
+        """
+        max_num_nodes = min(num_nodes, len(self.profile_data))
+        if max_num_nodes < self.min_num_nodes:
+            raise RuntimeError(
+                f"At least {self.min_num_nodes} nodes are required to hold the model."
+            )
+
+        # Same as `ExecutionEngine`, an n-stage template is optimized for
+        # about n / num_nodes of the global number of microbatches.
+        pipeline_templates: dict[int, PipelineTemplate] = {}
+        for template_num_nodes in range(self.min_num_nodes, max_num_nodes + 1):
+            num_microbatches = max(
+                1, self.global_num_microbatches * template_num_nodes // num_nodes
+            )
+            if num_microbatches not in self._generators:
+                self._generators[num_microbatches] = PipelineTemplateGenerator(
+                    self.model_name,
+                    self.profile_data,
+                    device_memory=self.device_memory,
+                    num_microbatches=num_microbatches,
+                    inter_node_bandwidth=self.inter_node_bandwidth,
+                    inter_node_latency=self.inter_node_latency,
+                )
+            pipeline_templates.update(
+                self._generators[num_microbatches].create_pipeline_templates(
+                    [template_num_nodes]
+                )
+            )
+        if not pipeline_templates:
+            raise RuntimeError("No pipeline templates created.")
+        return pipeline_templates
+
+    def predict(self, num_nodes: int, simulate: bool = False) -> WhatIfResult:
+        """Predict training performance with `num_nodes` nodes.
+
+        Args:
+            num_nodes (int): The number of nodes.
+            simulate (bool): Whether to also simulate the chosen instantiation
+                with `PipelineSimulator`.
+
+        Returns:
+            WhatIfResult: The prediction. `error` is set if no instantiation
+            is feasible with `num_nodes` nodes.
+        """
+        try:
+            pipeline_templates = self.create_pipeline_templates(num_nodes)
+            instantiator = PipelineInstantiator(
+                pipeline_templates,
+                self.global_num_microbatches,
+                self.fault_tolerance_threshold,
+                layer_num_gradient_bytes=self.layer_num_gradient_bytes,
+                allreduce_bandwidth=self.inter_node_bandwidth,
+                layer_optimizer_step_times=[
+                    layer.optimizer_step for layer in self.profile_data
+                ],
+            )
+            (
+                iteration_time,
+                num_instances,
+                num_microbatches,
+            ) = instantiator.find_optimal_instantiation(num_nodes)
+        except RuntimeError as e:
+            logger.debug(f"No instantiation is feasible with {num_nodes} nodes: {e}")
+            return WhatIfResult(num_nodes=num_nodes, error=str(e))
+
+        result = WhatIfResult(
+            num_nodes=num_nodes,
+            iteration_time=iteration_time,
+            samples_per_second=(
+                self.global_batch_size / (iteration_time / 1000)
+                if iteration_time > 0
+                else None
+            ),
+            num_instances={
+                template.num_stages: count for template, count in num_instances.items()
+            },
+            num_microbatches={
+                template.num_stages: num_microbatches[template]
+                for template in num_instances
+            },
+        )
+
+        if simulate:
+            simulator = PipelineSimulator(
+                self.profile_data,
+                inter_node_bandwidth=self.inter_node_bandwidth,
+                inter_node_latency=self.inter_node_latency,
+                layer_num_gradient_bytes=self.layer_num_gradient_bytes,
+                device_memory=self.device_memory,
+            )
+            result.simulated_iteration_time = simulator.simulate_instantiation(
+                num_instances, num_microbatches
+            ).iteration_time
+
+        return result
+
+
+def parse_num_nodes(ctx, param, value: str) -> list[int]:
+    """Parse comma-separated numbers of nodes or inclusive ranges,
+    e.g. "8..64", "8..64..8" (with a step), or "4,8..12"."""
+    num_nodes: list[int] = []
+    try:
+        for part in value.split(","):
+            bounds = [int(bound) for bound in part.split("..")]
+            if len(bounds) == 1:
+                num_nodes.append(bounds[0])
+            elif len(bounds) in (2, 3) and (len(bounds) == 2 or bounds[2] > 0):
+                step = bounds[2] if len(bounds) == 3 else 1
+                num_nodes.extend(range(bounds[0], bounds[1] + 1, step))
+            else:
+                raise ValueError(part)
+    except ValueError:
+        raise click.BadParameter(
+            "must be comma-separated integers or ranges such as 8..64 or 8..64..8."
+        )
+
+    if not num_nodes or any(n <= 0 for n in num_nodes):
+        raise click.BadParameter("numbers of nodes must be positive.")
+    return sorted(set(num_nodes))
+
+
+@click.command(
+    help="Predict iteration time, throughput, and pipeline template mix "
+    "for different numbers of nodes from a profile, without launching a job."
+)
+@click.option(
+    "--profile",
+    "profile_path",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    required=True,
+    help="Path to a profile JSON file.",
+)
+@click.option(
+    "--nodes",
+    "num_nodes",
+    type=str,
+    required=True,
+    callback=parse_num_nodes,
+    help="Numbers of nodes, e.g. 8..64, 8..64..8, or 4,8,16.",
+)
+@click.option("--global_batch_size", type=int, required=True, help="Global batch size.")
+@click.option(
+    "--fault_tolerance_threshold",
+    type=int,
+    default=1,
+    help="Minimum number of pipelines.",
+)
+@click.option(
+    "--device_memory",
+    type=int,
+    default=None,
+    help="Memory of a device in bytes. Not considered if not given.",
+)
+@click.option(
+    "--inter_node_bandwidth",
+    type=float,
+    default=None,
+    help="Bandwidth between nodes in Gbps for stage-to-stage transfers and "
+    "gradient all-reduce. Communication is ignored if not given. All-reduce is "
+    "only modeled for profiles with the number of parameters of each layer.",
+)
+@click.option(
+    "--inter_node_latency", type=float, default=0.0, help="Latency between nodes in ms."
+)
+@click.option(
+    "--timing_statistic",
+    type=click.Choice(TIMING_STATISTICS),
+    default="mean",
+    help="Statistic of measured layer latency to plan with.",
+)
+@click.option(
+    "--simulate",
+    is_flag=True,
+    help="Also simulate the chosen instantiation with the pipeline simulator.",
+)
+def main(
+    profile_path: Path,
+    num_nodes: list[int],
+    global_batch_size: int,
+    fault_tolerance_threshold: int,
+    device_memory: int | None,
+    inter_node_bandwidth: float | None,
+    inter_node_latency: float,
+    timing_statistic: str,
+    simulate: bool,
+):
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    planner = CapacityPlanner.from_profile(
+        profile_path,
+        timing_statistic=timing_statistic,
+        global_batch_size=global_batch_size,
+        fault_tolerance_threshold=fault_tolerance_threshold,
+        device_memory=device_memory,
+        inter_node_bandwidth=inter_node_bandwidth,
+        inter_node_latency=inter_node_latency,
+    )
+
+    header = (
+        f"{'nodes':>5} {'iteration (ms)':>14} {'samples/s':>10} {'marginal/node':>13}"
+    )
+    if simulate:
+        header += f" {'simulated (ms)':>14}"
+    print(header + " templates")
+
+    previous: WhatIfResult | None = None
+    for n in num_nodes:
+        result = planner.predict(n, simulate=simulate)
+        if result.error is not None:
+            print(f"{n:>5} infeasible: {result.error}")
+            continue
+
+        # Throughput gained per node added since the previous feasible number of nodes
+        marginal = (
+            f"{(result.samples_per_second - previous.samples_per_second) / (n - previous.num_nodes):>13.2f}"
+            if previous is not None
+            and result.samples_per_second is not None
+            and previous.samples_per_second is not None
+            else f"{'-':>13}"
+        )
+        samples_per_second = (
+            f"{result.samples_per_second:>10.2f}"
+            if result.samples_per_second is not None
+            else f"{'-':>10}"
+        )
+        line = f"{n:>5} {result.iteration_time:>14.2f} {samples_per_second} {marginal}"
+        if simulate:
+            line += f" {result.simulated_iteration_time:>14.2f}"
+        print(f"{line} {result.template_mix}")
+        previous = result
+
+
+if __name__ == "__main__":
+    main()
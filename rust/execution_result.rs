@@ -2,7 +2,6 @@ use pyo3::conversion::FromPyObject;
 use serde::{Deserialize, Serialize};
 use std::clone::Clone;
 use std::cmp::{Ordering, PartialEq};
-use std::sync::Arc;
 
 #[derive(Serialize, Deserialize)]
 pub struct ProfileResult {
@@ -38,6 +37,9 @@ pub struct LayerExecutionResult {
     pub forward: f64,
     pub backward: f64,
     pub mem_required: u64,
+    // Size of the output activation of the layer in bytes.
+    #[serde(default)]
+    pub activation_bytes: u64,
 }
 
 impl<'source> FromPyObject<'source> for LayerExecutionResult {
@@ -47,75 +49,155 @@ impl<'source> FromPyObject<'source> for LayerExecutionResult {
         let forward: f64 = ob.getattr("forward")?.extract()?;
         let backward: f64 = ob.getattr("backward")?.extract()?;
         let mem_required: u64 = ob.getattr("mem_required")?.extract()?;
+        let activation_bytes: u64 = ob.getattr("activation_bytes")?.extract()?;
         Ok(LayerExecutionResult {
             layer_index,
             layer_name,
             forward,
             backward,
             mem_required,
+            activation_bytes,
         })
     }
 }
 
-pub struct StageExecutionResult {
-    pub layers: (u32, u32),
-    forward: f64,
-    backward: f64,
-    mem_required: u64,
+/// Point-to-point communication cost between two adjacent stages.
+#[derive(Clone, Copy)]
+pub struct CommunicationCost {
+    /// Bandwidth in Gbps.
+    pub bandwidth: f64,
+    /// Latency in ms.
+    pub latency: f64,
 }
 
-impl StageExecutionResult {
+impl CommunicationCost {
+    /// Time in ms to transfer `bytes` bytes.
+    pub fn transfer_time(&self, bytes: u64) -> f64 {
+        self.latency + bytes as f64 * 8.0 / (self.bandwidth * 1e6)
+    }
+}
+
+/// Prefix sums of layer execution results.
+///
+/// Costs of a stage that consists of layers `[i, j)` are computed in O(1)
+/// without summing up every layer of the stage.
+pub struct LayerExecutionPrefixSums {
+    forward: Vec<f64>,
+    backward: Vec<f64>,
+    mem_required: Vec<u64>,
+    activation_bytes: Vec<u64>,
+}
+
+impl LayerExecutionPrefixSums {
     pub fn new(layers: &[LayerExecutionResult]) -> Self {
-        let mut forward = 0.0;
-        let mut backward = 0.0;
-        let mut mem_required = 0;
-
-        for layer in layers {
-            forward += layer.forward;
-            backward += layer.backward;
-            mem_required += layer.mem_required;
+        let mut forward = vec![0.0; layers.len() + 1];
+        let mut backward = vec![0.0; layers.len() + 1];
+        let mut mem_required = vec![0; layers.len() + 1];
+
+        for (index, layer) in layers.iter().enumerate() {
+            forward[index + 1] = forward[index] + layer.forward;
+            backward[index + 1] = backward[index] + layer.backward;
+            mem_required[index + 1] = mem_required[index] + layer.mem_required;
         }
 
-        StageExecutionResult {
-            layers: (
-                layers[0].layer_index,
-                layers[layers.len() - 1].layer_index + 1,
-            ),
+        LayerExecutionPrefixSums {
             forward,
             backward,
             mem_required,
+            activation_bytes: layers.iter().map(|layer| layer.activation_bytes).collect(),
         }
     }
 
+    pub fn num_layers(&self) -> usize {
+        self.forward.len() - 1
+    }
+
+    /// Execution result of a stage with layers `[start, end)`.
+    pub fn stage(&self, start: usize, end: usize) -> StageExecutionResult {
+        StageExecutionResult {
+            layers: (start as u32, end as u32),
+            forward: self.forward[end] - self.forward[start],
+            backward: self.backward[end] - self.backward[start],
+            mem_required: self.mem_required[end] - self.mem_required[start],
+        }
+    }
+
+    /// Add time of sending activations to the next stage in forward pass
+    /// and sending gradients to the previous stage in backward pass to the stage.
+    pub fn add_communication(
+        &self,
+        mut stage: StageExecutionResult,
+        communication: &CommunicationCost,
+    ) -> StageExecutionResult {
+        let (start, end) = (stage.layers.0 as usize, stage.layers.1 as usize);
+        if end < self.num_layers() {
+            stage.forward += communication.transfer_time(self.activation_bytes[end - 1]);
+        }
+        if start > 0 {
+            stage.backward += communication.transfer_time(self.activation_bytes[start - 1]);
+        }
+        stage
+    }
+}
+
+#[derive(Clone, Copy)]
+pub struct StageExecutionResult {
+    pub layers: (u32, u32),
+    forward: f64,
+    backward: f64,
+    mem_required: u64,
+}
+
+impl StageExecutionResult {
     pub fn latency(&self) -> f64 {
         self.forward + self.backward
     }
+    /// Execution result of the stage on a node that is `speed` times
+    /// as fast as the node that the layers are profiled on.
+    pub fn on_node(&self, speed: f64) -> Self {
+        StageExecutionResult {
+            forward: self.forward / speed,
+            backward: self.backward / speed,
+            ..*self
+        }
+    }
+    pub fn mem_required(&self) -> u64 {
+        self.mem_required
+    }
 }
 
-#[derive(Clone)]
+/// Summary of the best pipeline for a subproblem of the planner.
+///
+/// Stages themselves are not stored; the planner keeps back-pointers
+/// instead and rebuilds stages only for the final pipeline templates.
+/// Only the information that is needed to merge two subproblems is kept.
+#[derive(Clone, Copy)]
 pub struct PipelineExecutionResult {
-    pub stages: Vec<Arc<StageExecutionResult>>,
+    pub num_stages: u32,
     pub t1: f64,
     pub t2: f64,
     pub t3: f64,
     pub kstar: usize,
+    pub kstar_latency: f64,
+    mem_required: u64,
+    // The number of microbatches that the pipeline is optimized for.
+    num_microbatches: u32,
 }
 
 impl PipelineExecutionResult {
     pub fn new(left: &PipelineExecutionResult, right: &PipelineExecutionResult) -> Self {
-        let mut stages = left.stages.clone();
-        stages.extend(right.stages.clone());
+        let num_stages = left.num_stages + right.num_stages;
 
         let t1 = left.t1 + right.t1;
 
-        let kstar = if left.stages[left.kstar].latency() > right.stages[right.kstar].latency() {
-            left.kstar
+        let (kstar, kstar_latency) = if left.kstar_latency > right.kstar_latency {
+            (left.kstar, left.kstar_latency)
         } else {
-            left.stages.len() + right.kstar
+            (left.num_stages as usize + right.kstar, right.kstar_latency)
         };
 
-        let num_microbatches = 4 * stages.len();
-        let t2 = (num_microbatches - stages.len() + kstar - 1) as f64 * stages[kstar].latency();
+        let num_microbatches = 4 * num_stages as usize;
+        let t2 = (num_microbatches - num_stages as usize + kstar - 1) as f64 * kstar_latency;
 
         let t3 = if kstar == left.kstar {
             left.t3 + right.t1
@@ -124,21 +206,27 @@ impl PipelineExecutionResult {
         };
 
         PipelineExecutionResult {
-            stages,
+            num_stages,
             t1,
             t2,
             t3,
             kstar,
+            kstar_latency,
+            mem_required: left.mem_required + right.mem_required,
+            num_microbatches: left.num_microbatches,
         }
     }
-    pub fn make_base_result(stage: Arc<StageExecutionResult>) -> Self {
+    pub fn make_base_result(stage: &StageExecutionResult, num_microbatches: u32) -> Self {
         let latency = stage.latency();
         PipelineExecutionResult {
-            stages: vec![stage],
+            num_stages: 1,
             t1: latency,
             t2: 2.0 * (latency),
             t3: latency,
             kstar: 0,
+            kstar_latency: latency,
+            mem_required: stage.mem_required,
+            num_microbatches,
         }
     }
     pub fn latency_with_mb(&self, mb: u32) -> f64 {
@@ -148,32 +236,24 @@ impl PipelineExecutionResult {
         self.t1
             + self.t2
             + self.t3
-            + (((mb as i32) - (4 * self.stages.len() as i32)) as f64)
-                * self.stages[self.kstar].latency()
+            + (((mb as i32) - (4 * self.num_stages as i32)) as f64) * self.kstar_latency
     }
     pub fn latency(&self) -> f64 {
         self.t1 + self.t2 + self.t3
     }
-    pub fn mem_required(&self) -> u64 {
-        self.stages.iter().fold(0, |acc, x| acc + x.mem_required)
+    /// Latency with the number of microbatches that the pipeline is optimized for.
+    /// A pipeline cannot have fewer microbatches than its stages.
+    pub fn objective(&self) -> f64 {
+        self.latency_with_mb(self.num_microbatches.max(self.num_stages))
     }
-    pub fn get_modules_per_stage(&self, layers: &Vec<LayerExecutionResult>) -> Vec<Vec<String>> {
-        let mut modules_per_stage: Vec<Vec<String>> = Vec::new();
-        for stage in &self.stages {
-            let mut modules: Vec<String> = Vec::new();
-            for layer in &layers[stage.layers.0 as usize..stage.layers.1 as usize] {
-                modules.push(layer.layer_name.clone());
-            }
-            modules_per_stage.push(modules);
-        }
-        modules_per_stage
+    pub fn mem_required(&self) -> u64 {
+        self.mem_required
     }
 }
 
 impl PartialEq for PipelineExecutionResult {
     fn eq(&self, other: &Self) -> bool {
-        self.latency_with_mb(128) == other.latency_with_mb(128)
-            && self.mem_required() == other.mem_required()
+        self.objective() == other.objective() && self.mem_required() == other.mem_required()
     }
 }
 
@@ -184,9 +264,9 @@ impl Ord for PipelineExecutionResult {
         if self == other {
             Ordering::Equal
         } else {
-            if self.latency_with_mb(128) < other.latency_with_mb(128) {
+            if self.objective() < other.objective() {
                 Ordering::Less
-            } else if self.latency_with_mb(128) > other.latency_with_mb(128) {
+            } else if self.objective() > other.objective() {
                 Ordering::Greater
             } else {
                 if self.mem_required() < other.mem_required() {
@@ -204,3 +284,32 @@ impl PartialOrd for PipelineExecutionResult {
         Some(self.cmp(other))
     }
 }
+
+/// A pipeline template planned by the generator, with its stages rebuilt.
+pub struct PipelineTemplateResult {
+    pub stages: Vec<StageExecutionResult>,
+    pub execution_result: PipelineExecutionResult,
+}
+
+impl PipelineTemplateResult {
+    pub fn latency(&self) -> f64 {
+        self.execution_result.latency()
+    }
+    pub fn kstar_latency(&self) -> f64 {
+        self.execution_result.kstar_latency
+    }
+    pub fn mem_required(&self) -> u64 {
+        self.execution_result.mem_required()
+    }
+    pub fn get_modules_per_stage(&self, layers: &Vec<LayerExecutionResult>) -> Vec<Vec<String>> {
+        let mut modules_per_stage: Vec<Vec<String>> = Vec::new();
+        for stage in &self.stages {
+            let mut modules: Vec<String> = Vec::new();
+            for layer in &layers[stage.layers.0 as usize..stage.layers.1 as usize] {
+                modules.push(layer.layer_name.clone());
+            }
+            modules_per_stage.push(modules);
+        }
+        modules_per_stage
+    }
+}
@@ -1,4 +1,5 @@
-use crate::pipeline_template_generator::PipelineTemplateGenerator;
+use crate::execution_result::{CommunicationCost, PipelineTemplateResult};
+use crate::pipeline_template_generator::{PipelineTemplateGenerator, PlannerOptions};
 mod execution_result;
 mod pipeline_template_generator;
 use env_logger;
@@ -33,48 +34,233 @@ impl From<PlannerError> for PyErr {
     }
 }
 
+fn to_py_template(
+    py: Python,
+    class: &PyObject,
+    model_name: &str,
+    generator: &PipelineTemplateGenerator,
+    result: &PipelineTemplateResult,
+) -> PyResult<PyObject> {
+    let py_template = class.call1(
+        py,
+        (
+            model_name,
+            result.get_modules_per_stage(&generator.layer_execution_results),
+            result.latency(),
+            result.kstar_latency(),
+            result.mem_required(),
+        ),
+    )?;
+    py_template.setattr(
+        py,
+        "mem_required_per_stage",
+        result
+            .stages
+            .iter()
+            .map(|stage| stage.mem_required())
+            .collect::<Vec<u64>>(),
+    )?;
+    Ok(py_template)
+}
+
+fn get_pipeline_templates(
+    py: Python,
+    model_name: &str,
+    generator: &PipelineTemplateGenerator,
+    num_nodes: Vec<u32>,
+) -> PyResult<Py<PyDict>> {
+    let results = PyDict::new_bound(py);
+
+    let module = PyModule::import_bound(py, "cornstarch.pipeline_template")?;
+    let class = module.getattr("PipelineTemplate")?.into_py(py);
+
+    for num_node in num_nodes {
+        // All templates up to the maximum number of nodes are planned,
+        // thus an error here means that no template is feasible for the number of nodes.
+        let result = match generator.get_pipeline_template(num_node) {
+            Ok(result) => result,
+            Err(error) => {
+                log::info!("{}", error);
+                continue;
+            }
+        };
+
+        let py_template = to_py_template(py, &class, model_name, generator, &result)?;
+        results.set_item(result.stages.len(), py_template)?;
+    }
+
+    Ok(results.into())
+}
+
+fn get_planner_options(
+    device_memory: Option<u64>,
+    num_microbatches: Option<u32>,
+    inter_node_bandwidth: Option<f64>,
+    inter_node_latency: f64,
+) -> PlannerOptions {
+    PlannerOptions {
+        device_memory,
+        num_microbatches,
+        communication: inter_node_bandwidth.map(|bandwidth| CommunicationCost {
+            bandwidth,
+            latency: inter_node_latency,
+        }),
+    }
+}
+
 #[pyfunction]
+#[pyo3(signature = (
+    model_name,
+    profile_data,
+    num_nodes,
+    device_memory=None,
+    num_microbatches=None,
+    inter_node_bandwidth=None,
+    inter_node_latency=0.0
+))]
 fn create_pipeline_templates(
+    py: Python<'_>,
     model_name: String,
     profile_data: Vec<execution_result::LayerExecutionResult>,
     mut num_nodes: Vec<u32>,
+    device_memory: Option<u64>,
+    num_microbatches: Option<u32>,
+    inter_node_bandwidth: Option<f64>,
+    inter_node_latency: f64,
 ) -> PyResult<Py<PyDict>> {
     num_nodes.sort();
 
-    let mut generator = PipelineTemplateGenerator::new(profile_data);
-    generator.divide_and_conquer(num_nodes[num_nodes.len() - 1])?;
-
-    Python::with_gil(|py| {
-        let results = PyDict::new_bound(py);
-
-        let module = PyModule::import_bound(py, "cornstarch.pipeline_template")?;
-        let class = module.getattr("PipelineTemplate")?.into_py(py);
-
-        for num_node in num_nodes {
-            let result = generator.get_pipeline_template(num_node).unwrap();
-            let py_template = class
-                .call1(
-                    py,
-                    (
-                        model_name.as_str(),
-                        result.get_modules_per_stage(&generator.layer_execution_results),
-                        result.latency(),
-                        result.stages[result.kstar].latency(),
-                        result.mem_required(),
-                    ),
-                )?
-                .to_object(py);
-            results.set_item(result.stages.len(), py_template)?;
+    let mut generator = PipelineTemplateGenerator::new(
+        profile_data,
+        get_planner_options(
+            device_memory,
+            num_microbatches,
+            inter_node_bandwidth,
+            inter_node_latency,
+        ),
+    );
+    // Planning does not touch Python objects. Release the GIL so that
+    // templates for different inputs can be planned in parallel from threads.
+    let max_num_nodes = num_nodes[num_nodes.len() - 1];
+    py.allow_threads(|| generator.divide_and_conquer(max_num_nodes))?;
+
+    get_pipeline_templates(py, &model_name, &generator, num_nodes)
+}
+
+/// Create a pipeline template whose stages are placed on nodes with the given speeds.
+///
+/// `node_speeds[k]` is the relative speed of the node that runs the `k`-th stage.
+#[pyfunction]
+#[pyo3(signature = (
+    model_name,
+    profile_data,
+    node_speeds,
+    device_memory=None,
+    num_microbatches=None,
+    inter_node_bandwidth=None,
+    inter_node_latency=0.0
+))]
+fn create_pipeline_template_for_node_speeds(
+    py: Python<'_>,
+    model_name: String,
+    profile_data: Vec<execution_result::LayerExecutionResult>,
+    node_speeds: Vec<f64>,
+    device_memory: Option<u64>,
+    num_microbatches: Option<u32>,
+    inter_node_bandwidth: Option<f64>,
+    inter_node_latency: f64,
+) -> PyResult<PyObject> {
+    let generator = PipelineTemplateGenerator::new(
+        profile_data,
+        get_planner_options(
+            device_memory,
+            num_microbatches,
+            inter_node_bandwidth,
+            inter_node_latency,
+        ),
+    );
+    let result = py.allow_threads(|| generator.plan_for_node_speeds(&node_speeds))?;
+
+    let module = PyModule::import_bound(py, "cornstarch.pipeline_template")?;
+    let class = module.getattr("PipelineTemplate")?.into_py(py);
+    let py_template = to_py_template(py, &class, &model_name, &generator, &result)?;
+    py_template.setattr(py, "node_speeds", node_speeds)?;
+    Ok(py_template)
+}
+
+/// A pipeline template generator that is kept alive across planning requests.
+///
+/// Planning results are cached in the generator, so that requesting templates
+/// for more nodes only computes results for the number of stages
+/// that have not been planned yet.
+#[pyclass(name = "PipelineTemplateGenerator")]
+struct PyPipelineTemplateGenerator {
+    model_name: String,
+    generator: PipelineTemplateGenerator,
+}
+
+#[pymethods]
+impl PyPipelineTemplateGenerator {
+    #[new]
+    #[pyo3(signature = (
+        model_name,
+        profile_data,
+        device_memory=None,
+        num_microbatches=None,
+        inter_node_bandwidth=None,
+        inter_node_latency=0.0
+    ))]
+    fn new(
+        model_name: String,
+        profile_data: Vec<execution_result::LayerExecutionResult>,
+        device_memory: Option<u64>,
+        num_microbatches: Option<u32>,
+        inter_node_bandwidth: Option<f64>,
+        inter_node_latency: f64,
+    ) -> Self {
+        PyPipelineTemplateGenerator {
+            model_name,
+            generator: PipelineTemplateGenerator::new(
+                profile_data,
+                get_planner_options(
+                    device_memory,
+                    num_microbatches,
+                    inter_node_bandwidth,
+                    inter_node_latency,
+                ),
+            ),
         }
+    }
+
+    #[getter]
+    fn max_num_nodes(&self) -> u32 {
+        self.generator.max_num_nodes()
+    }
+
+    fn create_pipeline_templates(
+        &mut self,
+        py: Python<'_>,
+        mut num_nodes: Vec<u32>,
+    ) -> PyResult<Py<PyDict>> {
+        num_nodes.sort();
 
-        Ok(results.into())
-    })
+        let max_num_nodes = num_nodes[num_nodes.len() - 1];
+        let generator = &mut self.generator;
+        py.allow_threads(|| generator.divide_and_conquer(max_num_nodes))?;
+
+        get_pipeline_templates(py, &self.model_name, &self.generator, num_nodes)
+    }
 }
 
 #[pymodule]
 fn planner(_py: Python, m: &Bound<'_, PyModule>) -> PyResult<()> {
     let _ = env_logger::try_init();
     m.add_function(wrap_pyfunction!(create_pipeline_templates, m)?)?;
+    m.add_function(wrap_pyfunction!(
+        create_pipeline_template_for_node_speeds,
+        m
+    )?)?;
+    m.add_class::<PyPipelineTemplateGenerator>()?;
     Ok(())
 }
 
@@ -108,6 +294,7 @@ mod test {
                 } else {
                     (i + 1) as u64
                 },
+                activation_bytes: 0,
             });
         }
 
@@ -124,7 +311,19 @@ mod test {
 
         let model_name = "gpt2".to_string();
 
-        create_pipeline_templates(model_name, layer_results, num_nodes).unwrap();
+        Python::with_gil(|py| {
+            create_pipeline_templates(
+                py,
+                model_name,
+                layer_results,
+                num_nodes,
+                None,
+                None,
+                None,
+                0.0,
+            )
+            .unwrap();
+        });
 
         // let py = Python::acquire_gil();
         // let py_result = result.extract::<PyList>(py).unwrap();
@@ -1,184 +1,326 @@
 use crate::execution_result::*;
 use crate::PlannerError;
-use dashmap::DashMap;
 use log;
 use rayon::prelude::*;
 use std::cmp::Ordering;
 use std::result::Result;
-use std::sync::Arc;
+
+/// Options that change how pipeline templates are planned.
+#[derive(Clone, Default)]
+pub struct PlannerOptions {
+    /// Memory available in a single device in bytes.
+    /// A stage that requires more memory than this is infeasible.
+    pub device_memory: Option<u64>,
+    /// The expected number of microbatches per pipeline.
+    /// Templates are optimized for this number of microbatches.
+    pub num_microbatches: Option<u32>,
+    /// Cost of transferring activations and gradients between stages.
+    /// If None, communication between stages is considered free.
+    pub communication: Option<CommunicationCost>,
+}
+
+impl PlannerOptions {
+    const DEFAULT_NUM_MICROBATCHES: u32 = 128;
+
+    fn num_microbatches(&self) -> u32 {
+        self.num_microbatches
+            .unwrap_or(Self::DEFAULT_NUM_MICROBATCHES)
+    }
+}
+
+/// An entry of the dynamic programming table.
+#[derive(Clone, Copy)]
+struct PlanEntry {
+    result: PipelineExecutionResult,
+    // Back-pointer to the subproblems that this result is merged from:
+    // (layer index where the pipeline is split, number of stages on the left).
+    // None for a single stage pipeline.
+    split: Option<(usize, u32)>,
+}
 
 pub struct PipelineTemplateGenerator {
     pub layer_execution_results: Vec<LayerExecutionResult>,
-    // Key: (layer_start_index, layer_end_index)
-    stage_execution_results: DashMap<(usize, usize), Arc<StageExecutionResult>>,
-    // Key: (num_stages, layer_start_index, layer_end_index)
-    execution_result_cache: DashMap<(u32, usize, usize), Result<PipelineExecutionResult, String>>,
+    options: PlannerOptions,
+    prefix_sums: LayerExecutionPrefixSums,
+    // Dense dynamic programming table.
+    // Index: [num_stages - 1][index of (layer_start_index, layer_end_index)]
+    // None if the subproblem is infeasible.
+    plan_entries: Vec<Vec<Option<PlanEntry>>>,
 }
 
 impl PipelineTemplateGenerator {
-    pub fn new(profile_data: Vec<LayerExecutionResult>) -> Self {
+    pub fn new(profile_data: Vec<LayerExecutionResult>, options: PlannerOptions) -> Self {
+        let prefix_sums = LayerExecutionPrefixSums::new(&profile_data);
         PipelineTemplateGenerator {
             layer_execution_results: profile_data,
-            stage_execution_results: DashMap::new(),
-            execution_result_cache: DashMap::new(),
+            options,
+            prefix_sums,
+            plan_entries: Vec::new(),
         }
     }
 
-    pub fn divide_and_conquer(&mut self, max_num_nodes: u32) -> Result<(), PlannerError> {
-        if !self.stage_execution_results.is_empty() {
-            return Ok(());
+    pub fn max_num_nodes(&self) -> u32 {
+        self.plan_entries.len() as u32
+    }
+
+    /// Index of layers `[start, end)` in a flattened upper triangular matrix.
+    fn entry_index(&self, start: usize, end: usize) -> usize {
+        let num_layers = self.prefix_sums.num_layers();
+        start * (2 * num_layers - start + 1) / 2 + (end - start - 1)
+    }
+
+    /// Execution result of a stage with layers `[start, end)`.
+    fn stage(&self, start: usize, end: usize) -> StageExecutionResult {
+        self.stage_on_node(start, end, 1.0)
+    }
+
+    /// Execution result of a stage with layers `[start, end)` on a node
+    /// that is `speed` times as fast as the profiled one.
+    /// Communication between stages is not affected by the node speed.
+    fn stage_on_node(&self, start: usize, end: usize, speed: f64) -> StageExecutionResult {
+        let stage = self.prefix_sums.stage(start, end).on_node(speed);
+        match &self.options.communication {
+            Some(communication) => self.prefix_sums.add_communication(stage, communication),
+            None => stage,
         }
+    }
+
+    /// A single stage pipeline with layers `[start, end)` on a node with `speed`.
+    /// None if the stage does not fit in a device.
+    fn base_result(&self, start: usize, end: usize, speed: f64) -> Option<PipelineExecutionResult> {
+        let stage = self.stage_on_node(start, end, speed);
 
+        // A stage that does not fit in a device is infeasible
+        if let Some(device_memory) = self.options.device_memory {
+            if stage.mem_required() > device_memory {
+                return None;
+            }
+        }
+
+        Some(PipelineExecutionResult::make_base_result(
+            &stage,
+            self.options.num_microbatches(),
+        ))
+    }
+
+    fn get_entry(&self, num_stages: u32, start: usize, end: usize) -> Option<&PlanEntry> {
+        self.plan_entries[num_stages as usize - 1][self.entry_index(start, end)].as_ref()
+    }
+
+    /// Fill the table with results for up to `max_num_nodes` stages.
+    ///
+    /// The generator can be reused with a larger `max_num_nodes`;
+    /// only results for the number of stages that are not yet
+    /// in the table are computed.
+    pub fn divide_and_conquer(&mut self, max_num_nodes: u32) -> Result<(), PlannerError> {
         let num_layers = self.layer_execution_results.len();
 
         if max_num_nodes as usize > num_layers {
             return Err(PlannerError::new("Invalid number of nodes"));
         }
 
-        // Put all base cases in the cache
-        (0..num_layers).into_par_iter().for_each(|i| {
-            ((i + 1)..=num_layers).into_par_iter().for_each(|j| {
-                let stage_execution_result = Arc::new(StageExecutionResult::new(
-                    &self.layer_execution_results[i..j],
-                ));
-                log::debug!(
-                    "StageExecutionResult({}, {})  -> {}",
-                    stage_execution_result.layers.0,
-                    stage_execution_result.layers.1,
-                    stage_execution_result.latency()
-                );
-                self.stage_execution_results
-                    .insert((i, j), stage_execution_result.clone());
-
-                let pipeline_execution_result =
-                    PipelineExecutionResult::make_base_result(stage_execution_result);
-                log::debug!(
-                    "PipelineExecutionResult({}, {}, {}) -> {}",
-                    1,
-                    i,
-                    j,
-                    pipeline_execution_result.latency()
-                );
-                self.execution_result_cache
-                    .insert((1, i, j), Ok(pipeline_execution_result));
+        // Compute results, gradually increasing the number of stages
+        // Number of stages can increase up to the number of nodes
+        // (currently more than two stages cannot be assigned to a node)
+        // Each number of stages all computations should be done before moving on to the next number of stages
+        for num_stages in (self.max_num_nodes() + 1)..=max_num_nodes {
+            let entries: Vec<Option<PlanEntry>> = (0..num_layers)
+                .into_par_iter()
+                .map(|i| {
+                    ((i + 1)..=num_layers)
+                        .map(|j| self.compute_entry(num_stages, i, j))
+                        .collect::<Vec<_>>()
+                })
+                .collect::<Vec<_>>()
+                .concat();
+            self.plan_entries.push(entries);
+        }
+        Ok(())
+    }
+
+    fn compute_entry(&self, num_stages: u32, i: usize, j: usize) -> Option<PlanEntry> {
+        if num_stages == 1 {
+            let result = self.base_result(i, j, 1.0)?;
+            log::debug!(
+                "PipelineExecutionResult({}, {}, {}) -> {}",
+                1,
+                i,
+                j,
+                result.latency()
+            );
+            return Some(PlanEntry {
+                result,
+                split: None,
             });
-        });
+        }
 
-        log::debug!("Base cases inserted into the cache");
+        // If number of layers is less than number of stages, skip it
+        // Cannot create specified number of stages with the given number of layers
+        if j - i < num_stages as usize {
+            return None;
+        }
 
-        // Compute the rest of the results, gradually increasing the number of stages
-        // Number of stages can increase from 2 up to the number of nodes
-        // (currently more than two stages cannot be assigned to a node)
-        // Each number of stages all computations should be done before moving on to the next number of stages
-        for num_stages in 2..=max_num_nodes as u32 {
-            (0..num_layers).into_par_iter().for_each(|i| {
-                ((i + 1)..=num_layers).into_par_iter().for_each(|j| {
-                    let key = (num_stages, i, j);
-
-                    // If number of layers is less than number of stages, skip it
-                    // Cannot create specified number of stages with the given number of layers
-                    if j - i < num_stages as usize {
-                        self.execution_result_cache
-                            .insert(key, Err("Infeasible case".to_string()));
-                        return;
+        let mut best_entry: Option<PlanEntry> = None;
+        for num_layers_left in (i + 1)..j {
+            for num_stages_left in 1..num_stages {
+                let num_stages_right = num_stages - num_stages_left;
+
+                // As we gradually increase the number of stages from 1,
+                // we must have already computed the results for the subproblems
+                let (left, right) = match (
+                    self.get_entry(num_stages_left, i, num_layers_left),
+                    self.get_entry(num_stages_right, num_layers_left, j),
+                ) {
+                    (Some(left), Some(right)) => (left, right),
+                    _ => continue,
+                };
+
+                // Merge two subproblems into a bigger PipelineExecutionResult
+                let local_result = PipelineExecutionResult::new(&left.result, &right.result);
+                if best_entry.is_none()
+                    || local_result.cmp(&best_entry.unwrap().result) == Ordering::Less
+                {
+                    best_entry = Some(PlanEntry {
+                        result: local_result,
+                        split: Some((num_layers_left, num_stages_left)),
+                    });
+                }
+            }
+        }
+
+        log::debug!(
+            "PipelineExecutionResult({}, {}, {}) -> {}",
+            num_stages,
+            i,
+            j,
+            if let Some(entry) = best_entry {
+                entry.result.latency()
+            } else {
+                0.0
+            }
+        );
+        best_entry
+    }
+
+    /// Rebuild stages of a subproblem result by following back-pointers.
+    fn rebuild_stages(
+        &self,
+        num_stages: u32,
+        start: usize,
+        end: usize,
+        stages: &mut Vec<StageExecutionResult>,
+    ) {
+        match self.get_entry(num_stages, start, end).unwrap().split {
+            None => stages.push(self.stage(start, end)),
+            Some((num_layers_left, num_stages_left)) => {
+                self.rebuild_stages(num_stages_left, start, num_layers_left, stages);
+                self.rebuild_stages(num_stages - num_stages_left, num_layers_left, end, stages);
+            }
+        }
+    }
+
+    /// Plan a pipeline whose stages are placed on nodes with the given speeds in order.
+    ///
+    /// Unlike templates from `divide_and_conquer()`, stages are not interchangeable;
+    /// `node_speeds[k]` is the speed of the node that runs the `k`-th stage,
+    /// relative to the node that the layers are profiled on.
+    /// Slower nodes get fewer layers.
+    pub fn plan_for_node_speeds(
+        &self,
+        node_speeds: &[f64],
+    ) -> Result<PipelineTemplateResult, PlannerError> {
+        let num_layers = self.layer_execution_results.len();
+        let num_stages = node_speeds.len();
+
+        if num_stages == 0 || num_stages > num_layers {
+            return Err(PlannerError::new("Invalid number of nodes"));
+        }
+        if node_speeds.iter().any(|speed| *speed <= 0.0) {
+            return Err(PlannerError::new("Node speed must be positive"));
+        }
+
+        // entries[k][j]: the best pipeline of the first k + 1 stages with layers [0, j),
+        // and the layer index where its last stage starts.
+        let mut entries: Vec<Vec<Option<(PipelineExecutionResult, usize)>>> =
+            vec![vec![None; num_layers + 1]; num_stages];
+        for j in 1..=num_layers {
+            entries[0][j] = self
+                .base_result(0, j, node_speeds[0])
+                .map(|result| (result, 0));
+        }
+        for k in 1..num_stages {
+            for j in (k + 1)..=num_layers {
+                for i in k..j {
+                    let (left, right) =
+                        match (entries[k - 1][i], self.base_result(i, j, node_speeds[k])) {
+                            (Some((left, _)), Some(right)) => (left, right),
+                            _ => continue,
+                        };
+
+                    let local_result = PipelineExecutionResult::new(&left, &right);
+                    if entries[k][j].is_none()
+                        || local_result.cmp(&entries[k][j].unwrap().0) == Ordering::Less
+                    {
+                        entries[k][j] = Some((local_result, i));
                     }
+                }
+            }
+        }
 
-                    // Spawn a task to compute the result for this subproblem.
-                    let best_result = (i..j)
-                        .into_par_iter()
-                        .map(|num_layers_left| {
-                            let mut result: Result<PipelineExecutionResult, String> =
-                                Err("Error in subproblem".to_string());
-
-                            for num_stages_left in 1..num_stages {
-                                let num_stages_right = num_stages - num_stages_left;
-
-                                if num_layers_left - i == 0 || j - num_layers_left == 0 {
-                                    continue;
-                                }
-
-                                // As we gradually increase the number of stages from 1,
-                                // we must have already computed the results for the subproblems
-                                let left = self
-                                    .execution_result_cache
-                                    .get(&(num_stages_left, i, num_layers_left))
-                                    .unwrap();
-                                let right = self
-                                    .execution_result_cache
-                                    .get(&(num_stages_right, num_layers_left, j))
-                                    .unwrap();
-
-                                if left.is_err() || right.is_err() {
-                                    continue;
-                                }
-
-                                // Merge two subproblems into a bigger PipelineExecutionResult
-                                let local_result = PipelineExecutionResult::new(
-                                    left.as_ref().unwrap(),
-                                    right.as_ref().unwrap(),
-                                );
-                                if result.is_err()
-                                    || local_result.cmp(result.as_ref().unwrap()) == Ordering::Less
-                                {
-                                    result = Ok(local_result);
-                                }
-                            }
-
-                            result
-                        })
-                        .reduce(
-                            || Err("Error in subproblem".to_string()),
-                            |acc, result| {
-                                if result.is_err() {
-                                    return acc;
-                                } else if acc.is_err() {
-                                    return result;
-                                } else if result.as_ref().unwrap() < acc.as_ref().unwrap() {
-                                    return result;
-                                } else {
-                                    return acc;
-                                }
-                            },
-                        );
-
-                    log::debug!(
-                        "PipelineExecutionResult({}, {}, {}) -> {}",
-                        num_stages,
-                        i,
-                        j,
-                        if best_result.is_ok() {
-                            best_result.as_ref().unwrap().latency()
-                        } else {
-                            0.0
-                        }
-                    );
-                    self.execution_result_cache.insert(key, best_result);
-                })
-            });
+        let execution_result = match entries[num_stages - 1][num_layers] {
+            Some((result, _)) => result,
+            None => {
+                return Err(PlannerError::new(
+                    format!("No feasible pipeline template for {} nodes", num_stages).as_str(),
+                ))
+            }
+        };
+
+        let mut stages = Vec::with_capacity(num_stages);
+        let mut end = num_layers;
+        for k in (0..num_stages).rev() {
+            let start = entries[k][end].unwrap().1;
+            stages.push(self.stage_on_node(start, end, node_speeds[k]));
+            end = start;
         }
-        Ok(())
+        stages.reverse();
+
+        Ok(PipelineTemplateResult {
+            stages,
+            execution_result,
+        })
     }
 
     pub fn get_pipeline_template(
         &self,
         num_nodes: u32,
-    ) -> Result<PipelineExecutionResult, PlannerError> {
+    ) -> Result<PipelineTemplateResult, PlannerError> {
+        let num_layers = self.layer_execution_results.len();
         log::debug!(
             "get_pipeline_template({}, {}, {})",
             num_nodes,
             0,
-            self.layer_execution_results.len()
+            num_layers
         );
 
-        let result =
-            self.execution_result_cache
-                .get(&(num_nodes, 0, self.layer_execution_results.len()));
+        if num_nodes == 0 || num_nodes > self.max_num_nodes() {
+            return Err(PlannerError::new(
+                format!("No pipeline template for {} nodes", num_nodes).as_str(),
+            ));
+        }
 
-        match result {
-            Some(result) => Ok(result.value().clone().unwrap()),
+        match self.get_entry(num_nodes, 0, num_layers) {
+            Some(entry) => {
+                let mut stages = Vec::with_capacity(num_nodes as usize);
+                self.rebuild_stages(num_nodes, 0, num_layers, &mut stages);
+                Ok(PipelineTemplateResult {
+                    stages,
+                    execution_result: entry.result,
+                })
+            }
             None => Err(PlannerError::new(
-                format!("No pipeline template for {} nodes", num_nodes).as_str(),
-            ))?,
+                format!("No feasible pipeline template for {} nodes", num_nodes).as_str(),
+            )),
         }
     }
 }
@@ -188,9 +330,23 @@ mod test {
     use super::*;
 
     fn prepare(
+        num_layers: u32,
+        same_latency: bool,
+        num_nodes: Vec<u32>,
+    ) -> Result<PipelineTemplateGenerator, PlannerError> {
+        prepare_with_options(
+            num_layers,
+            same_latency,
+            num_nodes,
+            PlannerOptions::default(),
+        )
+    }
+
+    fn prepare_with_options(
         num_layers: u32,
         same_latency: bool,
         mut num_nodes: Vec<u32>,
+        options: PlannerOptions,
     ) -> Result<PipelineTemplateGenerator, PlannerError> {
         let mut layer_results = vec![];
         for i in 0..num_layers {
@@ -212,12 +368,13 @@ mod test {
                 } else {
                     (i + 1) as u64
                 },
+                activation_bytes: 0,
             });
         }
 
         num_nodes.sort();
 
-        let mut generator = PipelineTemplateGenerator::new(layer_results);
+        let mut generator = PipelineTemplateGenerator::new(layer_results, options);
         generator.divide_and_conquer(num_nodes[num_nodes.len() - 1])?;
         Ok(generator)
     }
@@ -302,6 +459,220 @@ mod test {
         assert_eq!(template.stages[3].layers, (5, 6));
     }
 
+    #[test]
+    fn test_divide_and_conquer_incremental() {
+        let mut generator = prepare(8, false, vec![1, 2]).unwrap();
+        assert_eq!(generator.max_num_nodes(), 2);
+        assert!(generator.get_pipeline_template(3).is_err());
+
+        generator.divide_and_conquer(5).unwrap();
+        assert_eq!(generator.max_num_nodes(), 5);
+
+        // Shrinking the number of nodes must not drop computed results
+        generator.divide_and_conquer(3).unwrap();
+        assert_eq!(generator.max_num_nodes(), 5);
+
+        let expected = prepare(8, false, vec![5]).unwrap();
+        for i in 1..=5 {
+            let template = generator.get_pipeline_template(i).unwrap();
+            let expected_template = expected.get_pipeline_template(i).unwrap();
+            assert_eq!(template.stages.len(), i as usize);
+            assert_eq!(
+                template
+                    .stages
+                    .iter()
+                    .map(|stage| stage.layers)
+                    .collect::<Vec<_>>(),
+                expected_template
+                    .stages
+                    .iter()
+                    .map(|stage| stage.layers)
+                    .collect::<Vec<_>>()
+            );
+        }
+    }
+
+    #[test]
+    fn test_device_memory_infeasible() {
+        // Layer memory: 1, 2, 3, 4, 5, 6
+        // No 3 contiguous stages fit in 7 bytes each, but 4 stages do.
+        let generator = prepare_with_options(
+            6,
+            false,
+            vec![4],
+            PlannerOptions {
+                device_memory: Some(7),
+                ..Default::default()
+            },
+        )
+        .unwrap();
+
+        assert!(generator.get_pipeline_template(1).is_err());
+        assert!(generator.get_pipeline_template(3).is_err());
+
+        let template = generator.get_pipeline_template(4).unwrap();
+        assert_eq!(template.stages.len(), 4);
+        assert!(template
+            .stages
+            .iter()
+            .all(|stage| stage.mem_required() <= 7));
+    }
+
+    #[test]
+    fn test_device_memory_changes_split() {
+        // Same latency, but the first layer requires much more memory
+        let layer_results: Vec<LayerExecutionResult> = (0..6)
+            .map(|i| LayerExecutionResult {
+                layer_index: i,
+                layer_name: format!("layer{}", i),
+                forward: 1.0,
+                backward: 1.0,
+                mem_required: if i == 0 { 10 } else { 1 },
+                activation_bytes: 0,
+            })
+            .collect();
+
+        let mut generator =
+            PipelineTemplateGenerator::new(layer_results, PlannerOptions::default());
+        generator.divide_and_conquer(2).unwrap();
+        let template = generator.get_pipeline_template(2).unwrap();
+        assert_eq!(template.stages[0].layers, (0, 3));
+        assert_eq!(template.stages[1].layers, (3, 6));
+
+        let mut generator = PipelineTemplateGenerator::new(
+            generator.layer_execution_results,
+            PlannerOptions {
+                device_memory: Some(11),
+                ..Default::default()
+            },
+        );
+        generator.divide_and_conquer(2).unwrap();
+        let template = generator.get_pipeline_template(2).unwrap();
+        assert_eq!(template.stages[0].layers, (0, 2));
+        assert_eq!(template.stages[1].layers, (2, 6));
+        assert_eq!(template.stages[0].mem_required(), 11);
+        assert_eq!(template.stages[1].mem_required(), 4);
+    }
+
+    #[test]
+    fn test_num_microbatches_changes_split() {
+        // Stage latencies of splits: (6, 12), (10, 8), (12, 6)
+        let layer_results: Vec<LayerExecutionResult> = [3.0, 2.0, 1.0, 3.0]
+            .iter()
+            .enumerate()
+            .map(|(i, latency)| LayerExecutionResult {
+                layer_index: i as u32,
+                layer_name: format!("layer{}", i),
+                forward: *latency,
+                backward: *latency,
+                mem_required: 1,
+                activation_bytes: 0,
+            })
+            .collect();
+
+        // With many microbatches, the slowest stage dominates the latency
+        let mut generator =
+            PipelineTemplateGenerator::new(layer_results, PlannerOptions::default());
+        generator.divide_and_conquer(2).unwrap();
+        let template = generator.get_pipeline_template(2).unwrap();
+        assert_eq!(template.stages[0].layers, (0, 2));
+        assert_eq!(template.stages[1].layers, (2, 4));
+
+        // With few microbatches, pipeline fill and drain dominate the latency
+        let mut generator = PipelineTemplateGenerator::new(
+            generator.layer_execution_results,
+            PlannerOptions {
+                num_microbatches: Some(2),
+                ..Default::default()
+            },
+        );
+        generator.divide_and_conquer(2).unwrap();
+        let template = generator.get_pipeline_template(2).unwrap();
+        assert_eq!(template.stages[0].layers, (0, 3));
+        assert_eq!(template.stages[1].layers, (3, 4));
+    }
+
+    #[test]
+    fn test_communication_changes_split() {
+        // Same latency, but the output activation of layer 2 is large
+        let layer_results: Vec<LayerExecutionResult> = (0..6)
+            .map(|i| LayerExecutionResult {
+                layer_index: i,
+                layer_name: format!("layer{}", i),
+                forward: 1.0,
+                backward: 1.0,
+                mem_required: 1,
+                activation_bytes: if i == 2 { 1_000_000 } else { 1_000 },
+            })
+            .collect();
+
+        let mut generator =
+            PipelineTemplateGenerator::new(layer_results, PlannerOptions::default());
+        generator.divide_and_conquer(2).unwrap();
+        let template = generator.get_pipeline_template(2).unwrap();
+        assert_eq!(template.stages[0].layers, (0, 3));
+        assert_eq!(template.stages[1].layers, (3, 6));
+
+        // Sending 1MB over 1Gbps takes 8ms, which is more than any stage computation
+        let mut generator = PipelineTemplateGenerator::new(
+            generator.layer_execution_results,
+            PlannerOptions {
+                communication: Some(CommunicationCost {
+                    bandwidth: 1.0,
+                    latency: 0.0,
+                }),
+                ..Default::default()
+            },
+        );
+        generator.divide_and_conquer(2).unwrap();
+        let template = generator.get_pipeline_template(2).unwrap();
+        assert_eq!(template.stages[0].layers, (0, 4));
+        assert_eq!(template.stages[1].layers, (4, 6));
+        assert!((template.stages[0].latency() - (8.0 + 0.008)).abs() < 1e-9);
+        assert!((template.stages[1].latency() - (4.0 + 0.008)).abs() < 1e-9);
+    }
+
+    #[test]
+    fn test_plan_for_node_speeds() {
+        let generator = prepare(6, false, vec![4]).unwrap();
+
+        // With the same speed, the result is the same as the template
+        for num_stages in 1..=4 {
+            let template = generator.get_pipeline_template(num_stages).unwrap();
+            let result = generator
+                .plan_for_node_speeds(&vec![1.0; num_stages as usize])
+                .unwrap();
+            assert_eq!(
+                result
+                    .stages
+                    .iter()
+                    .map(|stage| stage.layers)
+                    .collect::<Vec<_>>(),
+                template
+                    .stages
+                    .iter()
+                    .map(|stage| stage.layers)
+                    .collect::<Vec<_>>()
+            );
+        }
+
+        // A slower node gets fewer layers
+        let generator = prepare(6, true, vec![1]).unwrap();
+        let result = generator.plan_for_node_speeds(&[1.0, 0.5]).unwrap();
+        assert_eq!(result.stages[0].layers, (0, 4));
+        assert_eq!(result.stages[1].layers, (4, 6));
+        assert_eq!(result.stages[0].latency(), 8.0);
+        assert_eq!(result.stages[1].latency(), 8.0);
+
+        let result = generator.plan_for_node_speeds(&[0.5, 1.0]).unwrap();
+        assert_eq!(result.stages[0].layers, (0, 2));
+        assert_eq!(result.stages[1].layers, (2, 6));
+
+        assert!(generator.plan_for_node_speeds(&[]).is_err());
+        assert!(generator.plan_for_node_speeds(&[1.0, 0.0]).is_err());
+        assert!(generator.plan_for_node_speeds(&[1.0; 7]).is_err());
+    }
+
     #[test]
     fn test_measure_time_of_large_model() {
         let generator = prepare(96, false, vec![64]).unwrap();
@@ -37,6 +37,7 @@ def load_profile_data(
             forward=layer["forward"],
             backward=layer["backward"],
             mem_required=layer["mem_required"],
+            activation_bytes=layer["activation_bytes"],
         )
         for layer in data["layers"]
     ]
@@ -57,6 +58,7 @@ def init_profile_data(
                 forward=1.0,
                 backward=1.0,
                 mem_required=10,
+                activation_bytes=1024,
             )
             for index, layer_name in enumerate(modules)
         ],
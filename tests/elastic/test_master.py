@@ -6,6 +6,7 @@ from io import StringIO
 from pathlib import Path
 
 import grpc
+import pytest
 from google.protobuf.empty_pb2 import Empty
 from pytest_mock import MockerFixture
 
@@ -37,6 +38,21 @@ def test_get_dist_info(
         assert host.ip == fake_host.ip
         assert host.devices == fake_host.devices
         assert host.port == fake_host.port
+        assert host.speed == fake_host.speed
+
+
+def test_fetch_hostfile_with_speed(tmp_path: Path):
+    hostfile = tmp_path / "hostfile"
+    hostfile.write_text(
+        "127.0.0.1 slots=2 port=1234\n127.0.0.2 slots=2 port=1234 speed=0.5\n"
+    )
+
+    hosts = HostInfo.fetch_hostfile(hostfile)
+    assert [host.speed for host in hosts] == [1.0, 0.5]
+
+    hostfile.write_text("127.0.0.1 slots=2 port=1234 speed=0\n")
+    with pytest.raises(ValueError):
+        HostInfo.fetch_hostfile(hostfile)
 
 
 def test_get_code(
@@ -228,8 +228,9 @@ class TestEngineExecutionClass(OobleckEngineTestBase):
             sys.exit(0)
 
         with patch(
-            "oobleck.engine.execution_engine.PipelineInstantiator.instantiate",
+            "oobleck.engine.execution_engine.PipelineInstantiator.find_optimal_instantiation",
             return_value=(
+                0.0,
                 dict(Counter(pipelines)),
                 {
                     template: self.global_batch_size // len(pipelines)
@@ -331,8 +332,9 @@ class TestEnginePrepareClass(OobleckEngineTestBase):
     @requires_gloo()
     def test_engine_prepare(self, pipelines: list[PipelineTemplate]):
         with patch(
-            "oobleck.engine.execution_engine.PipelineInstantiator.instantiate",
+            "oobleck.engine.execution_engine.PipelineInstantiator.find_optimal_instantiation",
             return_value=(
+                0.0,
                 dict(Counter(pipelines)),
                 {
                     template: self.global_batch_size // len(pipelines)
@@ -1,7 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
 import pytest
+from cornstarch.pipeline_template import PipelineTemplate
 
 from oobleck.engine.pipeline_instantiator import PipelineInstantiator
 
+from ..conftest import model_name, modules
 from .conftest import template_1stage, template_2stages, template_3stages
 
 
@@ -48,3 +53,368 @@ def test_instantiate_onenode():
         for template, num_pipelines in result[0].items()
     )
     assert total_num_nodes == 1
+
+
+def test_apply_host_speeds():
+    template1 = PipelineTemplate(model_name, [modules], 40.0, 10.0)
+    template2 = PipelineTemplate(model_name, [modules[:3], modules[3:]], 50.0, 5.0)
+    instantiator = PipelineInstantiator(
+        {1: template1, 2: template2},
+        32,
+        1,
+        host_speeds=[1.0, 1.0, 1.0, 0.5, 1.0],
+    )
+
+    pipelines = instantiator.apply_host_speeds(
+        [template2, template1, template1, template1]
+    )
+    assert pipelines[0] is template2
+    # All pipelines from the same template are bounded by the slowest host
+    assert all(pipeline is pipelines[1] for pipeline in pipelines[1:])
+    assert pipelines[1].latency(4) == 2 * template1.latency(4)
+    assert pipelines[1].latency(8) == 2 * template1.latency(8)
+
+
+def test_apply_host_speeds_with_new_template():
+    template_2stages_for_speeds = PipelineTemplate(
+        model_name, [modules[:5], modules[5:]], 60.0, 5.0
+    )
+    requested_node_speeds: list[list[float]] = []
+
+    def create_template_for_node_speeds(node_speeds: list[float]):
+        requested_node_speeds.append(node_speeds)
+        return template_2stages_for_speeds
+
+    instantiator = PipelineInstantiator(
+        {2: template_2stages},
+        32,
+        1,
+        host_speeds=[1.0, 0.5, 1.0, 1.0],
+        create_template_for_node_speeds=create_template_for_node_speeds,
+    )
+
+    pipelines = instantiator.apply_host_speeds([template_2stages, template_2stages])
+    assert pipelines == [template_2stages_for_speeds, template_2stages_for_speeds]
+    assert requested_node_speeds == [[1.0, 0.5]]
+
+
+@pytest.mark.parametrize(
+    "host_speeds",
+    [[1.0] * 6, [1.0, 1.0, 1.0, 0.5, 0.5, 0.5], [0.5, 1.0, 2.0, 1.0, 0.5, 1.0]],
+)
+def test_instantiate_with_host_speeds(host_speeds: list[float]):
+    template2 = PipelineTemplate(model_name, [modules[:3], modules[3:]], 80.0, 10.0)
+    template3 = PipelineTemplate(
+        model_name, [modules[:4], modules[4:7], modules[7:]], 90.0, 7.5
+    )
+    instantiator = PipelineInstantiator(
+        {2: template2, 3: template3}, 64, 1, host_speeds=host_speeds
+    )
+    num_instances, num_microbatches = instantiator.instantiate(len(host_speeds))
+
+    assert (
+        sum(
+            num_instances[template] * num_mb
+            for template, num_mb in num_microbatches.items()
+        )
+        == 64
+    )
+    assert (
+        sum(
+            template.num_stages * num_pipelines
+            for template, num_pipelines in num_instances.items()
+        )
+        == 6
+    )
+
+
+def test_find_optimal_instantiation():
+    template2 = PipelineTemplate(model_name, [modules[:3], modules[3:]], 80.0, 10.0)
+    template3 = PipelineTemplate(
+        model_name, [modules[:4], modules[4:7], modules[7:]], 90.0, 7.5
+    )
+    instantiator = PipelineInstantiator({2: template2, 3: template3}, 64, 1)
+    latency, num_instances, num_microbatches = instantiator.find_optimal_instantiation(
+        8
+    )
+
+    assert (num_instances, num_microbatches) == instantiator.instantiate(8)
+    assert latency == pytest.approx(
+        max(
+            template.latency(num_mb)
+            for template, num_mb in num_microbatches.items()
+            if num_mb > 0
+        )
+    )
+
+
+def test_enumerate_instantiation_options():
+    instantiator = PipelineInstantiator(
+        {2: template_2stages, 3: template_3stages}, 512, 2
+    )
+    options = list(instantiator._enumerate_instantiation_options(12))
+
+    assert len(options) == 3
+    for option in [
+        {template_2stages: 6},
+        {template_2stages: 3, template_3stages: 2},
+        {template_3stages: 4},
+    ]:
+        assert option in options
+
+    # {template_3stages: 3} has less than 4 pipelines.
+    instantiator.fault_tolerance_threshold = 4
+    assert list(instantiator._enumerate_instantiation_options(9)) == [
+        {template_2stages: 3, template_3stages: 1}
+    ]
+
+    with pytest.raises(RuntimeError):
+        next(instantiator._enumerate_instantiation_options(1))
+
+
+@pytest.mark.parametrize("num_nodes", [5, 8, 13], ids=lambda n: f"{n} nodes")
+def test_find_optimal_instantiation_with_pruning(num_nodes: int):
+    templates = {
+        1: PipelineTemplate(model_name, [modules], 45.0, 10.0),
+        2: PipelineTemplate(model_name, [modules[:3], modules[3:]], 50.0, 5.5),
+        3: PipelineTemplate(
+            model_name, [modules[:4], modules[4:7], modules[7:]], 60.0, 4.0
+        ),
+    }
+    instantiator = PipelineInstantiator(templates, 96, 1)
+    latency, _, _ = instantiator.find_optimal_instantiation(num_nodes)
+
+    # Pruning must not miss the optimal option.
+    latencies = [
+        instantiator.distribute_batch(option)
+        for option in instantiator._enumerate_instantiation_options(num_nodes)
+    ]
+    assert latency == pytest.approx(
+        min(result[0] for result in latencies if result is not None)
+    )
+
+
+@pytest.mark.parametrize(
+    "need_all_pipelines_have_batch", [False, True], ids=["optional", "all"]
+)
+@pytest.mark.parametrize("global_num_microbatches", [7, 64, 301])
+def test_distribute_batch_matches_pulp(
+    global_num_microbatches: int, need_all_pipelines_have_batch: bool
+):
+    pytest.importorskip("pulp")
+
+    template1 = PipelineTemplate(model_name, [modules], 45.0, 10.0)
+    template2 = PipelineTemplate(model_name, [modules[:3], modules[3:]], 50.0, 5.5)
+    template3 = PipelineTemplate(
+        model_name, [modules[:4], modules[4:7], modules[7:]], 60.0, 4.0
+    )
+    instantiator = PipelineInstantiator({}, global_num_microbatches, 1)
+
+    for num_pipelines in [
+        {template1: 1},
+        {template1: 2, template2: 1},
+        {template2: 2, template3: 3},
+        {template1: 3, template2: 2, template3: 1},
+    ]:
+        result = instantiator.distribute_batch(
+            num_pipelines, need_all_pipelines_have_batch
+        )
+        expected = instantiator._distribute_batch_pulp(
+            num_pipelines, need_all_pipelines_have_batch
+        )
+
+        if expected is None:
+            assert result is None
+            continue
+
+        latency, num_microbatches = result
+        assert latency == pytest.approx(expected[0])
+        assert (
+            sum(
+                num_pipelines[template] * num_mb
+                for template, num_mb in num_microbatches.items()
+            )
+            == global_num_microbatches
+        )
+        if need_all_pipelines_have_batch:
+            assert all(num_mb > 0 for num_mb in num_microbatches.values())
+
+
+def test_distribute_batch_memoized():
+    template2 = PipelineTemplate(model_name, [modules[:3], modules[3:]], 50.0, 5.5)
+    template3 = PipelineTemplate(
+        model_name, [modules[:4], modules[4:7], modules[7:]], 60.0, 4.0
+    )
+    option = {template2: 2, template3: 1}
+    PipelineInstantiator._batch_distributions.clear()
+
+    expected = PipelineInstantiator({}, 64, 1).distribute_batch(option)
+
+    with patch(
+        "oobleck.engine.pipeline_instantiator.distribute_microbatches",
+        return_value=None,
+    ) as distribute_microbatches:
+        # Another instantiator, e.g. for reconfiguration, reuses the result.
+        assert PipelineInstantiator({}, 64, 1).distribute_batch(option) == expected
+        distribute_microbatches.assert_not_called()
+
+        PipelineInstantiator({}, 64, 1).distribute_batch(option, True)
+        PipelineInstantiator({}, 32, 1).distribute_batch(option)
+        assert distribute_microbatches.call_count == 2
+
+
+def test_find_optimal_instantiation_with_workers():
+    templates = {
+        1: PipelineTemplate(model_name, [modules], 45.0, 10.0),
+        2: PipelineTemplate(model_name, [modules[:3], modules[3:]], 50.0, 5.5),
+        3: PipelineTemplate(
+            model_name, [modules[:4], modules[4:7], modules[7:]], 60.0, 4.0
+        ),
+    }
+
+    PipelineInstantiator._batch_distributions.clear()
+    expected = PipelineInstantiator(templates, 96, 1).find_optimal_instantiation(13)
+
+    PipelineInstantiator._batch_distributions.clear()
+    result = PipelineInstantiator(
+        templates, 96, 1, num_workers=2
+    ).find_optimal_instantiation(13)
+
+    assert result[0] == pytest.approx(expected[0])
+
+
+def test_select_reconfiguration():
+    template1 = PipelineTemplate(model_name, [modules], 40.0, 4.0)
+    template2 = PipelineTemplate(model_name, [modules[:3], modules[3:]], 50.0, 5.0)
+    candidates = [[template1, template1], [template2]]
+    # Two remaining hosts hold layers of different stages of 2-stage pipelines.
+    old_layers_per_host = PipelineInstantiator.get_layers_per_host([template2])
+    instantiator = PipelineInstantiator({1: template1, 2: template2}, 16, 1)
+
+    pipelines, num_microbatches = instantiator.select_reconfiguration(
+        candidates, old_layers_per_host
+    )
+    assert pipelines == [template1, template1]
+    assert num_microbatches == {template1: 8}
+
+    # Transferring layers takes longer than the gain in iteration time.
+    pipelines, num_microbatches = instantiator.select_reconfiguration(
+        candidates, old_layers_per_host, [2**30] * len(modules), bandwidth=10.0
+    )
+    assert pipelines == [template2]
+    assert num_microbatches == {template2: 16}
+
+    # Among candidates with the same iteration time, less transfer is preferred.
+    pipelines, _ = PipelineInstantiator({}, 16, 1).select_reconfiguration(
+        [[template_1stage, template_1stage], [template_2stages]], old_layers_per_host
+    )
+    assert pipelines == [template_2stages]
+
+
+def test_select_reconfiguration_with_threshold():
+    template1 = PipelineTemplate(model_name, [modules], 40.0, 4.0)
+    template2 = PipelineTemplate(model_name, [modules[:3], modules[3:]], 50.0, 5.0)
+    old_layers_per_host = PipelineInstantiator.get_layers_per_host([template2])
+    instantiator = PipelineInstantiator({1: template1, 2: template2}, 16, 2)
+
+    # A single pipeline would transfer no layer, but is below the threshold.
+    pipelines, num_microbatches = instantiator.select_reconfiguration(
+        [[template2], [template1, template1]],
+        old_layers_per_host,
+        [2**30] * len(modules),
+        bandwidth=10.0,
+    )
+    assert pipelines == [template1, template1]
+    assert num_microbatches == {template1: 8}
+
+    assert (
+        instantiator.select_reconfiguration([[template2]], old_layers_per_host) is None
+    )
+
+
+def test_select_reconfiguration_with_workers():
+    template1 = PipelineTemplate(model_name, [modules], 40.0, 4.0)
+    template2 = PipelineTemplate(model_name, [modules[:3], modules[3:]], 50.0, 5.0)
+    templates = {1: template1, 2: template2}
+    candidates = [[template1, template1, template1, template1], [template2] * 2]
+    old_layers_per_host = PipelineInstantiator.get_layers_per_host([template2] * 2)
+
+    PipelineInstantiator._batch_distributions.clear()
+    expected = PipelineInstantiator(templates, 16, 1).select_reconfiguration(
+        candidates, old_layers_per_host
+    )
+
+    PipelineInstantiator._batch_distributions.clear()
+    instantiator = PipelineInstantiator(templates, 16, 1, num_workers=2)
+    instantiator.precompute_batch_distributions(
+        [{template1: 4}, {template2: 2}], need_all_pipelines_have_batch=True
+    )
+    with patch(
+        "oobleck.engine.pipeline_instantiator.distribute_microbatches",
+        return_value=None,
+    ) as distribute_microbatches:
+        # Problems are already solved on the worker processes.
+        assert (
+            instantiator.select_reconfiguration(candidates, old_layers_per_host)
+            == expected
+        )
+        distribute_microbatches.assert_not_called()
+
+
+def test_get_executor_from_threads():
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        executors = list(
+            executor.map(lambda _: PipelineInstantiator._get_executor(3), range(8))
+        )
+    assert all(executor is executors[0] for executor in executors)
+    assert PipelineInstantiator._executor is executors[0]
+
+
+def test_find_optimal_instantiation_with_allreduce():
+    templates = {
+        1: PipelineTemplate(model_name, [modules], 20.0, 2.0),
+        2: PipelineTemplate(model_name, [modules[:3], modules[3:]], 22.0, 1.2),
+    }
+
+    _, num_instances, _ = PipelineInstantiator(
+        templates, 32, 1
+    ).find_optimal_instantiation(4)
+    assert num_instances == {templates[1]: 4}
+
+    # All-reduce dominates, and fewer pipelines with fewer layers per host win.
+    instantiator = PipelineInstantiator(
+        templates,
+        32,
+        1,
+        layer_num_gradient_bytes=[10**8] * len(modules),
+        allreduce_bandwidth=1.0,
+    )
+    latency, num_instances, num_microbatches = instantiator.find_optimal_instantiation(
+        4
+    )
+    assert num_instances == {templates[2]: 2}
+    # Hosts of the second stage hold the most gradients.
+    assert latency == pytest.approx(
+        templates[2].latency(num_microbatches[templates[2]])
+        + 2 * (2 - 1) / 2 * len(modules[3:]) * 10**8 * 8 / 1e6
+    )
+
+
+def test_find_optimal_instantiation_with_optimizer_step():
+    templates = {
+        1: PipelineTemplate(model_name, [modules], 20.0, 2.0),
+        2: PipelineTemplate(model_name, [modules[:3], modules[3:]], 22.0, 1.2),
+    }
+
+    # Optimizer step dominates, and pipelines with fewer layers per host win.
+    instantiator = PipelineInstantiator(
+        templates, 32, 1, layer_optimizer_step_times=[10.0] * len(modules)
+    )
+    latency, num_instances, num_microbatches = instantiator.find_optimal_instantiation(
+        4
+    )
+    assert num_instances == {templates[2]: 2}
+    # Hosts of the second stage hold the most layers.
+    assert latency == pytest.approx(
+        templates[2].latency(num_microbatches[templates[2]]) + 10.0 * len(modules[3:])
+    )
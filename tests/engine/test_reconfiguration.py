@@ -5,6 +5,7 @@ from pathlib import Path
 from unittest.mock import patch
 
 import numpy as np
+import pytest
 import torch
 import torch.distributed as dist
 from colossalai.accelerator import CpuAccelerator
@@ -32,7 +33,7 @@ from transformers import (
 from oobleck.engine.configuration_engine import ConfigurationEngine
 from oobleck.engine.plugin import OobleckPlugin
 
-from ..conftest import config
+from ..conftest import config, model_name, modules
 from .conftest import (
     OobleckMultiprocessTestBase,
     template_1stage,
@@ -232,10 +233,9 @@ class TestOobleckReconfiguration4RanksClass(OobleckReconfigurationClassBase):
             ],
             [
                 [1235, 1236],
-                [template_1stage, template_1stage],
+                [template_2stages],
                 [
-                    [[0], [0], [0], [0], [0], [0], [0], [0], [0]],
-                    [[1], [1], [1], [1], [1], [1], [1], [1], [1]],
+                    [[0], [0], [0], [1], [1], [1], [1], [1], [1]],
                 ],
             ],
         ],
@@ -263,6 +263,53 @@ class TestOobleckReconfiguration4RanksClass(OobleckReconfigurationClassBase):
 
         self.do_step(plugin, model, optimizer, dataloader)
 
+    @parametrize(
+        "hosts_to_fail, expected_new_pipelines",
+        [
+            [[1235], [template_1stage, template_2stages]],
+            [[1237], [template_2stages, template_1stage]],
+            [[1235, 1236], [template_2stages]],
+        ],
+        name_fn=lambda hosts_to_fail, *_: (f"hosts_to_fail={hosts_to_fail}"),
+    )
+    @requires_nccl()
+    @skip_if_lt_x_gpu(4)
+    def test_reconfiguration_with_precomputed_plans(
+        self,
+        hosts_to_fail: list[int],
+        expected_new_pipelines: list[PipelineTemplate],
+    ):
+        plugin, model, optimizer, dataloader = self.prepare(
+            [template_2stages, template_2stages]
+        )
+        plugin.precompute_double_failures = True
+        plugin.precompute_reconfiguration_plans(
+            {1: template_1stage, 2: template_2stages, 3: template_3stages}
+        )
+        plugin._reconfiguration_planner.join()
+
+        configuration_engine = ConfigurationEngine.get_instance()
+        # 4 single failures and 6 double failures
+        assert len(plugin._reconfiguration_plans) == 10
+        plan = plugin._reconfiguration_plans[
+            frozenset(
+                host
+                for host in configuration_engine.rank_map
+                if host.port in hosts_to_fail
+            )
+        ]
+        assert plan.pipelines == expected_new_pipelines
+
+        self.do_step(plugin, model, optimizer, dataloader)
+        model, optimizer, dataloader = self.do_reconfigure(
+            hosts_to_fail, plugin, model, optimizer, dataloader
+        )
+
+        assert plugin.pipelines == expected_new_pipelines
+        assert plugin.num_microbatches == plan.num_microbatches
+
+        self.do_step(plugin, model, optimizer, dataloader)
+
     @parametrize(
         "hosts_to_fail, expected_num_pipeline_stages, hosts_to_checkpoint",
         [
@@ -504,3 +551,81 @@ class TestOobleckReconfigurationTensorParallelClass(OobleckReconfigurationClassB
 instantiate_parametrized_tests(TestOobleckReconfiguration3RanksClass)
 instantiate_parametrized_tests(TestOobleckReconfiguration4RanksClass)
 instantiate_parametrized_tests(TestOobleckReconfigurationTensorParallelClass)
+
+
+@pytest.mark.parametrize(
+    "template_num_stages, num_hosts_per_pipeline, fault_tolerance_threshold, "
+    "expected_num_hosts_per_pipeline",
+    [
+        [[1, 2, 3], [1, 2], 1, [1, 2]],
+        [[1, 2, 3], [0, 3, 2], 1, [3, 2]],
+        [[1, 3], [1, 2], 1, [1, 1, 1]],
+        [[3, 4], [2, 1, 3], 1, [3, 3]],
+        [[2, 3, 4], [1, 3, 1, 2], 1, [2, 3, 2]],
+        [[1, 2, 3], [1, 2], 3, [1, 1, 1]],
+        [[2, 3], [3, 3], 3, [2, 2, 2]],
+        [[2, 3, 4], [1, 3, 1, 2], 3, [2, 3, 2]],
+    ],
+)
+def test_merge_pipelines(
+    template_num_stages: list[int],
+    num_hosts_per_pipeline: list[int],
+    fault_tolerance_threshold: int,
+    expected_num_hosts_per_pipeline: list[int],
+):
+    def create_template(num_stages: int) -> PipelineTemplate:
+        bounds = [stage * len(modules) // num_stages for stage in range(num_stages + 1)]
+        return PipelineTemplate(
+            model_name,
+            [modules[start:end] for start, end in zip(bounds[:-1], bounds[1:])],
+        )
+
+    pipeline_templates = {
+        num_stages: create_template(num_stages) for num_stages in template_num_stages
+    }
+
+    assert (
+        OobleckPlugin._merge_pipelines(
+            pipeline_templates, num_hosts_per_pipeline, fault_tolerance_threshold
+        )
+        == expected_num_hosts_per_pipeline
+    )
+
+
+def test_merge_pipelines_infeasible():
+    with pytest.raises(RuntimeError):
+        OobleckPlugin._merge_pipelines({3: template_3stages}, [1, 1])
+    # Six hosts cannot make three pipelines of three hosts.
+    with pytest.raises(RuntimeError):
+        OobleckPlugin._merge_pipelines({3: template_3stages}, [3, 3], 3)
+
+
+@pytest.mark.parametrize(
+    "old_num_hosts_per_pipeline, num_hosts_per_pipeline, fault_tolerance_threshold, "
+    "expected_groupings",
+    [
+        [[2, 2], [1, 2], 1, [[1, 2]]],
+        [[2, 2], [1, 1], 1, [[1, 1], [2]]],
+        [[3, 3], [3, 1], 1, [[3, 1]]],
+        [[3, 3, 2], [1, 2, 2], 1, [[1, 2, 2], [3, 2], [2, 1, 2], [1, 1, 1, 2]]],
+        [[3, 3, 2], [1, 2, 2], 3, [[1, 2, 2], [2, 1, 2], [1, 1, 1, 2]]],
+        [[3, 3, 3], [3, 2, 3], 3, [[3, 2, 3], [3, 1, 1, 3]]],
+    ],
+)
+def test_get_pipeline_groupings(
+    old_num_hosts_per_pipeline: list[int],
+    num_hosts_per_pipeline: list[int],
+    fault_tolerance_threshold: int,
+    expected_groupings: list[list[int]],
+):
+    pipeline_templates = {1: template_1stage, 2: template_2stages, 3: template_3stages}
+
+    assert (
+        OobleckPlugin._get_pipeline_groupings(
+            pipeline_templates,
+            old_num_hosts_per_pipeline,
+            num_hosts_per_pipeline,
+            fault_tolerance_threshold,
+        )
+        == expected_groupings
+    )
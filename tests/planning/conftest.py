@@ -0,0 +1,29 @@
+from pathlib import Path
+
+import pytest
+
+from oobleck.planning.profiler import LayerExecutionResult
+
+from ..conftest import init_profile_data, load_profile_data, tag
+
+microbatch_size = 1
+tp_size = 1
+precision = "fp32"
+
+
+@pytest.fixture
+def profile_data(tmp_path: Path) -> list[LayerExecutionResult]:
+    profile_dir_path = tmp_path / tag / "profile"
+    init_profile_data(
+        profile_dir=profile_dir_path,
+        tp_size=tp_size,
+        microbatch_size=microbatch_size,
+        precision=precision,
+    )
+
+    return load_profile_data(
+        profile_dir=profile_dir_path,
+        tp_size=tp_size,
+        microbatch_size=microbatch_size,
+        precision=precision,
+    )
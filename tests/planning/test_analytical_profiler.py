@@ -0,0 +1,84 @@
+import json
+from pathlib import Path
+
+import pytest
+import torch
+
+from oobleck.planning.analytical_profiler import AnalyticalProfiler
+from oobleck.planning.profiler import ModelProfiler
+from oobleck.planning.whatif import CapacityPlanner
+
+from ..conftest import config, model_name, modules, tag
+
+sequence_length = 128
+
+
+@pytest.fixture
+def profiler(tmp_path: Path) -> AnalyticalProfiler:
+    return AnalyticalProfiler(
+        tag,
+        model_name_or_path=model_name,
+        optimizer_class="torch.optim.Adam",
+        config=config,
+        precision="fp32",
+        tp_size=1,
+        base_dir=tmp_path,
+        device_tflops=100.0,
+    )
+
+
+def get_inputs(microbatch_size: int) -> dict[str, torch.Tensor]:
+    return {
+        "input_ids": torch.zeros(microbatch_size, sequence_length, dtype=torch.long)
+    }
+
+
+def test_estimate(profiler: AnalyticalProfiler):
+    layers = profiler.estimate(get_inputs(2))
+    assert [layer.layer_name for layer in layers] == modules
+
+    blocks = [layer for layer in layers if ".h." in layer.layer_name]
+    assert len(blocks) == config.n_layer
+    for block in blocks:
+        assert block.forward > 0
+        assert block.forward == pytest.approx(blocks[0].forward)
+        # Backward with activation checkpointing recomputes forward.
+        assert block.backward == pytest.approx(3 * block.forward)
+        assert block.backward_no_checkpointing == pytest.approx(2 * block.forward)
+        # Outputs include hidden states in fp32.
+        assert block.activation_bytes >= 2 * sequence_length * config.n_embd * 4
+        assert block.mem_required > block.activation_bytes
+        # Intermediate activations are kept without activation checkpointing.
+        assert block.mem_required_no_checkpointing > block.mem_required
+
+    # Compute bound layers take twice longer with twice larger microbatches.
+    doubled = profiler.estimate(get_inputs(4))
+    assert doubled[layers.index(blocks[0])].forward == pytest.approx(
+        2 * blocks[0].forward
+    )
+
+
+def test_memory_bandwidth(profiler: AnalyticalProfiler):
+    layers = profiler.estimate(get_inputs(1))
+    profiler.memory_bandwidth = 1e-3
+    memory_bound = profiler.estimate(get_inputs(1))
+
+    assert all(
+        slow.forward >= layer.forward for slow, layer in zip(memory_bound, layers)
+    )
+    assert sum(layer.forward for layer in memory_bound) > sum(
+        layer.forward for layer in layers
+    )
+
+
+def test_write_profile(profiler: AnalyticalProfiler, tmp_path: Path):
+    profile_path = ModelProfiler.get_profile_path(tmp_path, 1, 2, "fp32")
+    profiler.write_profile(get_inputs(2), profile_path)
+
+    data = json.loads(profile_path.read_text())
+    assert data["microbatch_size"] == 2
+    assert data["backend"] == "analytical"
+
+    planner = CapacityPlanner.from_profile(profile_path, global_batch_size=16)
+    assert [layer.layer_name for layer in planner.profile_data] == modules
+    assert planner.predict(2).error is None
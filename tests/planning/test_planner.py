@@ -1,5 +1,5 @@
 import itertools
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from cornstarch.pipeline_template import PipelineTemplate
@@ -7,35 +7,7 @@ from cornstarch.pipeline_template import PipelineTemplate
 from oobleck.planning import planner
 from oobleck.planning.profiler import LayerExecutionResult
 
-from ..conftest import (
-    init_profile_data,
-    load_profile_data,
-    model_name,
-    modules,
-    tag,
-)
-
-microbatch_size = 1
-tp_size = 1
-precision = "fp32"
-
-
-@pytest.fixture
-def profile_data(tmp_path: Path) -> list[LayerExecutionResult]:
-    profile_dir_path = tmp_path / tag / "profile"
-    init_profile_data(
-        profile_dir=profile_dir_path,
-        tp_size=tp_size,
-        microbatch_size=microbatch_size,
-        precision=precision,
-    )
-
-    return load_profile_data(
-        profile_dir=profile_dir_path,
-        tp_size=tp_size,
-        microbatch_size=microbatch_size,
-        precision=precision,
-    )
+from ..conftest import model_name, modules
 
 
 def test_error_for_too_large_num_nodes(profile_data: list[LayerExecutionResult]):
@@ -62,3 +34,156 @@ def test_create_pipeline_templates(profile_data: list[LayerExecutionResult]):
         assert modules == list(
             itertools.chain.from_iterable(template.modules_per_stage)
         )
+
+
+def test_incremental_pipeline_template_generator(
+    profile_data: list[LayerExecutionResult],
+):
+    generator = planner.PipelineTemplateGenerator(model_name, profile_data)
+    assert generator.max_num_nodes == 0
+
+    templates = generator.create_pipeline_templates([1, 2])
+    assert generator.max_num_nodes == 2
+    assert list(templates.keys()) == [1, 2]
+
+    templates = generator.create_pipeline_templates([2, 3, 4])
+    assert generator.max_num_nodes == 4
+    assert list(templates.keys()) == [2, 3, 4]
+
+    expected = planner.create_pipeline_templates(
+        model_name=model_name,
+        profile_data=profile_data,
+        num_nodes=[2, 3, 4],
+    )
+    for num_stages, template in templates.items():
+        assert template.modules_per_stage == expected[num_stages].modules_per_stage
+
+    with pytest.raises(RuntimeError):
+        generator.create_pipeline_templates([len(modules) + 1])
+
+
+def test_create_pipeline_templates_with_device_memory(
+    profile_data: list[LayerExecutionResult],
+):
+    device_memory = sum(layer.mem_required for layer in profile_data) - 1
+    templates: dict[PipelineTemplate] = planner.create_pipeline_templates(
+        model_name=model_name,
+        profile_data=profile_data,
+        num_nodes=[1, 2, 3, 4],
+        device_memory=device_memory,
+    )
+
+    # A single stage does not fit in a device.
+    assert list(templates.keys()) == [2, 3, 4]
+
+    for template in templates.values():
+        assert len(template.mem_required_per_stage) == template.num_stages
+        assert all(mem <= device_memory for mem in template.mem_required_per_stage)
+        assert sum(template.mem_required_per_stage) == template.mem_required
+
+
+@pytest.mark.parametrize("num_microbatches", [4, 16, 128])
+def test_create_pipeline_templates_with_num_microbatches(
+    profile_data: list[LayerExecutionResult], num_microbatches: int
+):
+    templates: dict[PipelineTemplate] = planner.create_pipeline_templates(
+        model_name=model_name,
+        profile_data=profile_data,
+        num_nodes=[1, 2, 3, 4],
+        num_microbatches=num_microbatches,
+    )
+
+    assert list(templates.keys()) == [1, 2, 3, 4]
+    for num_stages, template in templates.items():
+        assert num_stages == template.num_stages
+        assert modules == list(
+            itertools.chain.from_iterable(template.modules_per_stage)
+        )
+
+
+def test_create_pipeline_templates_with_communication(
+    profile_data: list[LayerExecutionResult],
+):
+    templates: dict[PipelineTemplate] = planner.create_pipeline_templates(
+        model_name=model_name,
+        profile_data=profile_data,
+        num_nodes=[1, 2, 3, 4],
+    )
+    templates_with_communication: dict[PipelineTemplate] = (
+        planner.create_pipeline_templates(
+            model_name=model_name,
+            profile_data=profile_data,
+            num_nodes=[1, 2, 3, 4],
+            inter_node_bandwidth=100.0,
+            inter_node_latency=0.01,
+        )
+    )
+
+    assert list(templates_with_communication.keys()) == [1, 2, 3, 4]
+
+    # A single stage pipeline does not communicate
+    assert templates_with_communication[1].latency(128) == pytest.approx(
+        templates[1].latency(128)
+    )
+    for num_stages in [2, 3, 4]:
+        assert templates_with_communication[num_stages].latency(128) > templates[
+            num_stages
+        ].latency(128)
+
+
+def test_create_pipeline_template_for_node_speeds(
+    profile_data: list[LayerExecutionResult],
+):
+    templates: dict[PipelineTemplate] = planner.create_pipeline_templates(
+        model_name=model_name,
+        profile_data=profile_data,
+        num_nodes=[2],
+    )
+    template = planner.create_pipeline_template_for_node_speeds(
+        model_name=model_name,
+        profile_data=profile_data,
+        node_speeds=[1.0, 1.0],
+    )
+    assert template.modules_per_stage == templates[2].modules_per_stage
+    assert template.node_speeds == [1.0, 1.0]
+
+    template = planner.create_pipeline_template_for_node_speeds(
+        model_name=model_name,
+        profile_data=profile_data,
+        node_speeds=[1.0, 0.5],
+    )
+    assert template.num_stages == 2
+    assert modules == list(itertools.chain.from_iterable(template.modules_per_stage))
+    # The slower node gets fewer layers
+    assert len(template.modules_per_stage[0]) > len(template.modules_per_stage[1])
+    assert template.latency(8) > templates[2].latency(8)
+
+    with pytest.raises(RuntimeError):
+        planner.create_pipeline_template_for_node_speeds(
+            model_name=model_name,
+            profile_data=profile_data,
+            node_speeds=[1.0, 0.0],
+        )
+
+
+def test_create_pipeline_templates_from_threads(
+    profile_data: list[LayerExecutionResult],
+):
+    expected = planner.create_pipeline_templates(
+        model_name=model_name, profile_data=profile_data, num_nodes=[1, 2, 3, 4]
+    )
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(
+            executor.map(
+                lambda _: planner.create_pipeline_templates(
+                    model_name=model_name,
+                    profile_data=profile_data,
+                    num_nodes=[1, 2, 3, 4],
+                ),
+                range(4),
+            )
+        )
+
+    for templates in results:
+        assert templates == expected
@@ -0,0 +1,98 @@
+import threading
+from pathlib import Path
+
+from oobleck.planning.profile_store import ProfileStore
+
+from ..conftest import model_name
+
+fingerprint_args = dict(
+    model_name_or_path=model_name,
+    model_config={"n_layer": 4, "n_embd": 768},
+    optimizer_class="torch.optim.Adam",
+    precision="fp32",
+    tp_size=1,
+    microbatch_size=1,
+    device_name="NVIDIA A40",
+    versions={"torch": "2.1.0", "colossalai": "0.3.6"},
+    input_shapes={"input_ids": [128], "attention_mask": [128], "labels": []},
+    profiler_options={"deduplicate_layers": True, "metrics": ["forward"]},
+)
+
+
+def test_fingerprint_depends_on_inputs():
+    key = ProfileStore.get_fingerprint(**fingerprint_args)
+
+    assert key == ProfileStore.get_fingerprint(
+        **{
+            **fingerprint_args,
+            "model_config": {"n_embd": 768, "n_layer": 4},
+        }
+    )
+
+    for name, value in [
+        ("model_config", {"n_layer": 8, "n_embd": 768}),
+        ("optimizer_class", "torch.optim.SGD"),
+        ("precision", "bf16"),
+        ("tp_size", 2),
+        ("microbatch_size", 2),
+        ("device_name", "NVIDIA A100-SXM4-80GB"),
+        ("versions", {"torch": "2.2.0", "colossalai": "0.3.6"}),
+        ("num_iterations", 10),
+        ("input_shapes", {"input_ids": [256], "attention_mask": [256], "labels": []}),
+        ("profiler_options", {"deduplicate_layers": False, "metrics": ["forward"]}),
+        (
+            "profiler_options",
+            {"deduplicate_layers": True, "metrics": ["forward", "backward"]},
+        ),
+    ]:
+        assert key != ProfileStore.get_fingerprint(
+            **{**fingerprint_args, name: value}
+        ), name
+
+
+def test_store_and_load(tmp_path: Path):
+    store = ProfileStore(tmp_path / "profile_store")
+    key = ProfileStore.get_fingerprint(**fingerprint_args)
+
+    profile_path = tmp_path / "job1" / "profile.json"
+    with store.lock(key):
+        assert not store.contains(key)
+        assert not store.load(key, profile_path)
+    assert not profile_path.exists()
+
+    source_path = tmp_path / "job0" / "profile.json"
+    source_path.parent.mkdir()
+    source_path.write_text('{"layers": []}')
+    with store.lock(key):
+        store.store(key, source_path)
+
+    with store.lock(key):
+        assert store.contains(key)
+        assert store.load(key, profile_path)
+    assert profile_path.read_text() == '{"layers": []}'
+
+    # No temporary files are left.
+    assert sorted(path.name for path in store.store_dir.iterdir()) == [
+        f"profile_{key}.json",
+        f"profile_{key}.lock",
+    ]
+    assert list(profile_path.parent.iterdir()) == [profile_path]
+
+
+def test_lock_is_exclusive(tmp_path: Path):
+    store = ProfileStore(tmp_path)
+    key = ProfileStore.get_fingerprint(**fingerprint_args)
+
+    acquired = threading.Event()
+
+    def acquire():
+        with store.lock(key):
+            acquired.set()
+
+    with store.lock(key):
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        assert not acquired.wait(0.2)
+
+    thread.join()
+    assert acquired.is_set()
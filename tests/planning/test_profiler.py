@@ -2,9 +2,12 @@ import json
 import multiprocessing
 import os
 from pathlib import Path
+from unittest.mock import patch
 
+import pytest
 import torch
 import torch.distributed as dist
+import torch.nn as nn
 from torch.testing._internal.common_distributed import (
     MultiProcessTestCase,
     cleanup_temp_dir,
@@ -17,12 +20,13 @@ from torch.testing._internal.common_utils import (
     instantiate_parametrized_tests,
     parametrize,
 )
+from transformers.models.gpt2.modeling_gpt2 import GPT2Block
 
 from oobleck.elastic.run import HostInfo
 from oobleck.engine.configuration_engine import ConfigurationEngine
-from oobleck.planning.profiler import ModelProfiler
+from oobleck.planning.profiler import LayerExecutionResult, ModelProfiler
 
-from ..conftest import config, model_name, modules, tag
+from ..conftest import config, init_profile_data, model_name, modules, tag
 from .data_builder import GLUEDataBuilder
 
 microbatch_size = 1
@@ -140,5 +144,375 @@ class TestProfileModelClass(MultiProcessTestCase):
         assert len(data["layers"]) == len(modules)
         assert [layer["layer_name"] for layer in data["layers"]] == modules
 
+    @requires_nccl()
+    @skip_if_lt_x_gpu(4)
+    def test_profile_model_skips_duplicate_layers(self):
+        """Transformer blocks other than the first one are identical to it,
+        thus they are not executed."""
+        temp_path = Path(os.environ["TEMP_DIR"])
+        profile_dir = temp_path / tag / "profile"
+        profile_dir.mkdir(parents=True, exist_ok=True)
+
+        torch.cuda.set_device(self.rank)
+
+        dataloader = GLUEDataBuilder("gpt2").dataloader(batch_size=16)
+        inputs = next(iter(dataloader))
+
+        executed_blocks: list[nn.Module] = []
+        block_forward = GPT2Block.forward
+
+        def forward(block: GPT2Block, *args, **kwargs):
+            executed_blocks.append(block)
+            return block_forward(block, *args, **kwargs)
+
+        with patch.object(GPT2Block, "forward", new=forward):
+            ModelProfiler._profile_model(
+                model_name_or_path=model_name,
+                model_config=config,
+                optimizer_class="torch.optim.Adam",
+                profile_dir=profile_dir,
+                local_rank=self.rank,
+                tp_size=self.world_size,
+                precision="fp32",
+                inputs=inputs,
+                warmup=1,
+            )
+
+        assert executed_blocks
+        assert all(block is executed_blocks[0] for block in executed_blocks)
+
+        profile_path = ModelProfiler.get_profile_path(
+            profile_dir, self.world_size, inputs["input_ids"].shape[0], "fp32"
+        )
+        data = json.loads(profile_path.read_text())
+        assert [layer["layer_name"] for layer in data["layers"]] == modules
+        blocks = [layer for layer in data["layers"] if ".h." in layer["layer_name"]]
+        assert len(blocks) == config.n_layer
+        assert all(block["forward"] == blocks[0]["forward"] for block in blocks)
+
 
 instantiate_parametrized_tests(TestProfileModelClass)
+
+
+class TestProfileMultipleAgentsClass(MultiProcessTestCase):
+    num_agents: int = 2
+    tp_size: int = 2
+
+    @property
+    def world_size(self):
+        return self.num_agents * self.tp_size
+
+    def setUp(self):
+        super().setUp()
+        initialize_temp_directories()
+        self._spawn_processes()
+
+    def tearDown(self):
+        cleanup_temp_dir()
+        ConfigurationEngine._instance = None
+        super().tearDown()
+
+    def init_configuration_engine(self, temp_dir: Path):
+        pipe, child_pipe = multiprocessing.Pipe()
+        # dist info
+        pipe.send(
+            [
+                HostInfo(
+                    "127.0.0.1", ",".join(str(i) for i in range(self.tp_size)), 1234 + i
+                )
+                for i in range(self.num_agents)
+            ]
+        )
+        self.pipe = pipe
+        ConfigurationEngine.create(
+            child_pipe,
+            self.rank // self.tp_size,
+            self.rank % self.tp_size,
+            tag,
+            temp_dir,
+        )
+
+    def init_distributed(self):
+        print(f"dist init r={self.rank}, world={self.world_size}")
+        dist.init_process_group(
+            init_method=f"{FILE_SCHEMA}{self.file_name}",
+            backend="nccl",
+            world_size=self.world_size,
+            rank=self.rank,
+        )
+        dist.barrier()
+        torch.cuda.synchronize()
+
+    @requires_nccl()
+    @skip_if_lt_x_gpu(4)
+    def test_profile_merge(self):
+        """Each agent profiles its range of layers and load_profile()
+        merges the partial profiles."""
+        temp_path = Path(os.environ["TEMP_DIR"])
+        profile_dir = temp_path / tag / "profile"
+        profile_dir.mkdir(parents=True, exist_ok=True)
+
+        torch.cuda.set_device(self.rank)
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(self.rank)
+
+        self.init_configuration_engine(temp_path)
+
+        profiler = ModelProfiler(
+            tag=tag,
+            model_name_or_path=model_name,
+            optimizer_class="torch.optim.Adam",
+            config=config,
+            precision="fp32",
+            tp_size=self.tp_size,
+            base_dir=temp_path,
+        )
+
+        dataloader = GLUEDataBuilder("gpt2").dataloader(batch_size=16)
+        inputs = next(iter(dataloader))
+        profiler.init_profile(inputs)
+
+        # All agents have written their partial profiles after the barrier.
+        self.init_distributed()
+
+        partials = [
+            json.loads(
+                ModelProfiler.get_partial_profile_path(
+                    profile_dir, self.tp_size, 16, "fp32", agent_index, self.num_agents
+                ).read_text()
+            )
+            for agent_index in range(self.num_agents)
+        ]
+        assert all(partial["num_layers"] == len(modules) for partial in partials)
+        assert [
+            layer["layer_name"] for partial in partials for layer in partial["layers"]
+        ] == modules
+        # Identical transformer blocks are measured only once.
+        representatives = {
+            layer["layer_index"]: layer["representative"]
+            for partial in partials
+            for layer in partial["layers"]
+            if "representative" in layer
+        }
+        assert representatives
+
+        profile_result = profiler.load_profile(16)
+        dist.barrier()
+
+        assert [layer.layer_index for layer in profile_result] == list(
+            range(len(modules))
+        )
+        assert [layer.layer_name for layer in profile_result] == modules
+        for index, representative in representatives.items():
+            assert profile_result[index].forward == (
+                profile_result[representative].forward
+            )
+            assert profile_result[index].mem_required == (
+                profile_result[representative].mem_required
+            )
+
+        data = json.loads(
+            ModelProfiler.get_profile_path(
+                profile_dir, self.tp_size, 16, "fp32"
+            ).read_text()
+        )
+        assert not any("representative" in layer for layer in data["layers"])
+
+        results = [None] * self.world_size
+        dist.all_gather_object(results, profile_result)
+        assert all([result == profile_result for result in results])
+
+
+def test_get_layer_range():
+    for num_layers in [1, 5, len(modules)]:
+        for num_agents in [1, 2, 3, 8]:
+            layer_ranges = [
+                ModelProfiler.get_layer_range(num_layers, agent_index, num_agents)
+                for agent_index in range(num_agents)
+            ]
+            assert [
+                index for layer_range in layer_ranges for index in layer_range
+            ] == list(range(num_layers))
+            assert max(map(len, layer_ranges)) - min(map(len, layer_ranges)) <= 1
+
+
+def test_load_partial_profile_from_whole_profile(tmp_path: Path):
+    profiler = ModelProfiler(
+        tag=tag,
+        model_name_or_path=model_name,
+        optimizer_class="torch.optim.Adam",
+        config=config,
+        precision="fp32",
+        tp_size=1,
+        base_dir=tmp_path,
+    )
+    init_profile_data(
+        profile_dir=profiler.profile_dir,
+        tp_size=1,
+        microbatch_size=microbatch_size,
+        precision="fp32",
+    )
+
+    partials = [
+        profiler._load_partial_profile(microbatch_size, agent_index, 3)
+        for agent_index in range(3)
+    ]
+    assert all(partial["num_layers"] == len(modules) for partial in partials)
+    assert [
+        layer["layer_name"] for partial in partials for layer in partial["layers"]
+    ] == modules
+
+
+def test_resize_batch():
+    tensor = torch.arange(6).view(3, 2)
+
+    assert torch.equal(ModelProfiler.resize_batch(tensor, 2), tensor[:2])
+    assert torch.equal(ModelProfiler.resize_batch(tensor, 3), tensor)
+    resized = ModelProfiler.resize_batch(tensor, 7)
+    assert resized.shape == (7, 2)
+    assert torch.equal(resized[:6], torch.cat([tensor, tensor]))
+    assert torch.equal(resized[6], tensor[0])
+
+
+def test_get_passthrough_outputs():
+    inputs = (torch.ones(2, 3),)
+    layer_inputs = (torch.full((2, 3), 2.0),)
+
+    passthrough = ModelProfiler.get_passthrough_outputs(
+        inputs, (torch.zeros(2, 3), None)
+    )
+    outputs = passthrough(layer_inputs)
+    assert outputs[0] is layer_inputs[0]
+    assert outputs[1:] == (None,)
+    assert passthrough((torch.ones(4, 3),)) is None
+
+    passthrough = ModelProfiler.get_passthrough_outputs(inputs, torch.zeros(2, 3))
+    assert passthrough(layer_inputs) is layer_inputs[0]
+
+    # Layers that change the shape of inputs cannot pass them through.
+    assert ModelProfiler.get_passthrough_outputs(inputs, torch.zeros(2, 4)) is None
+    assert ModelProfiler.get_passthrough_outputs((), torch.zeros(2, 3)) is None
+
+
+def test_fit_and_synthesize_profile():
+    def linear_profile(microbatch_size: int) -> list[LayerExecutionResult]:
+        return [
+            LayerExecutionResult(
+                layer_index=index,
+                layer_name=layer_name,
+                forward=0.5 + index * microbatch_size,
+                backward=1.0 + 2 * index * microbatch_size,
+                mem_required=100 + 10 * microbatch_size,
+                activation_bytes=1024 * microbatch_size,
+                backward_no_checkpointing=0.5 + index * microbatch_size,
+                mem_required_no_checkpointing=100 + 20 * microbatch_size,
+            )
+            for index, layer_name in enumerate(modules)
+        ]
+
+    fits = ModelProfiler.fit_profiles(
+        {size: linear_profile(size) for size in [1, 2, 4]}
+    )
+    assert [fit["layer_name"] for fit in fits] == modules
+
+    for size in [1, 3, 8]:
+        for synthesized, expected in zip(
+            ModelProfiler.synthesize_profile(fits, size), linear_profile(size)
+        ):
+            assert synthesized.layer_name == expected.layer_name
+            assert synthesized.forward == pytest.approx(expected.forward)
+            assert synthesized.backward == pytest.approx(expected.backward)
+            assert synthesized.mem_required == expected.mem_required
+            assert synthesized.activation_bytes == expected.activation_bytes
+            assert synthesized.backward_no_checkpointing == pytest.approx(
+                expected.backward_no_checkpointing
+            )
+            assert (
+                synthesized.mem_required_no_checkpointing
+                == expected.mem_required_no_checkpointing
+            )
+
+    # With one microbatch size, metrics are proportional to microbatch size.
+    fits = ModelProfiler.fit_profiles({2: linear_profile(2)})
+    synthesized = ModelProfiler.synthesize_profile(fits, 4)
+    assert synthesized[1].forward == pytest.approx(2 * linear_profile(2)[1].forward)
+    assert synthesized[1].activation_bytes == 2 * linear_profile(2)[1].activation_bytes
+
+    # Metrics not profiled in some microbatch size are not fitted.
+    profiles = {size: linear_profile(size) for size in [1, 2]}
+    profiles[2][0].backward_no_checkpointing = None
+    profiles[2][0].mem_required_no_checkpointing = None
+    synthesized = ModelProfiler.synthesize_profile(
+        ModelProfiler.fit_profiles(profiles), 4
+    )
+    assert synthesized[0].backward_no_checkpointing is None
+    assert synthesized[0].mem_required_no_checkpointing is None
+    assert synthesized[1].backward_no_checkpointing is not None
+
+
+def test_get_timing_statistics():
+    stats = ModelProfiler.get_timing_statistics([4.0, 1.0, 3.0, 2.0, 5.0])
+    assert stats["mean"] == pytest.approx(3.0)
+    assert stats["median"] == pytest.approx(3.0)
+    assert stats["p95"] == pytest.approx(4.8)
+    assert stats["std"] == pytest.approx(2**0.5)
+
+    stats = ModelProfiler.get_timing_statistics([2.0])
+    assert stats == {"mean": 2.0, "median": 2.0, "p95": 2.0, "std": 0.0}
+
+
+def test_layer_execution_result_from_dict():
+    layer = {
+        "layer_index": 0,
+        "layer_name": modules[0],
+        "forward": 2.0,
+        "backward": 4.0,
+        "mem_required": 10,
+    }
+    result = LayerExecutionResult.from_dict(layer, "p95")
+    assert (result.forward, result.backward) == (2.0, 4.0)
+    assert result.activation_bytes == 0
+    assert result.optimizer_step == 0.0
+    assert result.backward_no_checkpointing is None
+
+    layer["forward_stats"] = {"mean": 2.0, "median": 1.5, "p95": 3.0, "std": 0.5}
+    layer["backward_stats"] = {"mean": 4.0, "median": 3.5, "p95": 6.0, "std": 1.0}
+    for statistic, expected in [("mean", (2.0, 4.0)), ("p95", (3.0, 6.0))]:
+        result = LayerExecutionResult.from_dict(layer, statistic)
+        assert (result.forward, result.backward) == expected
+
+    layer["optimizer_step"] = 1.0
+    layer["optimizer_step_stats"] = {"mean": 1.0, "median": 1.0, "p95": 1.5, "std": 0.2}
+    layer["backward_no_checkpointing"] = 3.0
+    layer["backward_no_checkpointing_stats"] = {
+        "mean": 3.0,
+        "median": 2.5,
+        "p95": 5.0,
+        "std": 1.0,
+    }
+    result = LayerExecutionResult.from_dict(layer, "p95")
+    assert (result.optimizer_step, result.backward_no_checkpointing) == (1.5, 5.0)
+
+    with pytest.raises(ValueError):
+        LayerExecutionResult.from_dict(layer, "std")
+
+
+def test_get_representatives():
+    model = nn.Module()
+    model.embed = nn.Embedding(10, 4)
+    model.blocks = nn.ModuleList(
+        [nn.Sequential(nn.Linear(4, 4), nn.Dropout(0.1)) for _ in range(3)]
+    )
+    model.other_block = nn.Sequential(nn.Linear(4, 4), nn.Dropout(0.2))
+    model.head = nn.Linear(4, 10)
+    model.other_head = nn.Linear(4, 10)
+    layers = [
+        "embed",
+        "blocks.0",
+        "blocks.1",
+        "blocks.2",
+        "other_block",
+        "head",
+        "other_head",
+    ]
+
+    assert ModelProfiler.get_representatives(model, layers) == [0, 1, 1, 1, 4, 5, 5]
@@ -0,0 +1,159 @@
+import dataclasses
+
+import pytest
+from cornstarch.pipeline_template import PipelineTemplate
+
+from oobleck.planning.profiler import LayerExecutionResult
+from oobleck.planning.simulator import PipelineSimulator
+
+from ..conftest import model_name, modules
+
+# Every layer takes 1 ms for forward and backward in the `profile_data` fixture.
+template_1stage = PipelineTemplate(model_name, [modules])
+template_2stages = PipelineTemplate(model_name, [modules[:5], modules[5:]])
+
+
+def test_get_schedule():
+    schedule = PipelineSimulator.get_schedule(num_stages=3, num_microbatches=4)
+
+    assert schedule[0] == [
+        ("forward", 0),
+        ("forward", 1),
+        ("forward", 2),
+        ("backward", 0),
+        ("forward", 3),
+        ("backward", 1),
+        ("backward", 2),
+        ("backward", 3),
+    ]
+    assert schedule[2] == [
+        pass_
+        for index in range(4)
+        for pass_ in (("forward", index), ("backward", index))
+    ]
+    for passes in schedule:
+        assert sorted(passes) == sorted(
+            (name, index) for name in ["forward", "backward"] for index in range(4)
+        )
+
+
+@pytest.mark.parametrize("num_microbatches", [1, 2, 8])
+def test_simulate_uniform_pipeline(
+    profile_data: list[LayerExecutionResult], num_microbatches: int
+):
+    simulator = PipelineSimulator(profile_data)
+    result = simulator.simulate(
+        [template_2stages], {template_2stages: num_microbatches}
+    )
+
+    stage_time = 2 * len(modules) / 2
+    assert result.iteration_time == pytest.approx((num_microbatches + 1) * stage_time)
+    assert result.allreduce_time == 0.0
+    assert result.bubble_fraction == pytest.approx(1 / (num_microbatches + 1))
+    assert result.stage_utilization == [
+        [pytest.approx(num_microbatches / (num_microbatches + 1))] * 2
+    ]
+
+
+def test_simulate_host_speeds(profile_data: list[LayerExecutionResult]):
+    simulator = PipelineSimulator(profile_data)
+    result = simulator.simulate([template_2stages], {template_2stages: 4})
+    faster = simulator.simulate(
+        [template_2stages], {template_2stages: 4}, host_speeds=[2.0, 2.0]
+    )
+    slower = simulator.simulate(
+        [template_2stages], {template_2stages: 4}, host_speeds=[1.0, 0.5]
+    )
+
+    assert faster.iteration_time == pytest.approx(result.iteration_time / 2)
+    assert slower.iteration_time > result.iteration_time
+    # The faster stage waits for the slower one.
+    assert slower.stage_utilization[0][0] < slower.stage_utilization[0][1]
+
+
+def test_simulate_transfer(profile_data: list[LayerExecutionResult]):
+    bandwidth = 1.0
+    latency = 0.5
+    simulator = PipelineSimulator(
+        profile_data, inter_node_bandwidth=bandwidth, inter_node_latency=latency
+    )
+    result = simulator.simulate([template_2stages], {template_2stages: 1})
+
+    transfer_time = latency + profile_data[4].activation_bytes * 8 / (bandwidth * 1e6)
+    # forward, forward, backward, backward with transfers in between
+    assert result.iteration_time == pytest.approx(
+        2 * 2 * len(modules) / 2 + 2 * transfer_time
+    )
+    assert result.allreduce_time == 0.0
+
+
+def test_simulate_allreduce(profile_data: list[LayerExecutionResult]):
+    bandwidth = 1.0
+    num_gradient_bytes = 2**20
+    simulator = PipelineSimulator(
+        profile_data,
+        inter_node_bandwidth=bandwidth,
+        layer_num_gradient_bytes=[num_gradient_bytes] * len(profile_data),
+    )
+    result = simulator.simulate(
+        [template_1stage, template_1stage, template_1stage],
+        {template_1stage: 4},
+    )
+
+    assert result.pipeline_time == pytest.approx(4 * 2 * len(modules))
+    # Each device all-reduces all layers one by one.
+    assert result.allreduce_time == pytest.approx(
+        len(modules) * 2 * (3 - 1) / 3 * num_gradient_bytes * 8 / (bandwidth * 1e6)
+    )
+    assert result.iteration_time == pytest.approx(
+        result.pipeline_time + result.allreduce_time
+    )
+    assert result.bubble_fraction == pytest.approx(0.0)
+
+
+def test_simulate_instantiation(profile_data: list[LayerExecutionResult]):
+    simulator = PipelineSimulator(profile_data)
+    result = simulator.simulate_instantiation(
+        {template_1stage: 1, template_2stages: 2},
+        {template_1stage: 2, template_2stages: 3},
+    )
+
+    assert len(result.stage_utilization) == 3
+    assert [len(utilization) for utilization in result.stage_utilization] == [
+        1,
+        2,
+        2,
+    ]
+    assert result.iteration_time == pytest.approx(
+        max(2 * 2 * len(modules), (3 + 1) * 2 * len(modules) / 2)
+    )
+    assert 0.0 < result.bubble_fraction < 1.0
+
+
+def test_simulate_optimizer_step_and_checkpointing(
+    profile_data: list[LayerExecutionResult],
+):
+    profile_data = [
+        dataclasses.replace(
+            layer,
+            optimizer_step=0.5,
+            backward_no_checkpointing=0.5,
+            mem_required_no_checkpointing=30 if layer.layer_name in modules[:5] else 20,
+        )
+        for layer in profile_data
+    ]
+
+    simulator = PipelineSimulator(profile_data)
+    assert simulator.get_stage_checkpointing(template_2stages) == [True, True]
+    result = simulator.simulate([template_2stages], {template_2stages: 1})
+    # forward, forward, backward, backward, and then optimizer step of 5 layers
+    assert result.pipeline_time == pytest.approx(4 * 5)
+    assert result.optimizer_step_time == pytest.approx(5 * 0.5)
+    assert result.iteration_time == pytest.approx(4 * 5 + 5 * 0.5)
+
+    # Only the second stage fits in device memory without checkpointing.
+    simulator = PipelineSimulator(profile_data, device_memory=20 * 5)
+    assert simulator.get_stage_checkpointing(template_2stages) == [True, False]
+    result = simulator.simulate([template_2stages], {template_2stages: 1})
+    assert result.pipeline_time == pytest.approx(3 * 5 + 5 * 0.5)
+    assert result.iteration_time == pytest.approx(3 * 5 + 5 * 0.5 + 5 * 0.5)
@@ -0,0 +1,56 @@
+from dataclasses import replace
+from pathlib import Path
+
+from cornstarch.pipeline_template import PipelineTemplate
+
+from oobleck.planning.profiler import LayerExecutionResult
+from oobleck.planning.template_cache import PipelineTemplateCache
+
+from ..conftest import model_name, modules
+
+
+def test_cache_key_depends_on_inputs(profile_data: list[LayerExecutionResult]):
+    key = PipelineTemplateCache.get_cache_key(model_name, profile_data, 1, 1, [1, 2])
+
+    assert key == PipelineTemplateCache.get_cache_key(
+        model_name, profile_data, 1, 1, [2, 1]
+    )
+    assert key != PipelineTemplateCache.get_cache_key(
+        model_name, profile_data, 2, 1, [1, 2]
+    )
+    assert key != PipelineTemplateCache.get_cache_key(
+        model_name, profile_data, 1, 2, [1, 2]
+    )
+    assert key != PipelineTemplateCache.get_cache_key(
+        model_name, profile_data, 1, 1, [1, 2, 3]
+    )
+
+    changed_profile_data = [replace(profile_data[0], forward=2.0)] + profile_data[1:]
+    assert key != PipelineTemplateCache.get_cache_key(
+        model_name, changed_profile_data, 1, 1, [1, 2]
+    )
+
+
+def test_store_and_load(tmp_path: Path, profile_data: list[LayerExecutionResult]):
+    cache = PipelineTemplateCache(tmp_path)
+    key = PipelineTemplateCache.get_cache_key(model_name, profile_data, 1, 1, [1, 2])
+
+    assert cache.load(key) is None
+
+    templates = {
+        1: PipelineTemplate(model_name, [modules]),
+        2: PipelineTemplate(model_name, [modules[:3], modules[3:]]),
+    }
+    cache.store(key, templates, {3: "sanity check failed"})
+
+    loaded = cache.load(key)
+    assert loaded == templates
+    assert list(cache.cache_dir.iterdir()) == [cache.get_cache_path(key)]
+
+
+def test_broken_cache_ignored(tmp_path: Path):
+    cache = PipelineTemplateCache(tmp_path)
+    cache.cache_dir.mkdir(parents=True)
+    cache.get_cache_path("broken").write_bytes(b"not a pickle")
+
+    assert cache.load("broken") is None
@@ -0,0 +1,137 @@
+import json
+from pathlib import Path
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from oobleck.planning.profiler import ModelProfiler
+from oobleck.planning.whatif import CapacityPlanner, main, parse_num_nodes
+
+from ..conftest import init_profile_data, modules
+from .conftest import microbatch_size, precision, tp_size
+
+global_batch_size = 32
+
+
+@pytest.fixture
+def profile_path(tmp_path: Path) -> Path:
+    init_profile_data(
+        profile_dir=tmp_path,
+        tp_size=tp_size,
+        microbatch_size=microbatch_size,
+        precision=precision,
+    )
+    return ModelProfiler.get_profile_path(tmp_path, tp_size, microbatch_size, precision)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("8", [8]),
+        ("2..5", [2, 3, 4, 5]),
+        ("8..16..4", [8, 12, 16]),
+        ("4,1..3,4", [1, 2, 3, 4]),
+    ],
+)
+def test_parse_num_nodes(value: str, expected: list[int]):
+    assert parse_num_nodes(None, None, value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "a", "1..", "1..4..0", "0..2"])
+def test_parse_num_nodes_invalid(value: str):
+    with pytest.raises(click.BadParameter):
+        parse_num_nodes(None, None, value)
+
+
+def test_predict(profile_path: Path):
+    planner = CapacityPlanner.from_profile(
+        profile_path, global_batch_size=global_batch_size
+    )
+    assert len(planner.profile_data) == len(modules)
+    assert planner.microbatch_size == microbatch_size
+
+    for num_nodes in range(1, 5):
+        result = planner.predict(num_nodes, simulate=True)
+
+        assert result.error is None
+        assert result.num_nodes == num_nodes
+        assert result.iteration_time > 0
+        assert result.samples_per_second == pytest.approx(
+            global_batch_size / (result.iteration_time / 1000)
+        )
+        assert result.simulated_iteration_time > 0
+        assert (
+            sum(
+                num_stages * count for num_stages, count in result.num_instances.items()
+            )
+            == num_nodes
+        )
+        assert (
+            sum(
+                result.num_microbatches[num_stages] * count
+                for num_stages, count in result.num_instances.items()
+            )
+            == global_batch_size // microbatch_size
+        )
+
+
+def test_predict_allreduce(profile_path: Path):
+    kwargs = dict(
+        global_batch_size=global_batch_size,
+        inter_node_bandwidth=1.0,
+        # Gradients are all-reduced across at least two pipelines.
+        fault_tolerance_threshold=2,
+    )
+    planner = CapacityPlanner.from_profile(profile_path, **kwargs)
+    assert planner.layer_num_gradient_bytes is None
+    without_allreduce = planner.predict(4, simulate=True)
+
+    data = json.loads(profile_path.read_text())
+    for layer in data["layers"]:
+        layer["num_parameters"] = 1024 * 1024
+    profile_path.write_text(json.dumps(data))
+
+    planner = CapacityPlanner.from_profile(profile_path, **kwargs)
+    assert planner.layer_num_gradient_bytes == [4 * 1024 * 1024] * len(modules)
+    with_allreduce = planner.predict(4, simulate=True)
+
+    assert sum(with_allreduce.num_instances.values()) > 1
+    assert with_allreduce.iteration_time > without_allreduce.iteration_time
+    assert (
+        with_allreduce.simulated_iteration_time
+        > without_allreduce.simulated_iteration_time
+    )
+
+
+def test_predict_infeasible(profile_path: Path):
+    planner = CapacityPlanner.from_profile(
+        profile_path,
+        global_batch_size=global_batch_size,
+        # The model needs at least two nodes.
+        device_memory=10 * len(modules) - 1,
+    )
+
+    assert planner.predict(1).error is not None
+    assert planner.predict(2).error is None
+
+
+def test_whatif_cli(profile_path: Path):
+    result = CliRunner().invoke(
+        main,
+        [
+            "--profile",
+            str(profile_path),
+            "--nodes",
+            "1..4",
+            "--global_batch_size",
+            str(global_batch_size),
+            "--simulate",
+        ],
+    )
+
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[0].split()[0] == "nodes"
+    assert [int(line.split()[0]) for line in lines[1:]] == [1, 2, 3, 4]
+    assert "1x1-stage" in lines[1]